@@ -0,0 +1,298 @@
+import atexit
+import base64
+import logging
+import queue
+import random
+import threading
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+from django.db import close_old_connections, transaction
+
+from .models import SearchRequest, SearchQuery, SearchResponse
+from .quantization import encode_embedding
+from .util import get_env
+from .metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+# How searches are logged (SearchRequest, SearchQuery, SearchResponse and its laws):
+#   queue   written behind by a background thread of this worker, in batches (default)
+#   celery  written by a celery worker (api_app.tasks.write_search_events_task)
+#   sync    written within the request, the results carry the id of the SearchQuery
+SEARCH_LOG_MODE = get_env('SEARCH_LOG_MODE', 'queue')
+
+# Share of the searches that are logged at all
+SEARCH_LOG_SAMPLE_RATE = float(get_env('SEARCH_LOG_SAMPLE_RATE', 1.0))
+
+# Back-pressure of the queue: at most SEARCH_LOG_QUEUE_SIZE events wait to be written.
+# When the queue is full, a search waits up to SEARCH_LOG_BLOCK_TIMEOUT seconds for
+# space and then drops its event, so a slow database never blocks the searches.
+SEARCH_LOG_QUEUE_SIZE = int(get_env('SEARCH_LOG_QUEUE_SIZE', 10000))
+SEARCH_LOG_BLOCK_TIMEOUT = float(get_env('SEARCH_LOG_BLOCK_TIMEOUT', 0.0))
+SEARCH_LOG_BATCH_SIZE = int(get_env('SEARCH_LOG_BATCH_SIZE', 256))
+SEARCH_LOG_FLUSH_INTERVAL = float(get_env('SEARCH_LOG_FLUSH_INTERVAL', 1.0))
+
+
+def search_event(query: str, embedding: np.ndarray, law_ids: List[int]) -> dict:
+    """
+    Creates the log event of a search.
+
+    Parameters:
+    query (str): The search query.
+    embedding (np.ndarray): The embedding of the query.
+    law_ids (List[int]): The primary keys of the returned laws.
+
+    Returns:
+    dict: The event.
+    """
+    return {
+        'query': query,
+        'query_reduced': query[:SearchRequest.reduced_text_length],
+        'embedding': encode_embedding(embedding),
+        'law_ids': list(law_ids),
+    }
+
+
+def event_to_json(event: dict) -> dict:
+    """Makes an event JSON serializable (for celery)."""
+    return {**event, 'embedding': base64.b64encode(event['embedding']).decode('ascii')}
+
+
+def event_from_json(event: dict) -> dict:
+    """Reverts event_to_json."""
+    return {**event, 'embedding': base64.b64decode(event['embedding'])}
+
+
+def write_search_events(events: List[dict]) -> dict:
+    """
+    Writes a batch of search events in one transaction.
+
+    Every table is written with one bulk insert, no matter how many events the batch
+    holds. Queries that were logged before keep their SearchQuery.
+
+    Parameters:
+    events (List[dict]): The events created by search_event.
+
+    Returns:
+    dict: The ids of the SearchQuery objects, keyed by the reduced query.
+    """
+    if not events:
+        return {}
+
+    reduced_queries = {event['query_reduced'] for event in events}
+
+    with transaction.atomic():
+        query_ids = dict(
+            SearchQuery.objects.filter(query_reduced__in=reduced_queries).values_list('query_reduced', 'id')
+        )
+
+        SearchRequest.objects.bulk_create([
+            SearchRequest(search_text=query, search_text_reduced=query[:SearchRequest.reduced_text_length])
+            for query in {event['query'] for event in events}
+        ], ignore_conflicts=True)
+
+        new_events = list({
+            event['query_reduced']: event for event in events if event['query_reduced'] not in query_ids
+        }.values())
+        if new_events:
+            request_ids = dict(
+                SearchRequest.objects.filter(
+                    search_text__in=[event['query'] for event in new_events]
+                ).values_list('search_text', 'id')
+            )
+            SearchQuery.objects.bulk_create([
+                SearchQuery(
+                    search_request_id=request_ids[event['query']],
+                    query_text=event['query'],
+                    query_reduced=event['query_reduced'],
+                    embedding=event['embedding'],
+                ) for event in new_events
+            ], ignore_conflicts=True)
+            query_ids.update(
+                SearchQuery.objects.filter(
+                    query_reduced__in=[event['query_reduced'] for event in new_events]
+                ).values_list('query_reduced', 'id')
+            )
+
+        responses = SearchResponse.objects.bulk_create([
+            SearchResponse(search_query_id=query_ids[event['query_reduced']]) for event in events
+        ])
+        SearchResponse.laws.through.objects.bulk_create([
+            SearchResponse.laws.through(searchresponse_id=response.id, embeddedlaw_id=law_id)
+            for response, event in zip(responses, events)
+            for law_id in event['law_ids']
+        ])
+
+    metrics.increment('search_log_events_total', len(events), result='written')
+    return query_ids
+
+
+class WriteBehindQueue:
+    """
+    A bounded queue that is written to the database by a background thread.
+
+    Producers never wait for the database: put() only waits (up to block_timeout)
+    while the queue is full and drops the item afterwards. The thread collects up to
+    batch_size items, or whatever arrived within flush_interval, and hands them to
+    flush as one batch.
+    """
+
+    def __init__(self, flush: Callable[[list], object], max_size: int, batch_size: int,
+                 flush_interval: float, block_timeout: float = 0.0, name: str = 'write-behind'):
+        self.flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.name = name
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition()
+        self._pending = 0
+
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def put(self, item) -> bool:
+        """
+        Queues an item.
+
+        Returns:
+        bool: False if the queue stayed full and the item was dropped.
+        """
+        self._ensure_thread()
+        with self._idle:
+            self._pending += 1
+        try:
+            if self.block_timeout > 0:
+                self._queue.put(item, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            self._done(1)
+            return False
+        return True
+
+    def _done(self, count: int):
+        with self._idle:
+            self._pending -= count
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def _next_batch(self) -> list:
+        """Waits for the first item, then collects more until the batch is full or the interval is over."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.flush(batch)
+                self.written += len(batch)
+                self.batches += 1
+            except Exception as e:
+                self.errors += 1
+                metrics.increment('search_log_errors_total')
+                logger.error("%s: Writing %d items failed: %s", self.name, len(batch), e)
+            finally:
+                close_old_connections()
+                self._done(len(batch))
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until every queued item was written (or failed).
+
+        Returns:
+        bool: False if the timeout passed first.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'max_size': self._queue.maxsize,
+            'written': self.written,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
+
+
+# The search log of this worker
+search_log_queue = WriteBehindQueue(
+    write_search_events,
+    max_size=SEARCH_LOG_QUEUE_SIZE,
+    batch_size=SEARCH_LOG_BATCH_SIZE,
+    flush_interval=SEARCH_LOG_FLUSH_INTERVAL,
+    block_timeout=SEARCH_LOG_BLOCK_TIMEOUT,
+    name='search-log',
+)
+
+# Write what is still queued when the worker shuts down
+atexit.register(search_log_queue.join, 5.0)
+
+
+def log_search(query: str, embedding: np.ndarray, law_ids: List[int]) -> Optional[int]:
+    """
+    Logs a search according to SEARCH_LOG_MODE and SEARCH_LOG_SAMPLE_RATE.
+
+    Parameters:
+    query (str): The search query.
+    embedding (np.ndarray): The embedding of the query.
+    law_ids (List[int]): The primary keys of the returned laws.
+
+    Returns:
+    int: The id of the SearchQuery in sync mode, otherwise None (it is not known yet).
+    """
+    if SEARCH_LOG_SAMPLE_RATE < 1.0 and random.random() >= SEARCH_LOG_SAMPLE_RATE:
+        metrics.increment('search_log_events_total', result='sampled_out')
+        return None
+
+    event = search_event(query, embedding, law_ids)
+
+    if SEARCH_LOG_MODE == 'sync':
+        return write_search_events([event]).get(event['query_reduced'])
+
+    if SEARCH_LOG_MODE == 'celery':
+        from .tasks import write_search_events_task
+        write_search_events_task.delay([event_to_json(event)])
+    elif not search_log_queue.put(event):
+        metrics.increment('search_log_events_total', result='dropped')
+        return None
+
+    metrics.increment('search_log_events_total', result='queued')
+    return None
+
+
+async def alog_search(query: str, embedding: np.ndarray, law_ids: List[int]) -> Optional[int]:
+    """
+    Async version of log_search. Only the sync mode touches the database in the request.
+    """
+    if SEARCH_LOG_MODE == 'sync':
+        from asgiref.sync import sync_to_async
+        return await sync_to_async(log_search)(query, embedding, law_ids)
+    return log_search(query, embedding, law_ids)
@@ -20,5 +20,9 @@ class ApiAppConfig(AppConfig):
         # except (OperationalError, ProgrammingError):
         #     # Handle the case where the table doesn't exist yet
         #     pass
-        pass
+
+        # The triggers of the keyword index call fold_text on every write to EmbeddedLaw
+        from django.db.backends.signals import connection_created
+        from .keyword_index import register_sql_functions
+        connection_created.connect(register_sql_functions, dispatch_uid='api_app.register_sql_functions')
         
\ No newline at end of file
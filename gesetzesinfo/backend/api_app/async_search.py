@@ -0,0 +1,256 @@
+import asyncio
+import logging
+from functools import partial
+
+from django.http import JsonResponse
+from django.http import HttpRequest
+import numpy as np
+
+from .models import EmbeddedLaw
+from .util import clear_text
+from .clients import get_async_openai_client
+from .embedding_cache import embedding_cache
+from .analytics import alog_search
+from .result_cache import result_cache_key, get_cached_results, cache_results, entry_embedding
+from .search import (
+    KEYWORD_EXTRACTION_MODE, keyword_cache, keyword_cache_key, keyword_extraction_request, parse_keywords_response,
+    refresh_keywords_llm, embedding_request, embedding_batcher, query_to_keywords, natural_language_search, multi_keyword_search,
+    combine_search_results, build_final_results, parse_search_query, submit_search_task, keyword_fallback,
+)
+from .deadline import Deadline, client_with_deadline
+from .timing import stage
+from .singleflight import AsyncSingleFlight
+from .metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run_search_task(fn, *args, **kwargs):
+    """
+    Runs a blocking stage (faiss, numpy, raw SQL) on the search executor without blocking the event loop.
+    """
+    return await asyncio.wrap_future(submit_search_task(fn, *args, **kwargs))
+
+
+async def arequest_embedding(text: str, deadline: Deadline = None) -> np.ndarray:
+    """
+    Async version of request_embedding.
+    """
+    if embedding_batcher is not None:
+        timeout = deadline.remaining() if deadline is not None else None
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(embedding_batcher.submit(text, deadline)), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"The embedding batch did not return within {timeout}s") from None
+
+    client = client_with_deadline(get_async_openai_client('openai'), deadline)
+    response = await client.embeddings.create(**embedding_request(text))
+    return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+
+async def aget_embedding(text: str, deadline: Deadline = None) -> np.ndarray:
+    """
+    Async version of get_embedding, served from the query embedding cache when possible.
+    """
+    timeout = deadline.remaining() if deadline is not None else None
+    return await embedding_cache.aget_or_compute(text, partial(arequest_embedding, deadline=deadline), timeout)
+
+
+async def aextract_keywords_llm(query: str, max_keywords: int, deadline: Deadline, cache_key: tuple) -> tuple:
+    """
+    Async version of extract_keywords_llm.
+    """
+    request = keyword_extraction_request(query, max_keywords)
+    llm_client = get_async_openai_client('llm')
+
+    max_retries = 3
+    keywords = []
+    error = None
+    for attempt in range(max_retries):
+        try:
+            response = await client_with_deadline(llm_client, deadline).chat.completions.create(**request)
+            keywords = parse_keywords_response(response)
+
+            if keywords:
+                keyword_cache.set(cache_key, tuple(keywords))
+            break
+
+        except Exception as e:
+            logger.warning("aquery_to_keywords_llm: Attempt %d failed: %s", attempt + 1, e)
+            error = e
+
+            pause = deadline.retry_backoff(attempt) if attempt + 1 < max_retries else None
+            if pause is None:
+                break
+            await asyncio.sleep(pause)
+
+    return keywords, error
+
+
+# Concurrent extractions of the same query share one llm call
+keyword_flights = AsyncSingleFlight('keywords')
+
+
+async def aquery_to_keywords_llm(query: str, max_keywords: int = 32, deadline: Deadline = None) -> list:
+    """
+    Async version of query_to_keywords_llm, sharing its prompt, cache, retry budget and mode.
+    """
+    cache_key = keyword_cache_key(query, max_keywords)
+
+    cached_keywords = keyword_cache.get(cache_key)
+    if cached_keywords is not None:
+        metrics.increment('keyword_extractions_total', source='cache')
+        return list(cached_keywords)
+
+    if KEYWORD_EXTRACTION_MODE in ('local', 'async'):
+        if KEYWORD_EXTRACTION_MODE == 'async':
+            refresh_keywords_llm(query, max_keywords, cache_key)
+            # Results with the local keywords must not outlive the refresh
+            if deadline is not None:
+                deadline.mark_provisional('keywords')
+        metrics.increment('keyword_extractions_total', source='local')
+        return query_to_keywords(query, max_keywords)
+
+    deadline = deadline or Deadline(0)
+    query = clear_text(query)
+
+    try:
+        keywords, error = await keyword_flights.do(
+            cache_key, partial(aextract_keywords_llm, query, max_keywords, deadline, cache_key), deadline.remaining()
+        )
+    except TimeoutError as e:
+        keywords, error = [], e
+
+    if not keywords:
+        logger.info("aquery_to_keywords_llm: Defaulting to non AI keyword extraction from query.")
+        deadline.degrade('keywords', 'local_keywords', error)
+        metrics.increment('keyword_extractions_total', source='local')
+        return query_to_keywords(query, max_keywords)
+
+    metrics.increment('keyword_extractions_total', source='llm')
+    return list(keywords)
+
+
+async def aresults_from_cache(query: str, entry: dict) -> list:
+    """
+    Async version of results_from_cache.
+    """
+    results = entry['results']
+    try:
+        with stage('logging'):
+            query_id = await alog_search(query, entry_embedding(entry), [result['id'] for result in results])
+    except Exception as e:
+        logger.warning("Logging the search failed: %s", e)
+        query_id = None
+
+    return [{**result, 'query_id': query_id} for result in results]
+
+
+async def async_smart_search(query: str, max_results: int = 32, deadline: Deadline = None) -> list:
+    """
+    Async version of smart_search.
+
+    Waiting for the upstream apis does not block a thread, so one worker process can
+    hold many searches in flight. CPU bound stages run on the search executor. A
+    branch that outlives the deadline is cancelled and replaced by its fallback.
+
+    Parameters:
+    query (str): The search query.
+    max_results (int): The maximum number of results to return. Defaults to 32.
+    deadline (Deadline): The budget of the search, defaults to SEARCH_DEADLINE.
+
+    Returns:
+    list: The search results.
+    """
+    deadline = deadline or Deadline()
+    max_nl_results = int(max_results * 2.0)
+    max_keyword_results = int(max_results * 2.0)
+
+    with stage('result_cache'):
+        cache_key = result_cache_key(query, max_results)
+        cached = await run_search_task(get_cached_results, cache_key)
+    if cached is not None:
+        return await aresults_from_cache(query, cached)
+
+    async def vector_branch():
+        with stage('embedding'):
+            query_embedding = await aget_embedding(query, deadline)
+        with stage('vector_search'):
+            nl_search_results = await run_search_task(natural_language_search, query_embedding, max_nl_results)
+        return query_embedding, nl_search_results
+
+    async def keyword_branch():
+        with stage('keywords'):
+            keywords = await aquery_to_keywords_llm(query, deadline=deadline)
+        with stage('keyword_search'):
+            return keywords, await run_search_task(multi_keyword_search, keywords, max_keyword_results)
+
+    vector_task = asyncio.ensure_future(vector_branch())
+    keyword_task = asyncio.ensure_future(keyword_branch())
+
+    try:
+        query_embedding, nl_search_results = await asyncio.wait_for(vector_task, deadline.remaining())
+        vector_error = None
+    except Exception as e:
+        deadline.degrade('vector_search', 'keyword_only', e)
+        query_embedding, nl_search_results, vector_error = None, [], e
+
+    try:
+        keywords, keyword_search_results = await asyncio.wait_for(keyword_task, deadline.remaining())
+    except Exception as e:
+        keywords, keyword_search_results = keyword_fallback(query, deadline, e)
+
+    if vector_error is not None and not keyword_search_results:
+        raise vector_error
+
+    search_results = await run_search_task(
+        combine_search_results, nl_search_results, keyword_search_results, query_embedding, max_results
+    )
+
+    law_ids = [result['law_id'] for result in search_results]
+    with stage('hydration'):
+        laws = [law async for law in EmbeddedLaw.objects.for_results().filter(law_id__in=law_ids)]
+
+    query_id = None
+    if query_embedding is not None:
+        try:
+            with stage('logging'):
+                query_id = await alog_search(query, query_embedding, [law.id for law in laws])
+        except Exception as e:
+            logger.warning("Logging the search failed: %s", e)
+
+    with stage('snippets'):
+        final_results = build_final_results(laws, search_results, query_id, keywords)
+
+    if deadline.cacheable:
+        await run_search_task(cache_results, cache_key, final_results, query_embedding)
+
+    return final_results
+
+
+async def async_search_endpoint(request: HttpRequest) -> JsonResponse:
+    """
+    Async version of search_endpoint, served by the ASGI application.
+
+    Parameters:
+    request (HttpRequest): The HTTP request with the following query parameter:
+        q (str): The search query
+
+    Returns:
+    JsonResponse: A JSON response containing the search results or an error message
+    """
+    query, error_response = parse_search_query(request)
+    if error_response:
+        return error_response
+
+    deadline = Deadline()
+    try:
+        results = await async_smart_search(query, deadline=deadline)
+    except Exception as e:
+        return JsonResponse({'error': f"Error searching for query: {str(e)}", 'meta': deadline.meta()}, status=400)
+
+    if not results:
+        return JsonResponse({'error': 'Keine Ergebnisse gefunden.', 'meta': deadline.meta()}, status=200)
+
+    return JsonResponse({'query': query, 'results': results, 'meta': deadline.meta()}, status=200)
@@ -0,0 +1,241 @@
+import json
+import logging
+from typing import List
+
+from django.http import HttpRequest, JsonResponse
+import numpy as np
+
+from .models import EmbeddedLaw
+from .util import get_env
+from .embedding_cache import embedding_cache
+from .vector_index import law_index, law_prefix_index, truncate_embeddings, TWO_STAGE_SEARCH
+from .term_stats import get_term_stats
+from .analytics import log_search
+from .result_cache import result_cache_key, get_cached_results, cache_results
+from .search import (
+    VECTOR_SEARCH_CANDIDATES, request_embeddings, query_to_keywords_llm, keyword_candidates,
+    best_keyword_results, rescore_candidates, combine_search_results, build_final_results,
+    results_from_cache, clean_search_query, submit_search_task, query_to_keywords,
+)
+from .deadline import Deadline
+from .timing import stage
+
+
+logger = logging.getLogger(__name__)
+
+
+# The maximum number of queries of one batch request
+SEARCH_BATCH_MAX_QUERIES = int(get_env('SEARCH_BATCH_MAX_QUERIES', 64))
+SEARCH_BATCH_MAX_RESULTS = int(get_env('SEARCH_BATCH_MAX_RESULTS', 128))
+
+
+def get_embeddings(texts: List[str], deadline: Deadline = None) -> np.ndarray:
+    """
+    Batch version of get_embedding: cached embeddings are read with one lookup, all
+    missing ones are requested with one call.
+
+    Parameters:
+    texts (List[str]): The texts to get the embeddings for.
+    deadline (Deadline): The budget of the request.
+
+    Returns:
+    np.ndarray: The embeddings, one row per text.
+    """
+    embeddings = embedding_cache.get_many(texts)
+
+    missing = [text for text in dict.fromkeys(texts) if text not in embeddings]
+    if missing:
+        fresh = dict(zip(missing, request_embeddings(missing, deadline)))
+        embedding_cache.set_many(fresh)
+        embeddings.update(fresh)
+
+    return np.stack([embeddings[text] for text in texts])
+
+
+def natural_language_search_batch(embeddings: np.ndarray, max_results: int = 64) -> List[List[dict]]:
+    """
+    Batch version of natural_language_search: all queries are searched with one call of the index.
+
+    Parameters:
+    embeddings (np.ndarray): The embeddings of the queries, one row per query.
+    max_results (int): The maximum number of results per query.
+
+    Returns:
+    List[List[dict]]: The results (law_id and score) of every query.
+    """
+    if TWO_STAGE_SEARCH:
+        candidates = max(VECTOR_SEARCH_CANDIDATES, max_results)
+        _, candidate_ids = law_prefix_index.search(truncate_embeddings(embeddings), candidates)
+        return [
+            rescore_candidates(ids, embedding, max_results)
+            for ids, embedding in zip(candidate_ids, embeddings)
+        ]
+
+    distances, indices = law_index.search(embeddings, max_results)
+
+    return [
+        [{'law_id': int(idx), 'score': float(1 / (1 + distance))} for idx, distance in zip(row_indices, row_distances)]
+        for row_indices, row_distances in zip(indices, distances)
+    ]
+
+
+def multi_keyword_search_batch(keyword_lists: List[list], max_results: int = 64) -> List[List[dict]]:
+    """
+    Batch version of multi_keyword_search: the candidates of all queries are scored
+    with one sparse matrix product.
+
+    Parameters:
+    keyword_lists (List[list]): The keywords of every query.
+    max_results (int): The maximum number of results per query.
+
+    Returns:
+    List[List[dict]]: The results (law_id and score) of every query.
+    """
+    candidate_lists = [keyword_candidates(keywords, max_results) if keywords else [] for keywords in keyword_lists]
+    score_lists = get_term_stats().score_batch(candidate_lists, keyword_lists)
+
+    return [
+        best_keyword_results(candidate_ids, scores, max_results)
+        for candidate_ids, scores in zip(candidate_lists, score_lists)
+    ]
+
+
+def smart_search_batch(queries: List[str], max_results: int = 32, deadline: Deadline = None) -> List[list]:
+    """
+    Batch version of smart_search.
+
+    Cached queries are answered from the result cache. All other queries are embedded
+    with one request and searched with one call of the vector index, their keywords
+    are extracted concurrently and scored together, and all results are hydrated with
+    one query. The keywords of a query that are not extracted within the deadline
+    are taken from its text.
+
+    Every query tracks its degradations in its own child of the deadline, so only
+    the results of the degraded queries are left out of the result cache.
+
+    Parameters:
+    queries (List[str]): The search queries.
+    max_results (int): The maximum number of results per query. Defaults to 32.
+    deadline (Deadline): The budget of the whole batch, defaults to SEARCH_DEADLINE.
+
+    Returns:
+    List[list]: The results of every query, in the order of the queries.
+    """
+    deadline = deadline or Deadline()
+    max_nl_results = int(max_results * 2.0)
+    max_keyword_results = int(max_results * 2.0)
+
+    unique_queries = list(dict.fromkeys(queries))
+    cache_keys = {query: result_cache_key(query, max_results) for query in unique_queries}
+
+    results = {}
+    for query in unique_queries:
+        cached = get_cached_results(cache_keys[query])
+        if cached is not None:
+            results[query] = results_from_cache(query, cached)
+
+    pending = [query for query in unique_queries if query not in results]
+    if pending:
+        query_deadlines = [deadline.child(query) for query in pending]
+
+        # The keywords are extracted while the vector side runs
+        keyword_futures = [
+            submit_search_task(query_to_keywords_llm, query, deadline=query_deadline)
+            for query, query_deadline in zip(pending, query_deadlines)
+        ]
+
+        with stage('embedding'):
+            embeddings = get_embeddings(pending, deadline)
+        with stage('vector_search'):
+            nl_search_results = natural_language_search_batch(embeddings, max_nl_results)
+
+        # Only the wait for the keywords that the vector side did not cover
+        keyword_lists = []
+        with stage('keywords'):
+            for query, query_deadline, future in zip(pending, query_deadlines, keyword_futures):
+                try:
+                    keyword_lists.append(future.result(timeout=query_deadline.remaining()))
+                except Exception as e:
+                    query_deadline.degrade('keywords', 'local_keywords', e)
+                    keyword_lists.append(query_to_keywords(query))
+        with stage('keyword_search'):
+            keyword_search_results = multi_keyword_search_batch(keyword_lists, max_keyword_results)
+
+        search_results = [
+            combine_search_results(nl_results, keyword_results, embedding, max_results)
+            for nl_results, keyword_results, embedding in zip(nl_search_results, keyword_search_results, embeddings)
+        ]
+
+        # Hydrate the results of all queries with one query
+        law_ids = {result['law_id'] for query_results in search_results for result in query_results}
+        with stage('hydration'):
+            laws = {law.law_id: law for law in EmbeddedLaw.objects.for_results().filter(law_id__in=law_ids)}
+
+        for query, query_deadline, embedding, query_results, keywords in zip(
+            pending, query_deadlines, embeddings, search_results, keyword_lists
+        ):
+            query_laws = [laws[law_id] for law_id in dict.fromkeys(r['law_id'] for r in query_results) if law_id in laws]
+
+            try:
+                query_id = log_search(query, embedding, [law.id for law in query_laws])
+            except Exception as e:
+                logger.warning("Logging the search failed: %s", e)
+                query_id = None
+
+            results[query] = build_final_results(query_laws, query_results, query_id, keywords)
+            if query_deadline.cacheable:
+                cache_results(cache_keys[query], results[query], embedding)
+
+    return [results[query] for query in queries]
+
+
+def batch_search_endpoint(request: HttpRequest) -> JsonResponse:
+    """
+    Searches for several queries with one request.
+
+    Parameters:
+    request (HttpRequest): A POST request with a JSON body:
+        queries (List[str]): The search queries, at most SEARCH_BATCH_MAX_QUERIES
+        max_results (int): The maximum number of results per query (optional, default 32)
+
+    Returns:
+    JsonResponse: The results (or the error) of every query, in the order of the queries.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+
+    try:
+        body = json.loads(request.body)
+        queries = body['queries']
+        max_results = int(body.get('max_results', 32))
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse({'error': 'Body must be a JSON object with a list of queries'}, status=400)
+
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        return JsonResponse({'error': 'queries must be a list of strings'}, status=400)
+    if not queries or len(queries) > SEARCH_BATCH_MAX_QUERIES:
+        return JsonResponse({'error': f'queries must hold 1 to {SEARCH_BATCH_MAX_QUERIES} queries'}, status=400)
+    if not 1 <= max_results <= SEARCH_BATCH_MAX_RESULTS:
+        return JsonResponse({'error': f'max_results must be between 1 and {SEARCH_BATCH_MAX_RESULTS}'}, status=400)
+
+    cleaned = [clean_search_query(query) for query in queries]
+    valid = [query for query, error in cleaned if not error]
+
+    deadline = Deadline()
+    try:
+        results = iter(smart_search_batch(valid, max_results, deadline)) if valid else iter(())
+    except Exception as e:
+        return JsonResponse({'error': f"Error searching for queries: {str(e)}", 'meta': deadline.meta()}, status=400)
+
+    output = []
+    for original, (query, error) in zip(queries, cleaned):
+        if error:
+            output.append({'query': original, 'error': error})
+            continue
+        query_results = next(results)
+        if query_results:
+            output.append({'query': query, 'results': query_results})
+        else:
+            output.append({'query': query, 'error': 'Keine Ergebnisse gefunden.'})
+
+    return JsonResponse({'results': output, 'meta': deadline.meta()}, status=200)
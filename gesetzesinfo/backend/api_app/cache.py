@@ -0,0 +1,123 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def sizeof(value) -> int:
+    """
+    Estimates the memory used by a cached value in bytes.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes + sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeof(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    A thread safe in-process cache with least recently used eviction.
+
+    The cache holds at most `max_entries` values. If a `ttl` (seconds) is given,
+    entries expire after that time. Hits, misses, evictions and the memory used
+    by the cached values are tracked for reporting.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory_bytes = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for the key, or the default if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value, size = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """
+        Like get, but neither counted as hit or miss nor marked as recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                return entry[1]
+            return default
+
+    def set(self, key, value, ttl: float = None):
+        """
+        Stores a value. The least recently used entries are evicted if the cache is full.
+
+        Parameters:
+        key: The key of the value.
+        value: The value to cache.
+        ttl (float): Expiry of this entry in seconds, defaults to the ttl of the cache.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        size = sizeof(key) + sizeof(value)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, value, size)
+            self.memory_bytes += size
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory_bytes = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.memory_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """
+        Returns the usage statistics of the cache.
+        """
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'memory_bytes': self.memory_bytes,
+        }
@@ -0,0 +1,240 @@
+import asyncio
+import threading
+import weakref
+
+import httpx
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+from .util import get_env
+from .metrics import metrics
+
+
+# The external apis and the settings they are configured with.
+# Pool size, timeout and keep-alive can be set per upstream, e.g. LLM_POOL_SIZE=50.
+UPSTREAMS = {
+    'openai': {
+        'env_prefix': 'OPENAI',
+        'base_url': lambda: get_env('EMBEDDING_API_HOST'),
+        'api_key': lambda: get_env('OPENAI_API_KEY'),
+    },
+    'llm': {
+        'env_prefix': 'LLM',
+        'base_url': lambda: get_env('LLM_KEYWORD_EXTRACTION_HOST'),
+        'api_key': lambda: get_env('GROQ_API_KEY'),
+    },
+    'openlegaldata': {
+        'env_prefix': 'OPENLEGALDATA',
+        'base_url': lambda: get_env('OPENLEGALDATA_HOST', 'https://de.openlegaldata.io/api/'),
+        'api_key': lambda: get_env('OPENLEGALDATA_TOKEN'),
+    },
+}
+
+
+def upstream_config(name: str) -> dict:
+    """
+    Returns the connection settings of an upstream.
+
+    Parameters:
+    name (str): The name of the upstream (see UPSTREAMS).
+
+    Returns:
+    dict: base_url, api_key, pool_size, timeout and keepalive (seconds).
+    """
+    upstream = UPSTREAMS[name]
+    prefix = upstream['env_prefix']
+    return {
+        'base_url': upstream['base_url'](),
+        'api_key': upstream['api_key'](),
+        'pool_size': int(get_env(f'{prefix}_POOL_SIZE', 20)),
+        'timeout': float(get_env(f'{prefix}_TIMEOUT', 30)),
+        'keepalive': float(get_env(f'{prefix}_KEEPALIVE', 60)),
+    }
+
+
+def _count_request(name: str, pool, seen_connections: weakref.WeakSet):
+    """Counts a request and every connection of the pool that was not seen before."""
+    metrics.increment('upstream_requests_total', upstream=name)
+    for connection in pool.connections:
+        if connection not in seen_connections:
+            seen_connections.add(connection)
+            metrics.increment('upstream_connections_opened_total', upstream=name)
+
+
+class CountingTransport(httpx.HTTPTransport):
+    """
+    A pooled httpx transport that reports requests, new connections and errors to the metrics.
+    """
+
+    def __init__(self, upstream: str, **kwargs):
+        super().__init__(**kwargs)
+        self.upstream = upstream
+        self._seen_connections = weakref.WeakSet()
+
+    def handle_request(self, request):
+        try:
+            response = super().handle_request(request)
+        except Exception:
+            metrics.increment('upstream_errors_total', upstream=self.upstream)
+            raise
+        _count_request(self.upstream, self._pool, self._seen_connections)
+        if response.status_code >= 500:
+            metrics.increment('upstream_errors_total', upstream=self.upstream)
+        return response
+
+
+class AsyncCountingTransport(httpx.AsyncHTTPTransport):
+    """
+    Async version of CountingTransport.
+    """
+
+    def __init__(self, upstream: str, **kwargs):
+        super().__init__(**kwargs)
+        self.upstream = upstream
+        self._seen_connections = weakref.WeakSet()
+
+    async def handle_async_request(self, request):
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            metrics.increment('upstream_errors_total', upstream=self.upstream)
+            raise
+        _count_request(self.upstream, self._pool, self._seen_connections)
+        if response.status_code >= 500:
+            metrics.increment('upstream_errors_total', upstream=self.upstream)
+        return response
+
+
+# The SDK retries failed calls twice by default. Retries are left to the callers
+# (see extract_keywords_llm), which fit them into the budget of the search.
+MAX_RETRIES = 0
+
+
+def _httpx_options(config: dict) -> dict:
+    return {
+        'limits': httpx.Limits(
+            max_connections=config['pool_size'],
+            max_keepalive_connections=config['pool_size'],
+            keepalive_expiry=config['keepalive'],
+        ),
+        'timeout': httpx.Timeout(config['timeout']),
+    }
+
+
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_openai_client(name: str) -> openai.OpenAI:
+    """
+    Returns the shared OpenAI compatible client of an upstream ('openai' or 'llm').
+
+    The client is created once per process. Its connection pool keeps connections
+    alive between requests, so only the first request pays for the TLS handshake.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                config = upstream_config(name)
+                options = _httpx_options(config)
+                client = openai.OpenAI(
+                    base_url=config['base_url'],
+                    api_key=config['api_key'],
+                    timeout=config['timeout'],
+                    max_retries=MAX_RETRIES,
+                    http_client=httpx.Client(
+                        transport=CountingTransport(name, limits=options['limits']),
+                        **options
+                    ),
+                )
+                _clients[name] = client
+    return client
+
+
+def get_async_openai_client(name: str) -> openai.AsyncOpenAI:
+    """
+    Returns the shared async client of an upstream for the running event loop.
+
+    Async connection pools are bound to the event loop they were created in, so
+    there is one client per upstream and loop.
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    client = clients.get(name)
+    if client is None:
+        config = upstream_config(name)
+        options = _httpx_options(config)
+        client = openai.AsyncOpenAI(
+            base_url=config['base_url'],
+            api_key=config['api_key'],
+            timeout=config['timeout'],
+            max_retries=MAX_RETRIES,
+            http_client=httpx.AsyncClient(
+                transport=AsyncCountingTransport(name, limits=options['limits']),
+                **options
+            ),
+        )
+        clients[name] = client
+    return client
+
+
+def get_http_session(name: str) -> requests.Session:
+    """
+    Returns the shared requests session of an upstream (e.g. 'openlegaldata').
+
+    The session keeps up to <PREFIX>_POOL_SIZE connections alive. Requests should
+    pass upstream_config(name)['timeout'] as timeout.
+    """
+    session = _sessions.get(name)
+    if session is None:
+        with _lock:
+            session = _sessions.get(name)
+            if session is None:
+                config = upstream_config(name)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['pool_size'])
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.hooks['response'].append(_session_hook(name, adapter))
+                _sessions[name] = session
+    return session
+
+
+def _session_hook(name: str, adapter: HTTPAdapter):
+    """Creates a response hook that reports requests and new connections of a session."""
+    opened = {'connections': 0}
+
+    def hook(response, *args, **kwargs):
+        metrics.increment('upstream_requests_total', upstream=name)
+        if response.status_code >= 500:
+            metrics.increment('upstream_errors_total', upstream=name)
+
+        pools = adapter.poolmanager.pools
+        connections = sum(pools[key].num_connections for key in pools.keys())
+        if connections > opened['connections']:
+            metrics.increment('upstream_connections_opened_total', connections - opened['connections'], upstream=name)
+        opened['connections'] = max(opened['connections'], connections)
+
+    return hook
+
+
+def stats() -> dict:
+    """
+    Returns requests, opened connections and the connection reuse rate per upstream.
+    """
+    upstreams = {}
+    for name in UPSTREAMS:
+        requests_total = metrics.get('upstream_requests_total', upstream=name)
+        opened = metrics.get('upstream_connections_opened_total', upstream=name)
+        upstreams[name] = {
+            'requests': requests_total,
+            'connections_opened': opened,
+            'errors': metrics.get('upstream_errors_total', upstream=name),
+            'connection_reuse_rate': 1.0 - opened / requests_total if requests_total else 0.0,
+        }
+    return upstreams
@@ -0,0 +1,159 @@
+import random
+import threading
+import time
+from typing import Optional
+
+import openai
+
+from .metrics import metrics
+from .util import get_env
+
+
+# The latency budget of one search in seconds, 0 disables it
+SEARCH_DEADLINE = float(get_env('SEARCH_DEADLINE', 8.0))
+
+# The time an upstream call leaves for the local stages after it (combining, hydration)
+SEARCH_DEADLINE_RESERVE = float(get_env('SEARCH_DEADLINE_RESERVE', 0.5))
+
+# The pause before the second attempt of an upstream call, doubled for every further attempt
+UPSTREAM_RETRY_BACKOFF = float(get_env('UPSTREAM_RETRY_BACKOFF', 0.2))
+
+
+class DeadlineExceeded(Exception):
+    """The budget of a search is used up before a stage could start."""
+
+
+def is_timeout(error: Exception) -> bool:
+    """True if a stage failed because it ran out of time."""
+    return isinstance(error, (TimeoutError, DeadlineExceeded, openai.APITimeoutError))
+
+
+class Deadline:
+    """
+    The latency budget of one search request, handed to every stage of the search.
+
+    Upstream calls are given the remaining time as timeout. A stage that runs out
+    of budget (or fails) falls back to its cheap local alternative and records a
+    degradation, which is reported in the response and counted in the metrics.
+    """
+
+    def __init__(self, seconds: float = None):
+        self.seconds = SEARCH_DEADLINE if seconds is None else seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + self.seconds if self.seconds > 0 else None
+        self.degradations = []
+        self.provisional = []
+        self._lock = threading.Lock()
+        self._parent = None
+        self._name = None
+
+    def child(self, name: str = None) -> 'Deadline':
+        """
+        A deadline with the same budget but its own degradations, for one part of a
+        request (e.g. one query of a batch). Its degradations are reported in this
+        deadline as well, with the name of the part as "query".
+
+        Parameters:
+        name (str): The name of the part, e.g. the query.
+
+        Returns:
+        Deadline: The deadline of the part.
+        """
+        child = Deadline(self.seconds)
+        child.started_at, child.expires_at = self.started_at, self.expires_at
+        child._parent, child._name = self, name
+        return child
+
+    def remaining(self) -> Optional[float]:
+        """The seconds left, None without a deadline."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def upstream_timeout(self) -> Optional[float]:
+        """
+        The timeout of an upstream call: the remaining time minus the reserve of the local stages.
+
+        Raises:
+        DeadlineExceeded: If no time is left for the call.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        timeout = remaining - SEARCH_DEADLINE_RESERVE
+        if timeout <= 0:
+            raise DeadlineExceeded(f"No time left of the {self.seconds}s search deadline")
+        return timeout
+
+    def retry_backoff(self, attempt: int) -> Optional[float]:
+        """
+        The pause before retrying an upstream call after the given (0 based) failed attempt.
+
+        Returns:
+        float: The pause in seconds (with jitter), None if the retry would not fit the budget.
+        """
+        pause = UPSTREAM_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.0)
+        remaining = self.remaining()
+        if remaining is not None and remaining - pause <= SEARCH_DEADLINE_RESERVE:
+            return None
+        return pause
+
+    def degrade(self, stage: str, fallback: str, error: Exception = None):
+        """
+        Records that a stage was replaced by its fallback.
+
+        Parameters:
+        stage (str): The stage that failed (keywords, keyword_search, vector_search).
+        fallback (str): What was used instead (local_keywords, vector_only, keyword_only).
+        error (Exception): Why, a timeout counts as deadline, everything else as error.
+        """
+        reason = 'deadline' if error is not None and is_timeout(error) else 'error'
+        self._record({'stage': stage, 'fallback': fallback, 'reason': reason})
+        metrics.increment('search_degradations_total', stage=stage, fallback=fallback, reason=reason)
+
+    def mark_provisional(self, stage: str):
+        """
+        Records that a stage used a stand-in that is replaced in the background, e.g. the
+        local keywords of the async KEYWORD_EXTRACTION_MODE until the llm keywords are
+        cached. The results of the search are not cached, so the next search uses the
+        replacement.
+
+        Parameters:
+        stage (str): The stage that used the stand-in (keywords).
+        """
+        with self._lock:
+            self.provisional.append(stage)
+
+    def _record(self, degradation: dict):
+        with self._lock:
+            self.degradations.append(degradation)
+        if self._parent is not None:
+            self._parent._record({**degradation, 'query': self._name} if self._name is not None else degradation)
+
+    @property
+    def degraded(self) -> bool:
+        return bool(self.degradations)
+
+    @property
+    def cacheable(self) -> bool:
+        """True if the results are final: nothing degraded and no stage used a stand-in."""
+        return not self.degradations and not self.provisional
+
+    def meta(self) -> dict:
+        """The metadata of the response: budget, time taken and the degradations that fired."""
+        return {
+            'deadline_ms': round(self.seconds * 1000) if self.expires_at is not None else None,
+            'elapsed_ms': round((time.monotonic() - self.started_at) * 1000, 1),
+            'degraded': list(self.degradations),
+        }
+
+
+def client_with_deadline(client, deadline: Optional[Deadline]):
+    """
+    Returns the (async) OpenAI client with the remaining budget as timeout. The shared
+    clients do not retry (see clients.MAX_RETRIES), retries are left to the caller, so
+    they can be fitted into the budget as well.
+    """
+    if deadline is None or deadline.expires_at is None:
+        return client
+    return client.with_options(timeout=deadline.upstream_timeout())
@@ -0,0 +1,191 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from .deadline import Deadline, DeadlineExceeded
+from .metrics import metrics
+from .util import get_env
+
+
+# How long the dispatcher collects queries for one embeddings call in milliseconds. Off (0) by
+# default: batching pays off under concurrent load against a rate limited api, e.g. a few ms.
+EMBEDDING_BATCH_WINDOW_MS = float(get_env('EMBEDDING_BATCH_WINDOW_MS', 0))
+
+# The maximum number of queries of one embeddings call, a full batch is sent before its window is over
+EMBEDDING_BATCH_MAX_SIZE = int(get_env('EMBEDDING_BATCH_MAX_SIZE', 64))
+
+# The maximum number of embeddings calls in flight at once
+EMBEDDING_BATCH_CONCURRENCY = int(get_env('EMBEDDING_BATCH_CONCURRENCY', 4))
+
+# Buckets of the embedding_batch_size histogram
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class _Item:
+    """A queued query and the future of its embedding."""
+
+    def __init__(self, text: str, deadline: Optional[Deadline]):
+        self.text = text
+        self.deadline = deadline
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+
+def batch_deadline(deadlines: List[Optional[Deadline]]) -> Optional[Deadline]:
+    """
+    The deadline of a batch: the one of its most patient caller, None if any caller
+    has no deadline. Callers with less time stop waiting on their own.
+    """
+    if any(deadline is None or deadline.expires_at is None for deadline in deadlines):
+        return None
+    return max(deadlines, key=lambda deadline: deadline.expires_at)
+
+
+class EmbeddingBatcher:
+    """
+    Collects the queries of concurrent searches and embeds them with one call.
+
+    The dispatcher thread waits for the first query, then collects more until the
+    window is over or max_size queries are queued, and sends them (every text once)
+    as one embeddings call. Up to `concurrency` calls run at once, so a slow call does
+    not hold back the next batch; while all of them are busy the queries keep queueing
+    and go out with the next (larger) batch. The vectors are handed back through the
+    futures of the queries, a failed call fails every query of the batch.
+
+    The batches are recorded in embedding_batch_size and embedding_batches_total{result},
+    the time a query waited for its batch to be sent in embedding_batch_wait_seconds.
+    """
+
+    def __init__(self, embed_many: Callable[[List[str], Optional[Deadline]], np.ndarray],
+                 window: float, max_size: int, concurrency: int = 4, name: str = 'embedding-batcher'):
+        """
+        Parameters:
+        embed_many (Callable): Embeds a list of texts, e.g. search.request_embeddings.
+        window (float): How long a batch collects queries in seconds.
+        max_size (int): The maximum number of queries of a batch.
+        concurrency (int): The maximum number of calls in flight.
+        """
+        self.embed_many = embed_many
+        self.window = window
+        self.max_size = max_size
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=name)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def submit(self, text: str, deadline: Deadline = None) -> Future:
+        """
+        Queues a text for the next batch.
+
+        Returns:
+        Future: The future of the embedding (np.ndarray).
+        """
+        self._ensure_thread()
+        item = _Item(text, deadline)
+        self._queue.put(item)
+        return item.future
+
+    def embed(self, text: str, deadline: Deadline = None) -> np.ndarray:
+        """
+        Embeds a text with the next batch and waits for its embedding.
+
+        Parameters:
+        text (str): The text to embed.
+        deadline (Deadline): The budget of the search, limits the wait.
+
+        Returns:
+        np.ndarray: The embedding.
+
+        Raises:
+        TimeoutError: If the embedding did not arrive before the deadline.
+        """
+        future = self.submit(text, deadline)
+        timeout = deadline.remaining() if deadline is not None else None
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"The embedding batch did not return within {timeout}s") from None
+
+    def _next_batch(self) -> List[_Item]:
+        """Waits for the first item, then collects more until the batch is full or the window is over."""
+        batch = [self._queue.get()]
+        closes_at = time.monotonic() + self.window
+        while len(batch) < self.max_size:
+            remaining = closes_at - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self._slots.acquire()
+            self._executor.submit(self._dispatch, self._next_batch())
+
+    def _dispatch(self, batch: List[_Item]):
+        """Embeds the texts of a batch with one call and resolves the futures of its items."""
+        try:
+            self._embed_batch(batch)
+        finally:
+            self._slots.release()
+
+    def _embed_batch(self, batch: List[_Item]):
+        now = time.perf_counter()
+        items = []
+        for item in batch:
+            # Skip the queries whose caller gave up while they were queued
+            if not item.future.set_running_or_notify_cancel():
+                continue
+            if item.deadline is not None and item.deadline.remaining() == 0:
+                item.future.set_exception(DeadlineExceeded("No time left for the embedding"))
+                continue
+            metrics.observe('embedding_batch_wait_seconds', now - item.queued_at)
+            items.append(item)
+        if not items:
+            return
+
+        texts = list(dict.fromkeys(item.text for item in items))
+        metrics.observe('embedding_batch_size', len(texts), buckets=BATCH_SIZE_BUCKETS)
+
+        try:
+            embeddings = dict(zip(texts, self.embed_many(texts, batch_deadline([item.deadline for item in items]))))
+        except Exception as e:
+            metrics.increment('embedding_batches_total', result='error')
+            for item in items:
+                item.future.set_exception(e)
+            return
+
+        metrics.increment('embedding_batches_total', result='ok')
+        for item in items:
+            item.future.set_result(embeddings[item.text])
+
+
+def create_embedding_batcher(embed_many: Callable[[List[str], Optional[Deadline]], np.ndarray]) -> Optional[EmbeddingBatcher]:
+    """
+    Returns the embedding batcher configured by EMBEDDING_BATCH_WINDOW_MS, EMBEDDING_BATCH_MAX_SIZE
+    and EMBEDDING_BATCH_CONCURRENCY, or None if batching is disabled.
+    """
+    if EMBEDDING_BATCH_WINDOW_MS <= 0 or EMBEDDING_BATCH_MAX_SIZE <= 1:
+        return None
+    return EmbeddingBatcher(
+        embed_many,
+        window=EMBEDDING_BATCH_WINDOW_MS / 1000,
+        max_size=EMBEDDING_BATCH_MAX_SIZE,
+        concurrency=EMBEDDING_BATCH_CONCURRENCY,
+    )
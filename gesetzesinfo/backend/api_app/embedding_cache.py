@@ -0,0 +1,238 @@
+import hashlib
+from typing import Awaitable, Callable, Dict, List
+
+import numpy as np
+
+from .cache import LRUCache
+from .models import CachedEmbedding
+from .quantization import encode_embedding
+from .singleflight import SingleFlight, AsyncSingleFlight
+from .util import get_env, normalize_query
+
+
+class QueryEmbeddingCache:
+    """
+    Two tier cache for query embeddings.
+
+    The first tier is an in-process LRU cache. The second tier is the CachedEmbedding
+    table, which survives restarts and is shared by all workers. Queries are keyed by
+    their normalized text, so different spellings of the same query share one embedding.
+    Concurrent misses of the same query share one lookup and one upstream call.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.memory = LRUCache(max_entries)
+        self.persistent_hits = 0
+        self.persistent_misses = 0
+        self.flights = SingleFlight('embedding')
+        self.async_flights = AsyncSingleFlight('embedding')
+
+    @staticmethod
+    def key(query: str) -> str:
+        """
+        Returns the cache key of a query. It includes the embedding model and dimensions.
+        """
+        model = get_env('EMBEDDING_MODEL', '')
+        dims = get_env('EMBEDDING_MODEL_DIMS', '')
+        return hashlib.sha256(f"{model}:{dims}:{normalize_query(query)}".encode('utf-8')).hexdigest()
+
+    def get(self, query: str):
+        """
+        Returns the cached embedding of the query, or None if neither tier has it.
+        """
+        key = self.key(query)
+
+        embedding = self.memory.get(key)
+        if embedding is not None:
+            return embedding
+
+        return self._get_persistent(key)
+
+    def _get_persistent(self, key: str):
+        """Reads the persistent tier and copies a hit to the memory tier."""
+        cached = CachedEmbedding.objects.filter(key=key).only('embedding').first()
+        return self._persistent_result(key, cached)
+
+    def _persistent_result(self, key: str, cached):
+        if cached is None:
+            self.persistent_misses += 1
+            return None
+
+        self.persistent_hits += 1
+        embedding = cached.get_embedding()
+        self.memory.set(key, embedding)
+        return embedding
+
+    def set(self, query: str, embedding: np.ndarray):
+        """
+        Stores the embedding of the query in both tiers.
+        """
+        key = self.key(query)
+        embedding = np.asarray(embedding, dtype=np.float32)
+
+        self.memory.set(key, embedding)
+
+        # Another worker may have stored the same query in the meantime, that is fine
+        CachedEmbedding.objects.bulk_create([
+            CachedEmbedding(
+                key=key,
+                query_normalized=normalize_query(query),
+                embedding=encode_embedding(embedding),
+            )
+        ], ignore_conflicts=True)
+
+    def get_or_compute(self, query: str, compute: Callable[[str], np.ndarray], timeout: float = None) -> np.ndarray:
+        """
+        Returns the cached embedding of the query, computing and caching it on a miss.
+
+        Concurrent calls for the same normalized query wait for the first one, which
+        reads the persistent tier and computes the embedding for all of them.
+
+        Parameters:
+        query (str): The query to embed.
+        compute (Callable): Computes the embedding of the query on a cache miss.
+        timeout (float): How long to wait for the same query of another request.
+
+        Returns:
+        np.ndarray: The embedding of the query.
+        """
+        key = self.key(query)
+        embedding = self.memory.get(key)
+        if embedding is not None:
+            return embedding
+
+        def get_or_compute():
+            # The memory miss is counted already, the previous call for the same query may have filled it since
+            embedding = self.memory.peek(key)
+            if embedding is None:
+                embedding = self._get_persistent(key)
+            if embedding is None:
+                embedding = compute(query)
+                self.set(query, embedding)
+            return embedding
+
+        return self.flights.do(key, get_or_compute, timeout)
+
+    def get_many(self, queries: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Returns the cached embeddings of several queries, reading the persistent tier
+        with one query for everything the memory tier misses.
+
+        Returns:
+        dict: The embeddings of the cached queries, keyed by query.
+        """
+        embeddings = {}
+        missing = {}
+        for query in queries:
+            key = self.key(query)
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                embeddings[query] = embedding
+            else:
+                missing.setdefault(key, []).append(query)
+
+        if missing:
+            for cached in CachedEmbedding.objects.filter(key__in=list(missing)).only('key', 'embedding'):
+                embedding = cached.get_embedding()
+                self.memory.set(cached.key, embedding)
+                for query in missing.pop(cached.key):
+                    embeddings[query] = embedding
+                    self.persistent_hits += 1
+            self.persistent_misses += sum(len(queries) for queries in missing.values())
+
+        return embeddings
+
+    def set_many(self, embeddings: Dict[str, np.ndarray]):
+        """
+        Stores the embeddings of several queries in both tiers, with one insert.
+        """
+        rows = {}
+        for query, embedding in embeddings.items():
+            key = self.key(query)
+            embedding = np.asarray(embedding, dtype=np.float32)
+            self.memory.set(key, embedding)
+            rows[key] = CachedEmbedding(
+                key=key,
+                query_normalized=normalize_query(query),
+                embedding=encode_embedding(embedding),
+            )
+
+        CachedEmbedding.objects.bulk_create(list(rows.values()), ignore_conflicts=True)
+
+    async def aget(self, query: str):
+        """
+        Async version of get, using the async ORM for the persistent tier.
+        """
+        key = self.key(query)
+
+        embedding = self.memory.get(key)
+        if embedding is not None:
+            return embedding
+
+        return await self._aget_persistent(key)
+
+    async def _aget_persistent(self, key: str):
+        """Async version of _get_persistent."""
+        cached = await CachedEmbedding.objects.filter(key=key).only('embedding').afirst()
+        return self._persistent_result(key, cached)
+
+    async def aset(self, query: str, embedding: np.ndarray):
+        """
+        Async version of set, using the async ORM for the persistent tier.
+        """
+        key = self.key(query)
+        embedding = np.asarray(embedding, dtype=np.float32)
+
+        self.memory.set(key, embedding)
+
+        await CachedEmbedding.objects.abulk_create([
+            CachedEmbedding(
+                key=key,
+                query_normalized=normalize_query(query),
+                embedding=encode_embedding(embedding),
+            )
+        ], ignore_conflicts=True)
+
+    async def aget_or_compute(self, query: str, compute: Callable[[str], Awaitable[np.ndarray]], timeout: float = None) -> np.ndarray:
+        """
+        Async version of get_or_compute, compute is a coroutine function.
+        """
+        key = self.key(query)
+        embedding = self.memory.get(key)
+        if embedding is not None:
+            return embedding
+
+        async def aget_or_compute():
+            embedding = self.memory.peek(key)
+            if embedding is None:
+                embedding = await self._aget_persistent(key)
+            if embedding is None:
+                embedding = await compute(query)
+                await self.aset(query, embedding)
+            return embedding
+
+        return await self.async_flights.do(key, aget_or_compute, timeout)
+
+    def stats(self) -> dict:
+        """
+        Returns hit rates and memory use of both tiers.
+        """
+        memory = self.memory.stats()
+        persistent_requests = self.persistent_hits + self.persistent_misses
+        total_hits = memory['hits'] + self.persistent_hits
+        total_requests = memory['hits'] + memory['misses']
+
+        return {
+            'memory': memory,
+            'persistent': {
+                'entries': CachedEmbedding.objects.count(),
+                'hits': self.persistent_hits,
+                'misses': self.persistent_misses,
+                'hit_rate': self.persistent_hits / persistent_requests if persistent_requests else 0.0,
+            },
+            'hit_rate': total_hits / total_requests if total_requests else 0.0,
+        }
+
+
+# The query embedding cache of this worker
+embedding_cache = QueryEmbeddingCache(int(get_env('EMBEDDING_CACHE_SIZE', 4096)))
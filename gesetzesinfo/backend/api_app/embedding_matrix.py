@@ -0,0 +1,138 @@
+import threading
+import logging
+from typing import List
+
+import numpy as np
+
+from .models import EmbeddedLaw
+from .embedding_store import (
+    open_embedding_store, open_squared_norms, squared_norms, store_files_stamp,
+    write_embedding_store, write_squared_norms,
+)
+from .quantization import dequantize, decode_embedding
+
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingMatrix:
+    """
+    The embeddings of all laws as one contiguous matrix.
+
+    The matrix is usually a read only memory map of the embedding store, so all
+    workers share the page cache instead of holding their own copy. Rows are looked
+    up by law_id, so distances for any set of laws are computed with a single
+    gathered matrix-vector product and without database access.
+
+    Quantized stores (float16, int8 with per dimension scales) stay quantized in
+    memory, only the gathered rows are converted to float32.
+    """
+
+    def __init__(self, law_ids: np.ndarray, vectors: np.ndarray, scales: np.ndarray = None, norms: np.ndarray = None):
+        self.law_ids = np.asarray(law_ids, dtype=np.int64)
+        self.vectors = vectors if isinstance(vectors, np.memmap) else np.ascontiguousarray(vectors)
+        self.scales = scales
+        self.row_of = {int(law_id): row for row, law_id in enumerate(self.law_ids)}
+
+        # Squared norms of all rows, used to expand the L2 distance. Usually mapped
+        # from the store, where update_embedding keeps them in sync with the rows.
+        self.squared_norms = norms if norms is not None else squared_norms(self.vectors, scales)
+
+    def _chunks(self, size: int = 16384):
+        """Yields the matrix as float32 in chunks of rows, without converting it as a whole."""
+        for start in range(0, len(self.law_ids), size):
+            yield self.rows(np.arange(start, min(start + size, len(self.law_ids))))
+
+    def rows(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the given rows as float32.
+        """
+        return dequantize(self.vectors[rows], self.scales)
+
+    def dense(self) -> np.ndarray:
+        """
+        Returns the whole matrix as float32 (e.g. to build an index from it).
+        """
+        return np.concatenate(list(self._chunks())) if len(self.law_ids) else np.zeros((0, self.vectors.shape[1]), dtype=np.float32)
+
+    def lookup(self, law_ids: List[int]):
+        """
+        Returns the law_ids that have an embedding and their rows in the matrix.
+        """
+        found, rows = [], []
+        for law_id in law_ids:
+            row = self.row_of.get(int(law_id))
+            if row is not None:
+                found.append(law_id)
+                rows.append(row)
+        return found, np.array(rows, dtype=np.int64)
+
+    def squared_distances(self, rows: np.ndarray, query_embedding: np.ndarray) -> np.ndarray:
+        """
+        Returns the squared L2 distances (like faiss.IndexFlatL2) between the query and the given rows.
+
+        Uses |x - q|^2 = |x|^2 - 2 x.q + |q|^2, so the only work per row is one dot product.
+        """
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        distances = self.squared_norms[rows] - 2.0 * (self.rows(rows) @ query_embedding) + query_embedding @ query_embedding
+        return np.maximum(distances, 0.0)
+
+
+def build_embedding_store():
+    """
+    Writes the embedding store from the embeddings in the EmbeddedLaw table.
+    """
+    rows = list(EmbeddedLaw.objects.values_list('law_id', 'embedding_base', 'embedding_optimized').iterator())
+    law_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    write_embedding_store(law_ids, {
+        'base': np.array([decode_embedding(row[1]) for row in rows], dtype=np.float32),
+        'optimized': np.array([decode_embedding(row[2]) for row in rows], dtype=np.float32),
+    })
+
+
+_matrices = {}
+_matrix_lock = threading.Lock()
+
+
+def get_embedding_matrix(kind: str = 'base') -> EmbeddingMatrix:
+    """
+    Returns the embedding matrix of a kind ('base' or 'optimized') for this worker.
+
+    The matrix is mapped from the embedding store on first use and remapped when the
+    store files are replaced. Rows updated in place (ratings) are seen through the
+    shared mapping without a remap. If there is no store yet, it is written from the
+    database first.
+    """
+    stamp = store_files_stamp(kind)
+    loaded = _matrices.get(kind)
+    if loaded is not None and loaded[0] == stamp:
+        return loaded[1]
+
+    with _matrix_lock:
+        loaded = _matrices.get(kind)
+        if loaded is not None and loaded[0] == stamp:
+            return loaded[1]
+
+        if stamp is None:
+            build_embedding_store()
+            stamp = store_files_stamp(kind)
+
+        store = open_embedding_store(kind)
+        if store is None:
+            # The store is being replaced right now, keep using the current version
+            if loaded is not None:
+                return loaded[1]
+            raise FileNotFoundError(f"Embedding store for {kind} embeddings is not available")
+
+        law_ids, vectors, scales = store
+        norms = open_squared_norms(kind, len(law_ids))
+        if norms is None:
+            # Stores written before the norms were kept, computed once for all workers
+            write_squared_norms(kind, squared_norms(vectors, scales))
+            norms = open_squared_norms(kind, len(law_ids))
+            stamp = store_files_stamp(kind)
+
+        matrix = EmbeddingMatrix(law_ids, vectors, scales, norms)
+        _matrices[kind] = (stamp, matrix)
+        logger.info("Mapped %s embedding matrix with %d laws", kind, len(matrix.law_ids))
+        return matrix
@@ -0,0 +1,181 @@
+import os
+
+import numpy as np
+
+from .util import data_path
+from .quantization import dequantize, quantize_matrix, quantize_rows
+
+
+# The store keeps the law_ids and one matrix per embedding kind in .npy files.
+# Row i of every matrix belongs to law_ids[i]. The matrices are float32, float16 or
+# int8 (EMBEDDING_STORAGE_FORMAT), int8 matrices have a file with per dimension scales.
+# The squared norms of the rows are kept next to each matrix, so they are not
+# recomputed over the whole corpus whenever a worker maps the store.
+EMBEDDING_KINDS = ('base', 'optimized')
+STORE_IDS_PATH = data_path('law_embeddings_ids.npy')
+
+
+def store_path(kind: str) -> str:
+    """
+    Returns the path of the embedding matrix of a kind ('base' or 'optimized').
+    """
+    return data_path(f'law_embeddings_{kind}.npy')
+
+
+def scales_path(kind: str) -> str:
+    """
+    Returns the path of the per dimension scales of an int8 embedding matrix.
+    """
+    return data_path(f'law_embeddings_{kind}_scales.npy')
+
+
+def norms_path(kind: str) -> str:
+    """
+    Returns the path of the squared row norms of an embedding matrix.
+    """
+    return data_path(f'law_embeddings_{kind}_norms.npy')
+
+
+def squared_norms(vectors: np.ndarray, scales: np.ndarray = None, chunk_size: int = 16384) -> np.ndarray:
+    """
+    Returns the squared norms of the rows of a stored matrix, converting it to float32
+    in chunks of rows instead of as a whole.
+    """
+    norms = np.zeros(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = dequantize(vectors[start:start + chunk_size], scales)
+        norms[start:start + chunk_size] = np.einsum('ij,ij->i', chunk, chunk)
+    return norms
+
+
+def _save_atomic(path: str, array: np.ndarray):
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def write_embedding_store(law_ids, embeddings: dict):
+    """
+    Writes the embedding store in the configured storage format.
+
+    The matrices are written before the ids, each file is moved into place atomically.
+    Readers only pick up a new version once the ids and all matrices have the same length.
+
+    Parameters:
+    law_ids (array): The law_ids, one per row.
+    embeddings (dict): One float32 matrix per embedding kind, e.g. {'base': ..., 'optimized': ...}.
+    """
+    law_ids = np.asarray(law_ids, dtype=np.int64)
+    for kind, vectors in embeddings.items():
+        vectors, scales = quantize_matrix(np.asarray(vectors, dtype=np.float32).reshape(len(law_ids), -1))
+        if scales is not None:
+            _save_atomic(scales_path(kind), scales)
+        _save_atomic(store_path(kind), vectors)
+        if scales is None and os.path.exists(scales_path(kind)):
+            os.remove(scales_path(kind))
+        write_squared_norms(kind, squared_norms(vectors, scales))
+    _save_atomic(STORE_IDS_PATH, law_ids)
+
+    print(f"Wrote embedding store with {len(law_ids)} laws ({', '.join(embeddings)})")
+
+
+def update_embedding(kind: str, row: int, embedding: np.ndarray):
+    """
+    Overwrites one row of an embedding matrix in place.
+
+    All workers map the matrix and its squared norms shared and see the new row
+    right away. The changed store_stamp tells them to drop cached search results.
+
+    Parameters:
+    kind (str): The embedding kind.
+    row (int): The row of the law.
+    embedding (np.ndarray): The new embedding.
+    """
+    vectors = np.load(store_path(kind), mmap_mode='r+')
+    scales = np.load(scales_path(kind)) if vectors.dtype == np.int8 else None
+    if scales is not None:
+        vectors[row] = quantize_rows(embedding, scales)
+    else:
+        vectors[row] = np.asarray(embedding, dtype=vectors.dtype)
+    vectors.flush()
+
+    # The norm of the stored (possibly quantized) row
+    norms = open_squared_norms(kind, len(vectors), mode='r+')
+    if norms is not None:
+        norms[row] = squared_norms(vectors[row:row + 1], scales)[0]
+        norms.flush()
+        del norms
+    del vectors
+
+
+def write_squared_norms(kind: str, norms: np.ndarray):
+    """
+    Writes the squared row norms of an embedding matrix.
+    """
+    _save_atomic(norms_path(kind), np.asarray(norms, dtype=np.float32))
+
+
+def open_squared_norms(kind: str, rows: int, mode: str = 'r'):
+    """
+    Maps the squared row norms of an embedding matrix into memory.
+
+    Returns:
+    np.memmap: The norms, or None if they are missing or do not match the matrix.
+    """
+    try:
+        norms = np.load(norms_path(kind), mmap_mode=mode)
+    except FileNotFoundError:
+        return None
+    return norms if norms.shape == (rows,) else None
+
+
+def store_stamp(kind: str):
+    """
+    Returns a stamp that changes whenever the ids or the matrix of a kind are replaced,
+    or None if the store does not exist.
+    """
+    try:
+        ids_stat = os.stat(STORE_IDS_PATH)
+        vectors_stat = os.stat(store_path(kind))
+    except FileNotFoundError:
+        return None
+    return f"{ids_stat.st_mtime_ns}-{vectors_stat.st_mtime_ns}-{vectors_stat.st_size}"
+
+
+def store_files_stamp(kind: str):
+    """
+    Returns a stamp that changes whenever the files of a kind are replaced, but not
+    when rows are updated in place (see update_embedding), or None if the store does
+    not exist.
+    """
+    try:
+        ids_stat = os.stat(STORE_IDS_PATH)
+        vectors_stat = os.stat(store_path(kind))
+    except FileNotFoundError:
+        return None
+    try:
+        norms_inode = os.stat(norms_path(kind)).st_ino
+    except FileNotFoundError:
+        norms_inode = None
+    return f"{ids_stat.st_mtime_ns}-{ids_stat.st_ino}-{vectors_stat.st_ino}-{vectors_stat.st_size}-{norms_inode}"
+
+
+def open_embedding_store(kind: str):
+    """
+    Maps the embedding store of a kind into memory, without copying it.
+
+    Returns:
+    tuple: The law_ids, the read only memory mapped matrix and the per dimension scales
+           (None unless the matrix is int8), or None if the store is missing or being
+           replaced (ids and matrix differ in length).
+    """
+    try:
+        law_ids = np.load(STORE_IDS_PATH)
+        vectors = np.load(store_path(kind), mmap_mode='r')
+        scales = np.load(scales_path(kind)) if vectors.dtype == np.int8 else None
+    except FileNotFoundError:
+        return None
+
+    if len(law_ids) != vectors.shape[0]:
+        return None
+    return law_ids, vectors, scales
@@ -1,11 +1,26 @@
 from django.http import HttpResponse
 from django.http import JsonResponse
 from django.http import HttpRequest
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 
 from . import openlegaldata
 from .models import  OldTitleKeyword, Law, EmbeddedLaw
-from .search import search_endpoint
-from .rating import rating_endpoint
+from .search import search_endpoint, keyword_cache
+from .rating import rating_endpoint, async_rating_endpoint
+from .async_search import async_search_endpoint
+from .batch_search import batch_search_endpoint
+from .stream_search import stream_search_endpoint
+from .embedding_cache import embedding_cache
+from . import clients
+from .metrics import metrics, prometheus_family
+from .analytics import search_log_queue
+from .result_cache import result_cache_stats
+from .util import get_env
+
+
+# How long clients and proxies may reuse a law without asking again (seconds)
+LAW_DETAIL_MAX_AGE = int(get_env('LAW_DETAIL_MAX_AGE', 60 * 60))
 
 def unprocessed_law_count(request):
     try:
@@ -29,12 +44,109 @@ def old_keywords_count(request):
     except Exception as e:
         return JsonResponse({'count': None, 'error': str(e)})
 
+def stats(request):
+    try:
+        return JsonResponse({
+            'embedding_cache': embedding_cache.stats(),
+            'keyword_cache': keyword_cache.stats(),
+            'upstreams': clients.stats(),
+            'metrics': metrics.snapshot(),
+            'search_log': search_log_queue.stats(),
+            'result_cache': result_cache_stats(),
+            'error': None
+        })
+    except Exception as e:
+        return JsonResponse({'embedding_cache': None, 'keyword_cache': None, 'upstreams': None, 'metrics': None, 'search_log': None, 'result_cache': None, 'error': str(e)})
+
+def cache_hit_counts() -> dict:
+    """
+    The hits and misses of every cache of this worker, without querying the database.
+    """
+    memory = embedding_cache.memory.stats()
+    counts = {
+        'embedding_memory': (memory['hits'], memory['misses']),
+        'embedding_persistent': (embedding_cache.persistent_hits, embedding_cache.persistent_misses),
+    }
+    keywords = keyword_cache.stats()
+    counts['keyword'] = (keywords['hits'], keywords['misses'])
+
+    results = result_cache_stats()
+    if results is not None:
+        counts['result'] = (results['hits'], results['misses'])
+    return counts
+
+def prometheus_metrics(request):
+    """
+    The metrics of this worker in the Prometheus text format: the durations of the
+    search stages and requests (with p50/p95/p99), the upstream requests and errors,
+    the degradations, the search log and the hit rates of the caches.
+    """
+    counts = cache_hit_counts()
+    text = metrics.prometheus()
+    text += prometheus_family('cache_hits_total', 'counter', [({'cache': name}, hits) for name, (hits, _) in counts.items()])
+    text += prometheus_family('cache_misses_total', 'counter', [({'cache': name}, misses) for name, (_, misses) in counts.items()])
+    text += prometheus_family('cache_hit_ratio', 'gauge', [
+        ({'cache': name}, hits / (hits + misses) if hits + misses else 0.0) for name, (hits, misses) in counts.items()
+    ])
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def law_detail(request, id):
+    """
+    Returns the full text and metadata of a law.
+
+    The response carries an ETag and Last-Modified derived from last_updated, so
+    clients revalidate with If-None-Match / If-Modified-Since and get a 304 while the
+    law did not change.
+    """
+    try:
+        law = EmbeddedLaw.objects.metadata().get(id=id)
+    except EmbeddedLaw.DoesNotExist:
+        return JsonResponse({'error': f'EmbeddedLaw with id {id} does not exist'}, status=404)
+
+    last_modified = int(law.last_updated.timestamp())
+    etag = quote_etag(f"{law.id}-{law.last_updated.timestamp():.6f}")
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = JsonResponse({
+            'id': law.id,
+            'law_id': law.law_id,
+            'book_code': law.book_code,
+            'title': law.title,
+            'text': law.text,
+            'source_url': law.source_url,
+            'last_updated': law.last_updated.isoformat(),
+        })
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, public=True, max_age=LAW_DETAIL_MAX_AGE)
+    return response
+
+
 def search(request):
     return search_endpoint(request)
 
 
+def search_stream(request):
+    return stream_search_endpoint(request)
+
+
+def search_batch(request):
+    return batch_search_endpoint(request)
+
+
 def rate(request):
     try:
         return rating_endpoint(request)
     except Exception as e:
         return JsonResponse({'error': str(e)})
+
+async def search_async(request):
+    return await async_search_endpoint(request)
+
+async def rate_async(request):
+    try:
+        return await async_rating_endpoint(request)
+    except Exception as e:
+        return JsonResponse({'error': str(e)})
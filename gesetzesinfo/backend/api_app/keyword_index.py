@@ -0,0 +1,202 @@
+import logging
+import re
+from typing import List, Optional
+
+from django.db import connection, OperationalError
+
+from .models import EmbeddedLaw
+from .util import fold_text
+
+
+logger = logging.getLogger(__name__)
+
+
+LAW_TABLE = EmbeddedLaw._meta.db_table
+FTS_TABLE = f"{LAW_TABLE}_fts"
+
+# Weights of the title and text columns for the bm25 ranking of the candidates
+TITLE_WEIGHT = 5.0
+TEXT_WEIGHT = 1.0
+
+# The titles and texts are indexed folded with util.fold_text (ä -> ae, ß -> ss), like
+# the term statistics that score the candidates, so both see the same terms. unicode61
+# only has to fold the diacritics of other languages. Prefix indexes keep German
+# inflections and compounds cheap.
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+FTS_PREFIXES = "3 5"
+
+# The SQL function the triggers fold the indexed texts with
+FOLD_FUNCTION = 'fold_text'
+
+# Is the index known to exist in this process? None means "not checked yet".
+_index_ready = None
+
+
+def _fold(value):
+    return fold_text(value) if value is not None else None
+
+
+def register_sql_functions(sender=None, connection=None, **kwargs):
+    """
+    Registers the SQL functions used by the triggers of the index on a new SQLite connection.
+    Connected to the connection_created signal (see ApiAppConfig.ready).
+    """
+    if connection is not None and connection.vendor == 'sqlite':
+        connection.connection.create_function(FOLD_FUNCTION, 1, _fold, deterministic=True)
+
+
+def _table_exists(cursor, name: str) -> bool:
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [name])
+    return cursor.fetchone() is not None
+
+
+def _index_is_current(cursor) -> bool:
+    """True if the triggers fold the indexed texts (indexes of older versions index the raw texts)."""
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = %s", [f"{FTS_TABLE}_ai"])
+    row = cursor.fetchone()
+    return row is not None and f"{FOLD_FUNCTION}(" in row[0]
+
+
+def drop_keyword_index(cursor):
+    """Drops the index and its triggers (the triggers write to the index table)."""
+    for trigger in ('ai', 'ad', 'au'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{trigger}")
+    cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+def ensure_keyword_index(rebuild: bool = False) -> bool:
+    """
+    Creates the FTS5 full text index over EmbeddedLaw (title, text) if it does not exist.
+
+    The index is an external content table, so it does not duplicate the texts. Triggers on
+    the EmbeddedLaw table keep it in sync with every insert, delete and update of the title
+    or text, including bulk operations that bypass the ORM. They index the folded texts, so
+    an index of an older version (raw texts) is replaced.
+
+    Parameters:
+    rebuild (bool): Rebuild the index from the EmbeddedLaw table even if it already exists.
+
+    Returns:
+    bool: True if the index is available, False if the database does not support it.
+    """
+    global _index_ready
+
+    if connection.vendor != 'sqlite':
+        _index_ready = False
+        return False
+
+    try:
+        connection.ensure_connection()
+        register_sql_functions(connection=connection)
+
+        with connection.cursor() as cursor:
+            if _table_exists(cursor, FTS_TABLE) and not _index_is_current(cursor):
+                drop_keyword_index(cursor)
+            created = not _table_exists(cursor, FTS_TABLE)
+
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+                    title, text,
+                    content='{LAW_TABLE}', content_rowid='id',
+                    tokenize='{FTS_TOKENIZER}', prefix='{FTS_PREFIXES}'
+                )
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {LAW_TABLE} BEGIN
+                    INSERT INTO {FTS_TABLE}(rowid, title, text) VALUES (new.id, {FOLD_FUNCTION}(new.title), {FOLD_FUNCTION}(new.text));
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {LAW_TABLE} BEGIN
+                    INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, text) VALUES ('delete', old.id, {FOLD_FUNCTION}(old.title), {FOLD_FUNCTION}(old.text));
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF title, text ON {LAW_TABLE} BEGIN
+                    INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, text) VALUES ('delete', old.id, {FOLD_FUNCTION}(old.title), {FOLD_FUNCTION}(old.text));
+                    INSERT INTO {FTS_TABLE}(rowid, title, text) VALUES (new.id, {FOLD_FUNCTION}(new.title), {FOLD_FUNCTION}(new.text));
+                END
+            """)
+
+            if created or rebuild:
+                # Not the 'rebuild' command: it would index the raw texts of the content table
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')")
+                cursor.execute(f"""
+                    INSERT INTO {FTS_TABLE}(rowid, title, text)
+                    SELECT id, {FOLD_FUNCTION}(title), {FOLD_FUNCTION}(text) FROM {LAW_TABLE}
+                """)
+                logger.info("Built keyword index %s", FTS_TABLE)
+
+    except OperationalError as e:
+        logger.warning("Keyword index not available: %s", e)
+        _index_ready = False
+        return False
+
+    _index_ready = True
+    return True
+
+
+def _fts_term(tokens: List[str]) -> str:
+    """Builds a FTS5 term for the tokens of one keyword. Single words also match as prefix."""
+    phrase = '"' + ' '.join(token.replace('"', '""') for token in tokens) + '"'
+    if len(tokens) == 1 and len(tokens[0]) >= 3:
+        phrase += '*'
+    return phrase
+
+
+def build_fts_query(keywords: List[str]) -> str:
+    """
+    Converts a list of keywords to a FTS5 MATCH expression that matches any of the keywords.
+
+    Keywords with several words are matched as phrase, single words also match as prefix
+    (so "entwend" finds "entwendet" and "Diebstahl" finds "Diebstahls"). The keywords are
+    folded like the indexed texts, so "Schäden" and "Schaeden" or "Straße" and "Strasse"
+    are the same words.
+
+    Parameters:
+    keywords (list): The keywords.
+
+    Returns:
+    str: The MATCH expression, empty if the keywords contain no searchable words.
+    """
+    terms = []
+    for keyword in keywords:
+        tokens = re.findall(r'\w+', fold_text(keyword))
+        if tokens:
+            terms.append(_fts_term(tokens))
+
+    # Remove duplicates while keeping the order
+    return ' OR '.join(dict.fromkeys(terms))
+
+
+def search_keyword_index(keywords: List[str], max_results: int = 256) -> Optional[List[int]]:
+    """
+    Finds the laws that match any of the keywords with one indexed query.
+
+    Parameters:
+    keywords (list): The keywords to search for.
+    max_results (int): The maximum number of candidates to return.
+
+    Returns:
+    list: The law_ids of the matching laws, best bm25 match first.
+          None if the keyword index is not available.
+    """
+    if _index_ready is None:
+        ensure_keyword_index()
+    if not _index_ready:
+        return None
+
+    match = build_fts_query(keywords)
+    if not match:
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT law.law_id
+            FROM {FTS_TABLE}
+            JOIN {LAW_TABLE} AS law ON law.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH %s
+            ORDER BY bm25({FTS_TABLE}, {TITLE_WEIGHT}, {TEXT_WEIGHT})
+            LIMIT %s
+        """, [match, max_results])
+        return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,315 @@
+import json
+import os
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from .models import EmbeddedLaw
+from .util import data_path, fold_text
+
+
+KEYWORD_MODEL_PATH = data_path('law_keyword_model.json')
+
+# Bump when the format of the model changes
+KEYWORD_MODEL_VERSION = 1
+
+WORD_PATTERN = re.compile(r'\w+')
+
+# Function words of German questions and legal texts (folded, see util.fold_text). They
+# carry no meaning for the keyword search and match nearly every law.
+GERMAN_STOPWORDS = frozenset('''
+    a ab aber alle allem allen aller alles als also am an andere anderen anderer anderes auch auf aus
+    bei beim bereits bin bis bzw da dabei dadurch dafuer dagegen daher damit dann darf darueber
+    darin das dass davon dazu dem den denen der deren des dessen dich die dies diese diesem diesen dieser
+    dieses dir doch dort du durch duerfen ein eine einem einen einer eines er es etwa etwas euch euer
+    fuer gegen gibt hab habe haben hat hatte hier ich ihm ihn ihnen ihr ihre ihrem ihren ihrer im in
+    indem ins ist ja jede jedem jeden jeder jedes jedoch kann kein keine keinem keinen keiner koennen
+    koennte man mehr mein meine meinem meinen meiner mich mir mit muss muessen nach nicht nichts noch nun
+    nur ob oder ohne sein seine seinem seinen seiner seit sich sie sind so sofern solche soll sollen
+    sollte sondern soweit sowie ueber um und uns unser unter vom von vor wann war waere warum was weil
+    welche welchem welchen welcher welches wenn wer werde werden wie wieder wir wird wo woher wurde
+    wurden zu zum zur zwischen
+    abs absatz art artikel bestimmung bestimmungen buchstabe gemaess hinsichtlich insbesondere nr nummer
+    satz vorschrift vorschriften ziffer
+    bitte eigentlich erklaeren erklaerung frage genau gilt gelten heisst regelung regelt steht
+'''.split())
+
+# Inflection endings, stripped at most twice, and derivation endings, stripped once afterwards
+INFLECTION_SUFFIXES = ('ern', 'em', 'en', 'er', 'es', 'et', 'e', 'n', 's')
+SECOND_INFLECTION_SUFFIXES = ('en', 'er', 'es', 'e', 's')
+DERIVATION_SUFFIXES = ('ung', 'heit', 'keit', 'lich', 'isch')
+MIN_STEM_LENGTH = 4
+
+# Co-occurrence of the terms of the laws
+MAX_TERMS_PER_LAW = 16          # the most distinctive terms of a law (tf-idf) take part
+MIN_DOCUMENT_FREQUENCY = 2      # terms of a single law are typos or names
+MAX_DOCUMENT_SHARE = 0.2        # terms of more laws are stopwords of the corpus
+MIN_COOCCURRENCE = 3
+MIN_ASSOCIATION = 0.1           # Dice coefficient of two terms
+RELATED_TERMS = 4
+
+# Spellings of a term kept for the expansion, e.g. "entwendet", "Entwendung"
+MAX_VARIANTS = 4
+
+
+def strip_suffix(token: str, suffixes: Tuple[str, ...]) -> str:
+    for suffix in suffixes:
+        if token.endswith(suffix) and len(token) - len(suffix) >= MIN_STEM_LENGTH:
+            return token[:-len(suffix)]
+    return token
+
+
+def stem(token: str) -> str:
+    """
+    Reduces a folded token to its stem with a light German stemmer, so the inflections
+    of a word share one term ("entwenden", "entwendet", "Entwendung" -> "entwend").
+    Tokens with digits (paragraphs, "107c") are kept as they are.
+
+    Parameters:
+    token (str): The folded token.
+
+    Returns:
+    str: The stem.
+    """
+    if not token.isalpha():
+        return token
+    token = strip_suffix(token, INFLECTION_SUFFIXES)
+    token = strip_suffix(token, SECOND_INFLECTION_SUFFIXES)
+    return strip_suffix(token, DERIVATION_SUFFIXES)
+
+
+def is_stopword(token: str) -> bool:
+    """True for folded tokens that are never keywords: stopwords and single characters."""
+    return token in GERMAN_STOPWORDS or (len(token) < 2 and not token.isdigit())
+
+
+class KeywordModel:
+    """
+    Extracts and expands the keywords of a query without the llm, from statistics of the corpus.
+
+    Every term (stem) of the laws knows its most common spellings and the terms that
+    co-occur with it in the same laws, e.g. "Diebstahl" with "Wegnahme" and "entwendet".
+    Terms that occur in too many laws are treated as stopwords of the corpus.
+    """
+
+    def __init__(self, terms: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]], common: Iterable[str], law_count: int):
+        """
+        Parameters:
+        terms (dict): The spellings and related terms of every term.
+        common (Iterable[str]): The terms that occur in too many laws.
+        law_count (int): The number of laws the model was built from.
+        """
+        self.terms = terms
+        self.common = frozenset(common)
+        self.law_count = law_count
+
+    @classmethod
+    def build(cls, laws: Iterable[Tuple[str, str]]) -> 'KeywordModel':
+        """
+        Builds the model from (title, text) tuples.
+        """
+        vocabulary = {}
+        spellings = []
+        law_terms = []
+
+        for title, text in laws:
+            counts = Counter()
+            for word in WORD_PATTERN.findall(f"{title} {text}"):
+                token = fold_text(word)
+                if is_stopword(token) or token.isdigit():
+                    continue
+                column = vocabulary.setdefault(stem(token), len(vocabulary))
+                if column == len(spellings):
+                    spellings.append(Counter())
+                spellings[column][word] += 1
+                counts[column] += 1
+            law_terms.append(counts)
+
+        law_count = len(law_terms)
+        if not law_count:
+            return cls({}, (), 0)
+
+        document_frequency = np.zeros(len(vocabulary), dtype=np.int64)
+        for counts in law_terms:
+            document_frequency[list(counts)] += 1
+        idf = np.log(law_count / np.maximum(document_frequency, 1))
+        common = document_frequency > max(MAX_DOCUMENT_SHARE * law_count, MIN_DOCUMENT_FREQUENCY)
+        rare = document_frequency < MIN_DOCUMENT_FREQUENCY
+
+        # The most distinctive terms of every law, as binary law x term matrix
+        indptr, indices = [0], []
+        for counts in law_terms:
+            candidates = [(count * idf[column], column) for column, count in counts.items()
+                          if not common[column] and not rare[column]]
+            indices.extend(column for _, column in sorted(candidates, reverse=True)[:MAX_TERMS_PER_LAW])
+            indptr.append(len(indices))
+        del law_terms
+
+        occurrences = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+            shape=(law_count, len(vocabulary))
+        )
+        term_frequency = np.asarray(occurrences.sum(axis=0)).ravel()
+        cooccurrence = (occurrences.T @ occurrences).tocsr()
+
+        stems = [None] * len(vocabulary)
+        for term, column in vocabulary.items():
+            stems[column] = term
+
+        terms = {}
+        for column, term in enumerate(stems):
+            if rare[column] or common[column]:
+                continue
+
+            related = ()
+            start, end = cooccurrence.indptr[column], cooccurrence.indptr[column + 1]
+            others, together = cooccurrence.indices[start:end], cooccurrence.data[start:end]
+            dice = 2 * together / (term_frequency[column] + term_frequency[others])
+            keep = (others != column) & (together >= MIN_COOCCURRENCE) & (dice >= MIN_ASSOCIATION)
+            if keep.any():
+                best = np.argsort(-dice[keep], kind='stable')[:RELATED_TERMS]
+                related = tuple(stems[other] for other in others[keep][best])
+
+            # The most common spelling first, spellings that differ only in case once
+            variants = {}
+            for word, _ in spellings[column].most_common():
+                variants.setdefault(word.lower(), word)
+            variants = tuple(variants.values())[:MAX_VARIANTS]
+
+            if related or len(variants) > 1:
+                terms[term] = (variants, related)
+
+        common_terms = [stems[column] for column in np.flatnonzero(common)]
+        return cls(terms, common_terms, law_count)
+
+    def save(self, path: str):
+        """Saves the model atomically, so other workers never read a half written file."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({
+                'version': KEYWORD_MODEL_VERSION,
+                'law_count': self.law_count,
+                'common': sorted(self.common),
+                'terms': {term: [list(variants), list(related)] for term, (variants, related) in self.terms.items()},
+            }, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['KeywordModel']:
+        """Loads a saved model, None if it was saved in an older format."""
+        with open(path, encoding='utf-8') as file:
+            data = json.load(file)
+        if data.get('version') != KEYWORD_MODEL_VERSION:
+            return None
+        terms = {term: (tuple(variants), tuple(related)) for term, (variants, related) in data['terms'].items()}
+        return cls(terms, data['common'], data['law_count'])
+
+    def extract(self, query: str, max_keywords: int = 32) -> List[str]:
+        """
+        Extracts the keywords of a query.
+
+        The words of the query come first (without stopwords), then the other spellings of
+        their terms, then the terms that co-occur with them in the laws, so max_keywords
+        cuts the expansions before the words of the user.
+
+        Parameters:
+        query (str): The query.
+        max_keywords (int): The maximum number of keywords.
+
+        Returns:
+        list: The keywords.
+        """
+        words = WORD_PATTERN.findall(query)
+        tokens = [fold_text(word) for word in words]
+        terms = [stem(token) for token in tokens]
+        selected = [(word, term) for word, token, term in zip(words, tokens, terms)
+                    if not is_stopword(token) and term not in self.common]
+        if not selected:
+            # Nothing but stopwords, e.g. "was ist das": keep the words of the query
+            selected = list(zip(words, terms))
+
+        expansions = [self.terms.get(term, ((), ())) for _, term in selected]
+        candidates = [word for word, _ in selected]
+        candidates += [variant for variants, _ in expansions for variant in variants]
+        candidates += [
+            self.terms[term][0][0] if term in self.terms else term
+            for _, related in expansions for term in related
+        ]
+
+        keywords = {}
+        for keyword in candidates:
+            keywords.setdefault(fold_text(keyword), keyword)
+            if len(keywords) == max_keywords:
+                break
+        return list(keywords.values())
+
+
+def build_keyword_model(path: str = KEYWORD_MODEL_PATH) -> KeywordModel:
+    """
+    Builds the keyword model from the EmbeddedLaw table and saves it to disk.
+
+    Parameters:
+    path (str): Where to save the model.
+
+    Returns:
+    KeywordModel: The new model.
+    """
+    model = KeywordModel.build(EmbeddedLaw.objects.values_list('title', 'text').iterator())
+    model.save(path)
+    print(f"Built keyword model with {len(model.terms)} terms from {model.law_count} laws")
+
+    _loaded.update(model=model, stamp=_file_stamp(path))
+    return model
+
+
+_loaded = {'model': None, 'stamp': None}
+_load_lock = threading.Lock()
+
+
+def _file_stamp(path: str):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def get_keyword_model(path: str = KEYWORD_MODEL_PATH) -> Optional[KeywordModel]:
+    """
+    Returns the keyword model of this worker. It is loaded once and reloaded when the
+    file changes. Unlike the term statistics it is not built on demand (the co-occurrence
+    of a large corpus takes a while), see build_keyword_model.
+
+    Returns:
+    KeywordModel: The keyword model, None if it was not built yet.
+    """
+    stamp = _file_stamp(path)
+    if stamp is None or stamp == _loaded['stamp']:
+        return _loaded['model'] if stamp is not None else None
+
+    with _load_lock:
+        if _loaded['stamp'] != stamp:
+            _loaded.update(model=KeywordModel.load(path), stamp=stamp)
+        return _loaded['model']
+
+
+# Used without a model: the words of the query, stopwords and inflections are still handled
+_empty_model = KeywordModel({}, (), 0)
+
+
+def local_keywords(query: str, max_keywords: int = 32) -> List[str]:
+    """
+    Extracts the keywords of a query locally, in well under a millisecond.
+
+    Parameters:
+    query (str): The query.
+    max_keywords (int): The maximum number of keywords.
+
+    Returns:
+    list: The keywords.
+    """
+    return (get_keyword_model() or _empty_model).extract(query, max_keywords)
@@ -0,0 +1,224 @@
+import bisect
+import math
+import threading
+from typing import Iterable, List, Optional
+
+
+# Upper bounds (seconds) of the buckets of the duration histograms
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# The quantiles reported for every histogram
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """
+    Observations counted in fixed buckets, like a Prometheus histogram.
+
+    Memory does not grow with the number of observations. Quantiles are interpolated
+    linearly within their bucket, the same way histogram_quantile() does.
+    """
+
+    def __init__(self, buckets: Iterable[float] = DURATION_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self) -> 'Histogram':
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+    def cumulative_counts(self) -> List[int]:
+        """The number of observations up to every bucket bound, the last one is +Inf."""
+        cumulative, total = [], 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Returns the estimated q-quantile, None without observations. Values above the
+        largest bucket are reported as its bound.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        lower, previous = 0.0, 0
+        for bound, cumulative in zip(self.buckets, self.cumulative_counts()):
+            if cumulative >= rank:
+                in_bucket = cumulative - previous
+                return lower + (bound - lower) * ((rank - previous) / in_bucket if in_bucket else 0.0)
+            lower, previous = bound, cumulative
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    A thread safe registry of counters and histograms, shared by all requests of a worker.
+
+    Metrics are identified by a name and a set of labels, e.g.
+    increment('upstream_requests_total', upstream='llm') or
+    observe('search_stage_duration_seconds', 0.12, stage='embedding').
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """
+        Increments a counter.
+
+        Parameters:
+        name (str): The name of the counter.
+        value (float): The increment, defaults to 1.
+        labels: The labels of the counter.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def get(self, name: str, **labels) -> float:
+        """Returns the value of a counter, 0 if it was never incremented."""
+        return self._counters.get(self._key(name, labels), 0)
+
+    def observe(self, name: str, value: float, buckets: Iterable[float] = DURATION_BUCKETS, **labels):
+        """
+        Adds an observation (e.g. a duration in seconds) to a histogram.
+
+        Parameters:
+        name (str): The name of the histogram.
+        value (float): The observed value.
+        buckets (Iterable[float]): The bucket bounds, used when the histogram is created.
+                                   Defaults to DURATION_BUCKETS.
+        labels: The labels of the histogram.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        """Returns a copy of a histogram, None if nothing was observed."""
+        with self._lock:
+            histogram = self._histograms.get(self._key(name, labels))
+            return histogram.copy() if histogram is not None else None
+
+    def _copy(self) -> tuple:
+        with self._lock:
+            return dict(self._counters), {key: histogram.copy() for key, histogram in self._histograms.items()}
+
+    def snapshot(self) -> dict:
+        """
+        Returns all counters as {name: [{'labels': {...}, 'value': ...}, ...]} and all
+        histograms as {name: [{'labels': {...}, 'count': ..., 'sum': ..., 'p50': ..., ...}, ...]}.
+        """
+        counters, histograms = self._copy()
+
+        snapshot = {}
+        for (name, labels), value in sorted(counters.items()):
+            snapshot.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        for (name, labels), histogram in sorted(histograms.items()):
+            snapshot.setdefault(name, []).append({
+                'labels': dict(labels),
+                'count': histogram.count,
+                'sum': histogram.sum,
+                **{f"p{round(q * 100)}": histogram.quantile(q) for q in QUANTILES},
+            })
+        return snapshot
+
+    def prometheus(self) -> str:
+        """
+        Returns all metrics in the Prometheus text format.
+
+        Histograms are written with their buckets, sum and count. Their p50/p95/p99
+        are added as gauge <name>_quantile{quantile="0.95"}, for dashboards without a
+        Prometheus server in front.
+        """
+        counters, histograms = self._copy()
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f"{name}{format_labels(dict(labels))} {format_value(value)}")
+
+        for name in sorted({name for name, _ in histograms}):
+            family = [
+                (dict(labels), histogram)
+                for (histogram_name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0])
+                if histogram_name == name
+            ]
+
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in family:
+                bounds = [*(format_value(bound) for bound in histogram.buckets), '+Inf']
+                for bound, cumulative in zip(bounds, histogram.cumulative_counts()):
+                    lines.append(f"{name}_bucket{format_labels({**labels, 'le': bound})} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram.sum)}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+            lines.append(f"# TYPE {name}_quantile gauge")
+            for labels, histogram in family:
+                for q in QUANTILES:
+                    value = histogram.quantile(q)
+                    if value is not None:
+                        lines.append(f"{name}_quantile{format_labels({**labels, 'quantile': str(q)})} {format_value(value)}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def prometheus_family(name: str, kind: str, samples: list) -> str:
+    """
+    Formats metrics that are not kept in the registry (e.g. read from a cache) in the Prometheus text format.
+
+    Parameters:
+    name (str): The name of the metric.
+    kind (str): Its type: counter or gauge.
+    samples (list): The (labels, value) of every series.
+    """
+    lines = [f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{format_labels(labels)} {format_value(value)}" for labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: dict) -> str:
+    """Formats labels as {name="value",...}, escaped like the Prometheus text format requires."""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# The metrics of this worker
+metrics = MetricsRegistry()
@@ -0,0 +1,60 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .metrics import metrics
+from .timing import request_timings, server_timing
+
+
+class ServerTimingMiddleware:
+    """
+    Collects the stage durations of every request (see timing.stage) and sends them
+    in a Server-Timing header, so the browser dev tools show where the time went.
+
+    The duration of every request is recorded in http_request_duration_seconds and
+    counted in http_requests_total, labelled with the name of its view. Streaming
+    responses run their stages after the headers are sent, they only get the metrics.
+    Works for sync and async views.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        start, timings = time.perf_counter(), []
+        token = request_timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_timings.reset(token)
+        return self.finish(request, response, timings, start)
+
+    async def __acall__(self, request):
+        start, timings = time.perf_counter(), []
+        token = request_timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_timings.reset(token)
+        return self.finish(request, response, timings, start)
+
+    @staticmethod
+    def finish(request, response, timings: list, start: float):
+        total = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match is not None and match.url_name else 'other'
+        metrics.observe('http_request_duration_seconds', total, view=view)
+        metrics.increment('http_requests_total', view=view, status=str(response.status_code))
+
+        if not response.streaming:
+            response['Server-Timing'] = server_timing(timings, total)
+        return response
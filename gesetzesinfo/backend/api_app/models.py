@@ -5,6 +5,8 @@ from django.utils import timezone
 import numpy as np
 from django_project import settings
 
+from .quantization import decode_embedding
+
 
 #########################################################
 #                                                       #
@@ -162,6 +164,27 @@ class Law(models.Model):
 
 
 
+class EmbeddedLawManager(models.Manager):
+
+    # The columns needed to show a law. The embedding blobs are served by the embedding store.
+    metadata_fields = ('id', 'law_id', 'book_code', 'title', 'text', 'source_url', 'last_updated')
+
+    def metadata(self):
+        """
+        Returns a queryset that only loads the metadata and text of the laws, without the embedding blobs.
+        """
+        return self.get_queryset().only(*self.metadata_fields)
+
+    # The columns the search results are built from
+    result_fields = ('id', 'law_id', 'book_code', 'title', 'text')
+
+    def for_results(self):
+        """
+        Returns a queryset that only loads the columns needed to build search results.
+        """
+        return self.get_queryset().only(*self.result_fields)
+
+
 class EmbeddedLaw(models.Model):
 
     # Main Key
@@ -200,6 +223,8 @@ class EmbeddedLaw(models.Model):
     # Embedding that is continuously optimized through user feedback
     embedding_optimized = models.BinaryField(default=None)
 
+    objects = EmbeddedLawManager()
+
     def jsonify(self):
         return {
             'Gesetzbuch': self.book_code,
@@ -213,11 +238,11 @@ class EmbeddedLaw(models.Model):
 
     def get_embedding_base(self) -> np.ndarray:
         """Returns the base embedding as a numpy array."""
-        return np.frombuffer(self.embedding_base, dtype=np.float32)
+        return decode_embedding(self.embedding_base)
     
     def get_embedding_optimized(self) -> np.ndarray:
         """Returns the optimized embedding as a numpy array."""
-        return np.frombuffer(self.embedding_optimized, dtype=np.float32)
+        return decode_embedding(self.embedding_optimized)
     
     def __str__(self):
         return f"{self.title}"
@@ -251,13 +276,13 @@ class SearchQuery(models.Model):
     id = models.AutoField(primary_key=True)
     search_request = models.ForeignKey(SearchRequest, on_delete=models.CASCADE, related_name='queries')
     query_text = models.TextField(default='', unique=True) 
-    query_reduced = models.CharField(max_length=reduced_text_length, default='')
+    query_reduced = models.CharField(max_length=reduced_text_length, default='', db_index=True)
     embedding = models.BinaryField(default=None)
     created_at = models.DateTimeField(auto_now=True)
 
     def get_embedding(self):
         if self.embedding:
-            return np.frombuffer(self.embedding, dtype=np.float32)
+            return decode_embedding(self.embedding)
         else:
             raise ValueError("Embedding is None for this search query.")
         
@@ -272,6 +297,32 @@ class SearchQuery(models.Model):
 
 
 
+class CachedEmbedding(models.Model):
+    """
+    Persistent tier of the query embedding cache, shared by all workers.
+
+    The key is a hash of the embedding model, its dimensions and the normalized query,
+    so changing the model never returns stale embeddings.
+    """
+    id = models.AutoField(primary_key=True)
+    key = models.CharField(max_length=64, unique=True)
+    query_normalized = models.TextField(default='')
+    embedding = models.BinaryField(default=None)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def get_embedding(self) -> np.ndarray:
+        """Returns the embedding as a numpy array."""
+        return decode_embedding(self.embedding)
+
+    def __str__(self):
+        return f"{self.query_normalized}"
+
+    class Meta:
+        # Additional options for the model
+        verbose_name = "Cached Embedding"
+        verbose_name_plural = "Cached Embeddings"
+
+
 class SearchResponse(models.Model):
     id = models.AutoField(primary_key=True)
     search_query = models.ForeignKey(SearchQuery, on_delete=models.CASCADE, related_name='responses')
@@ -1,6 +1,5 @@
 
 import os
-import requests
 from typing import List
 
 from django.db import IntegrityError
@@ -10,6 +9,8 @@ from pydantic import BaseModel
 
 import logging
 
+from .clients import get_openai_client, get_http_session, upstream_config
+
 
 def generate_search_keywords(query: str, min_kws: int = 4, max_kws: int = 16) -> List[str]:
     openai_key = os.getenv("OPENAI_API_KEY")
@@ -19,7 +20,7 @@ def generate_search_keywords(query: str, min_kws: int = 4, max_kws: int = 16) ->
         return []
     
     try:
-        openai_client = OpenAI(api_key=openai_key)
+        openai_client = get_openai_client('openai')
     except Exception as e:
         logging.error(f"Failed to create OpenAI client: {e}")
         return []
@@ -114,13 +115,17 @@ def law_search(query_title: str = None, query_text: str = None, book_code: str =
     }
 
     
+    # Reuse the pooled keep-alive connections of the shared session
+    session = get_http_session('openlegaldata')
+    config = upstream_config('openlegaldata')
+
     headers = {
         "accept": "application/json",
-        "Authorization": f"Token {os.getenv('OPENLEGALDATA_TOKEN')}",
+        "Authorization": f"Token {config['api_key']}",
     }
     
     while len(results) < max_results:
-        response = requests.get("https://de.openlegaldata.io/api/laws/search/", params=params, headers=headers)
+        response = session.get(f"{config['base_url']}laws/search/", params=params, headers=headers, timeout=config['timeout'])
         data = response.json()
         results.extend(data['results'])
 
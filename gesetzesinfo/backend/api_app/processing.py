@@ -1,10 +1,15 @@
 import os
 import sqlite3
+import numpy as np
 from django.conf import settings
 from django.db import transaction
-import faiss
-
 from .models import Law, EmbeddedLaw, OpenLegalDataLawTest, get_law_model
+from .vector_index import law_index, law_prefix_index, build_prefix_index, TWO_STAGE_SEARCH
+from .keyword_index import ensure_keyword_index
+from .term_stats import build_term_stats
+from .local_keywords import build_keyword_model
+from .embedding_store import write_embedding_store
+from .quantization import encode_embedding, decode_embedding
 
 
 def populate_law_db():
@@ -33,6 +38,9 @@ def populate_law_db():
     cursor.execute("SELECT law_id, book_code, title, text, source_url, embedding FROM embedded_laws")
     embedded_laws = [dict(row) for row in cursor.fetchall()]
 
+    # Decode the embeddings once, they are stored in the configured storage format below
+    embeddings = np.array([decode_embedding(law['embedding']) for law in embedded_laws], dtype=np.float32)
+
     # Clear existing data
     EmbeddedLaw.objects.all().delete()
 
@@ -47,15 +55,31 @@ def populate_law_db():
 
             text_reduced=law['text'][:EmbeddedLaw.reduced_text_length],
             embedding_text=law['text'],
-            embedding_base=law['embedding'],
-            embedding_optimized=law['embedding'] 
-        ) for law in embedded_laws
+            embedding_base=encode_embedding(embedding),
+            embedding_optimized=encode_embedding(embedding)
+        ) for law, embedding in zip(embedded_laws, embeddings)
     ])
 
     conn.close()
     print(f"Populated {len(embedded_laws)} laws into EmbeddedLaw")
 
-    # Load the FAISS index
-    index = faiss.read_index(faiss_db_path)
+    # Build the full text index for the keyword search. Triggers keep it in sync afterwards.
+    ensure_keyword_index(rebuild=True)
+
+    # Precompute the term statistics used to score the keyword search results
+    build_term_stats()
+
+    # The spellings and related terms of the local keyword extraction
+    build_keyword_model()
+
+    # Write the memory mapped embedding store read by the search and the rating
+    write_embedding_store([law['law_id'] for law in embedded_laws], {'base': embeddings, 'optimized': embeddings})
+
+    # The two stage search needs the index over the truncated embeddings as well
+    if TWO_STAGE_SEARCH:
+        law_prefix_index.publish(build_prefix_index(embeddings, [law['law_id'] for law in embedded_laws]))
+
+    # Load the FAISS index into the resident index of this worker
+    index = law_index.get()
     print(f"Loaded FAISS index with {index.ntotal} vectors")
 
@@ -0,0 +1,120 @@
+import numpy as np
+
+from .util import get_env
+
+
+# The formats embeddings can be stored in (EMBEDDING_STORAGE_FORMAT).
+# float16 halves and int8 quarters the size of every stored embedding.
+STORAGE_FORMATS = ('float32', 'float16', 'int8')
+
+# Quantized blobs start with a header: a float32 -inf (never part of an embedding),
+# the format code and padding. Blobs without it are plain float32 embeddings.
+BLOB_MARKER = np.array([-np.inf], dtype=np.float32).tobytes()
+BLOB_FORMAT_CODES = {'float16': 1, 'int8': 2}
+BLOB_HEADER_SIZE = 8
+
+
+def storage_format() -> str:
+    """
+    Returns the configured storage format of embeddings.
+    """
+    storage = get_env('EMBEDDING_STORAGE_FORMAT', 'float32')
+    if storage not in STORAGE_FORMATS:
+        raise ValueError(f"Unknown embedding storage format {storage}, expected one of {', '.join(STORAGE_FORMATS)}")
+    return storage
+
+
+def quantize_matrix(matrix: np.ndarray, storage: str = None):
+    """
+    Converts a float32 matrix (one embedding per row) to a storage format.
+
+    int8 uses a symmetric scale per dimension (column), so dimensions with a small
+    range keep their precision.
+
+    Parameters:
+    matrix (np.ndarray): The embeddings.
+    storage (str): One of STORAGE_FORMATS, defaults to EMBEDDING_STORAGE_FORMAT.
+
+    Returns:
+    tuple: The stored matrix and the float32 scales per dimension (None unless int8).
+    """
+    storage = storage or storage_format()
+    matrix = np.asarray(matrix, dtype=np.float32)
+
+    if storage == 'float32':
+        return np.ascontiguousarray(matrix), None
+    if storage == 'float16':
+        return matrix.astype(np.float16), None
+
+    scales = np.abs(matrix).max(axis=0) / 127.0 if len(matrix) else np.ones(matrix.shape[1], dtype=np.float32)
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    return quantize_rows(matrix, scales), scales
+
+
+def quantize_rows(rows: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """
+    Quantizes rows to int8 with existing per dimension scales. Values outside the range are clipped.
+    """
+    return np.clip(np.rint(np.asarray(rows, dtype=np.float32) / scales), -127, 127).astype(np.int8)
+
+
+def dequantize(matrix: np.ndarray, scales: np.ndarray = None) -> np.ndarray:
+    """
+    Converts stored rows back to float32.
+
+    Parameters:
+    matrix (np.ndarray): Rows in any storage format.
+    scales (np.ndarray): The per dimension scales of int8 rows.
+
+    Returns:
+    np.ndarray: The float32 rows.
+    """
+    if scales is not None:
+        return np.asarray(matrix, dtype=np.float32) * scales
+    return np.asarray(matrix, dtype=np.float32)
+
+
+def encode_embedding(embedding: np.ndarray, storage: str = None) -> bytes:
+    """
+    Encodes one embedding as a blob for the database.
+
+    A single blob has no column statistics, so int8 blobs store one scale for the whole vector.
+
+    Parameters:
+    embedding (np.ndarray): The embedding.
+    storage (str): One of STORAGE_FORMATS, defaults to EMBEDDING_STORAGE_FORMAT.
+
+    Returns:
+    bytes: The blob.
+    """
+    storage = storage or storage_format()
+    embedding = np.asarray(embedding, dtype=np.float32).ravel()
+
+    if storage == 'float32':
+        return embedding.tobytes()
+
+    header = BLOB_MARKER + bytes([BLOB_FORMAT_CODES[storage], 0, 0, 0])
+    if storage == 'float16':
+        return header + embedding.astype(np.float16).tobytes()
+
+    scale = np.float32(np.abs(embedding).max() / 127.0 or 1.0)
+    values = np.clip(np.rint(embedding / scale), -127, 127).astype(np.int8)
+    return header + np.array([scale], dtype=np.float32).tobytes() + values.tobytes()
+
+
+def decode_embedding(blob: bytes) -> np.ndarray:
+    """
+    Decodes a blob written by encode_embedding (or a plain float32 blob) to a float32 embedding.
+    """
+    blob = bytes(blob)
+    if not blob.startswith(BLOB_MARKER):
+        return np.frombuffer(blob, dtype=np.float32)
+
+    code = blob[len(BLOB_MARKER)]
+    payload = blob[BLOB_HEADER_SIZE:]
+    if code == BLOB_FORMAT_CODES['float16']:
+        return np.frombuffer(payload, dtype=np.float16).astype(np.float32)
+    if code == BLOB_FORMAT_CODES['int8']:
+        scale = np.frombuffer(payload[:4], dtype=np.float32)[0]
+        return np.frombuffer(payload[4:], dtype=np.int8).astype(np.float32) * scale
+    raise ValueError(f"Unknown embedding blob format {code}")
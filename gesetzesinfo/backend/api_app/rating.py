@@ -1,21 +1,21 @@
 
 from django.http import JsonResponse, HttpResponse, HttpRequest
+from asgiref.sync import sync_to_async
 from .models import EmbeddedLaw, SearchQuery, Lock
 import numpy as np
 
 from .util import clamp, lerp
-import faiss
-import os
+from .vector_index import law_index, law_prefix_index, build_index, build_prefix_index, TWO_STAGE_SEARCH
+from .embedding_matrix import get_embedding_matrix
+from .embedding_store import update_embedding
+from .quantization import encode_embedding
+from .search import get_embedding
+from .async_search import aget_embedding
 
 
 LOCK_NAME = 'index_update_lock'
 
 
-current_dir = os.path.dirname(os.path.abspath(__file__))
-parent_dir = os.path.dirname(current_dir)
-INDEX_PATH = os.path.join(parent_dir, 'law_vector_db.faiss')
-
-
 def calc_new_embedding(
     query_embedding: np.ndarray, 
     law_embedding: np.ndarray, 
@@ -58,6 +58,29 @@ def rating_to_score(rating: str) -> float:
     else:
         return 0.0
     
+def update_optimized_embedding(law_id: int, query_embedding: np.ndarray, rating: str) -> np.ndarray:
+    """
+    Moves the optimized embedding of a law towards (or away from) the query embedding.
+
+    The row is updated in place in the embedding store.
+
+    Parameters:
+    law_id (int): The law_id of the rated law.
+    query_embedding (np.ndarray): The embedding of the query.
+    rating (str): The rating ("positive" or "negative").
+
+    Returns:
+    np.ndarray: The new optimized embedding.
+    """
+    matrix = get_embedding_matrix('optimized')
+    row = matrix.row_of[law_id]
+
+    adjusted_embedding = calc_new_embedding(query_embedding, matrix.rows(np.array([row]))[0], rating_to_score(rating))
+    update_embedding('optimized', row, adjusted_embedding)
+
+    return adjusted_embedding.astype(np.float32)
+
+
 def rebuild_index():
 
     # Acquire the lock
@@ -67,20 +90,21 @@ def rebuild_index():
         return 
 
     try:
-        # Get all current IDs and optimized embeddings from the database
-        laws = EmbeddedLaw.objects.all()
-        ids = np.array([law.id for law in laws])
-        embeddings = np.array([law.get_embedding_optimized() for law in laws])
-        
-        # Create a new index
-        index = faiss.IndexFlatL2(embeddings.shape[1])
+        # Get all current IDs and optimized embeddings from the embedding store
+        # The index is keyed by law_id, just like the results of the search
+        matrix = get_embedding_matrix('optimized')
+        ids = matrix.law_ids
+        embeddings = matrix.dense()
         
-        # Add the IDs and embeddings to the index
-        id_map = faiss.IndexIDMap(index)
-        id_map.add_with_ids(embeddings, ids)
+        # Create a new index of the configured type and add the IDs and embeddings
+        id_map = build_index(embeddings, ids)
         
-        # Save the updated index back to the file
-        faiss.write_index(id_map, INDEX_PATH)
+        # Save the updated index and swap it in without a restart
+        law_index.publish(id_map)
+
+        # The first stage of the two stage search has its own, truncated index
+        if TWO_STAGE_SEARCH:
+            law_prefix_index.publish(build_prefix_index(embeddings, ids))
         
         print("Rebuilt index with new embeddings")
     
@@ -91,63 +115,87 @@ def rebuild_index():
     Lock.release_lock(LOCK_NAME)
 
 
-def rating_endpoint(request) -> JsonResponse:
+def parse_rating_params(request):
     """
-    Update the embedding of the law that was rated based on the query and rating.
+    Reads and validates the parameters of a rating request.
 
     Parameters:
-    request (HttpRequest): The HTTP request with the following query parameters:
-        id (int): The id of the law to rate
-        qid (int): The id of the search query
-        r (str): The rating ("positive" or "negative")
+    request (HttpRequest): The HTTP request with the parameters id, qid (or q) and r.
 
     Returns:
-    JsonResponse: A JSON response containing the result of the operation
+    tuple: (id, query_id, query, rating) and None, or None and the JsonResponse with the error.
     """
-    print("rating endpoint")
-
     # Get parameters from the request
-    id: int = int(request.GET.get('id', None))
-    query_id: int = int(request.GET.get('qid', None))
+    try:
+        id: int = int(request.GET.get('id') or 0)
+        query_id: int = int(request.GET.get('qid') or 0)
+    except ValueError:
+        return None, JsonResponse({'error': 'id and qid must be integers'}, status=400)
+    query: str = request.GET.get('q', None)
     rating: str = request.GET.get('r', None)
 
     # Validate parameters
     if not id:
-        return JsonResponse({'error': 'id is required'}, status=400)
-    if not query_id:
-        return JsonResponse({'error': 'qid is required'}, status=400)
+        return None, JsonResponse({'error': 'id is required'}, status=400)
+    if not query_id and not query:
+        return None, JsonResponse({'error': 'qid or q is required'}, status=400)
     if not rating:
-        return JsonResponse({'error': 'r is required'}, status=400)
+        return None, JsonResponse({'error': 'r is required'}, status=400)
     
     print(f"id: {id}, query_id: {query_id}, rating: {rating}")
 
     valid_ratings = ["positive", "negative"]
     if rating not in valid_ratings:
-        return JsonResponse({'error': f'r must be one of {", ".join(valid_ratings)}'}, status=400)
+        return None, JsonResponse({'error': f'r must be one of {", ".join(valid_ratings)}'}, status=400)
+
+    return (id, query_id, query, rating), None
+
+
+def rating_endpoint(request) -> JsonResponse:
+    """
+    Update the embedding of the law that was rated based on the query and rating.
+
+    Parameters:
+    request (HttpRequest): The HTTP request with the following query parameters:
+        id (int): The id of the law to rate
+        qid (int): The id of the search query
+        q (str): The query text, used instead of qid while the search is not logged yet
+        r (str): The rating ("positive" or "negative")
+
+    Returns:
+    JsonResponse: A JSON response containing the result of the operation
+    """
+    print("rating endpoint")
+
+    params, error_response = parse_rating_params(request)
+    if error_response:
+        return error_response
+    id, query_id, query_text, rating = params
 
     # Get the search query that corresponds to search query and law that is being rated
-    try:
-        query = SearchQuery.objects.get(id=query_id)
-    except SearchQuery.DoesNotExist:
-        return JsonResponse({'error': f'SearchQuery with id {query_id} does not exist'}, status=404)
+    if query_id:
+        try:
+            query = SearchQuery.objects.only('embedding').get(id=query_id)
+        except SearchQuery.DoesNotExist:
+            return JsonResponse({'error': f'SearchQuery with id {query_id} does not exist'}, status=404)
 
         
     # Get the law that is being rated
     try:
-        embedded_law = EmbeddedLaw.objects.get(id=id)
+        embedded_law = EmbeddedLaw.objects.metadata().get(id=id)
     except EmbeddedLaw.DoesNotExist:
         return JsonResponse({'error': f'EmbeddedLaw with id {id} does not exist'}, status=404)
 
     
     # Update the embedding
     try:
-        law_embedding = embedded_law.get_embedding_optimized()
-    
-        query_embedding = query.get_embedding()
+        # Searches are logged behind the request, a fresh one is rated with the cached query embedding
+        query_embedding = query.get_embedding() if query_id else get_embedding(query_text)
 
-        adjusted_embedding = calc_new_embedding(query_embedding, law_embedding, rating_to_score(rating))
+        adjusted_embedding = update_optimized_embedding(embedded_law.law_id, query_embedding, rating)
 
-        EmbeddedLaw.objects.filter(id=id).update(embedding_optimized=adjusted_embedding)
+        # Keep the database as record of the optimized embedding
+        EmbeddedLaw.objects.filter(id=id).update(embedding_optimized=encode_embedding(adjusted_embedding))
 
         rebuild_index()
 
@@ -155,4 +203,43 @@ def rating_endpoint(request) -> JsonResponse:
         return JsonResponse({'error': f"Error updating the embedding: {str(e)}"}, status=500)
 
     return JsonResponse({"success": True}, status=200)
-0.4254
\ No newline at end of file
+0.4254
+
+async def async_rating_endpoint(request) -> JsonResponse:
+    """
+    Async version of rating_endpoint, served by the ASGI application.
+
+    The lookups and the update use the async ORM. Rebuilding the index is CPU bound
+    and runs in a worker thread.
+    """
+    params, error_response = parse_rating_params(request)
+    if error_response:
+        return error_response
+    id, query_id, query_text, rating = params
+
+    if query_id:
+        try:
+            query = await SearchQuery.objects.only('embedding').aget(id=query_id)
+        except SearchQuery.DoesNotExist:
+            return JsonResponse({'error': f'SearchQuery with id {query_id} does not exist'}, status=404)
+
+    try:
+        embedded_law = await EmbeddedLaw.objects.metadata().aget(id=id)
+    except EmbeddedLaw.DoesNotExist:
+        return JsonResponse({'error': f'EmbeddedLaw with id {id} does not exist'}, status=404)
+
+    try:
+        query_embedding = query.get_embedding() if query_id else await aget_embedding(query_text)
+
+        adjusted_embedding = await sync_to_async(update_optimized_embedding, thread_sensitive=False)(
+            embedded_law.law_id, query_embedding, rating
+        )
+
+        await EmbeddedLaw.objects.filter(id=id).aupdate(embedding_optimized=encode_embedding(adjusted_embedding))
+
+        await sync_to_async(rebuild_index, thread_sensitive=False)()
+
+    except Exception as e:
+        return JsonResponse({'error': f"Error updating the embedding: {str(e)}"}, status=500)
+
+    return JsonResponse({"success": True}, status=200)
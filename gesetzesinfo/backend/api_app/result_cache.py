@@ -0,0 +1,309 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from .cache import LRUCache
+from .embedding_store import store_stamp
+from .quantization import encode_embedding, decode_embedding
+from .term_stats import TERM_STATS_PATH
+from .util import get_env, data_path, normalize_query
+from .vector_index import INDEX_PATH, PREFIX_INDEX_PATH, TWO_STAGE_SEARCH
+
+
+logger = logging.getLogger(__name__)
+
+
+# Backend of the search result cache: memory, file, redis or off
+SEARCH_RESULT_CACHE = get_env('SEARCH_RESULT_CACHE', 'memory')
+SEARCH_RESULT_CACHE_SIZE = int(get_env('SEARCH_RESULT_CACHE_SIZE', 2048))
+
+# Results expire after SEARCH_RESULT_CACHE_TTL seconds even if no version changed.
+# Searches without results are cached for a shorter time (negative caching).
+SEARCH_RESULT_CACHE_TTL = float(get_env('SEARCH_RESULT_CACHE_TTL', 24 * 60 * 60))
+SEARCH_RESULT_CACHE_NEGATIVE_TTL = float(get_env('SEARCH_RESULT_CACHE_NEGATIVE_TTL', 10 * 60))
+
+
+def file_stamp(path: str) -> Optional[str]:
+    """Returns a stamp that changes whenever a file is replaced, or None if it is missing."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def search_version() -> str:
+    """
+    Returns a stamp of everything the results of a search are computed from.
+
+    It changes whenever the vector index is rebuilt (after every rating), the
+    optimized embeddings or the term statistics are replaced, or the models are
+    switched. Only file stamps are read, nothing is loaded.
+    """
+    parts = [
+        file_stamp(INDEX_PATH),
+        file_stamp(PREFIX_INDEX_PATH) if TWO_STAGE_SEARCH else '',
+        store_stamp('optimized'),
+        file_stamp(TERM_STATS_PATH),
+        get_env('EMBEDDING_MODEL', ''),
+        get_env('LLM_KEYWORD_EXTRACTION_MODEL', ''),
+        get_env('KEYWORD_SCORING', 'bm25'),
+    ]
+    return '|'.join(str(part) for part in parts)
+
+
+def result_cache_key(query: str, max_results: int) -> str:
+    """
+    Returns the key of the cached results of a search: the normalized query, the
+    number of results and the current search_version.
+    """
+    key = f"{normalize_query(query)}:{max_results}:{search_version()}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def make_entry(results: List[dict], embedding: np.ndarray) -> dict:
+    """
+    Creates a cache entry. The query embedding is kept to log the searches that hit the cache.
+    """
+    return {
+        'results': results,
+        'embedding': base64.b64encode(encode_embedding(embedding)).decode('ascii'),
+    }
+
+
+def entry_embedding(entry: dict) -> np.ndarray:
+    """Returns the query embedding of a cache entry."""
+    return decode_embedding(base64.b64decode(entry['embedding']))
+
+
+def _json_default(value):
+    # Scores may still be numpy scalars
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dump_entry(entry: dict) -> bytes:
+    return json.dumps(entry, default=_json_default).encode('utf-8')
+
+
+class MemoryResultCache:
+    """
+    Results cached in the memory of this worker, evicted least recently used.
+    """
+
+    def __init__(self, max_entries: int):
+        self.cache = LRUCache(max_entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.cache.get(key)
+
+    def set(self, key: str, entry: dict, ttl: float):
+        self.cache.set(key, entry, ttl=ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+class FileResultCache:
+    """
+    Results cached as one file per key, shared by all workers of the machine.
+
+    Files are written next to their final name and moved into place atomically.
+    A read refreshes the modification time, so pruning the oldest files evicts the
+    least recently used entries. The directory is pruned every max_entries / 8 writes.
+    """
+
+    def __init__(self, directory: str, max_entries: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                expires_at, entry = json.loads(file.read())
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+
+        if expires_at <= time.time():
+            self.delete(key)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return entry
+
+    def set(self, key: str, entry: dict, ttl: float):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(b'[' + str(time.time() + ttl).encode('ascii') + b',' + dump_entry(entry) + b']')
+        os.replace(tmp_path, path)
+
+        self._writes += 1
+        if self._writes % max(1, self.max_entries // 8) == 0:
+            self.prune()
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _files(self) -> list:
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
+
+    def prune(self):
+        """Removes the least recently used files above max_entries."""
+        files = self._files()
+        if len(files) <= self.max_entries:
+            return
+
+        def mtime(entry):
+            try:
+                return entry.stat().st_mtime
+            except FileNotFoundError:
+                return 0.0
+
+        files.sort(key=mtime)
+        for entry in files[:len(files) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for entry in self._files():
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self._files()),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / requests if requests else 0.0,
+        }
+
+
+class RedisResultCache:
+    """
+    Results cached in Redis (or a compatible server), shared by all workers and machines.
+
+    Entries expire with their ttl. The size is bounded by the server: configure
+    maxmemory together with an LRU maxmemory-policy (e.g. allkeys-lru).
+    """
+
+    def __init__(self, url: str, prefix: str = 'gesetzesinfo:results:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: str, entry: dict, ttl: float):
+        self.client.set(self.prefix + key, dump_entry(entry), ex=max(1, int(ttl)))
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*', count=1000):
+            self.client.delete(key)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+        }
+
+
+def create_result_cache(backend: str = SEARCH_RESULT_CACHE):
+    """
+    Creates the result cache backend selected by SEARCH_RESULT_CACHE.
+
+    Returns:
+    The backend, or None if the cache is off.
+    """
+    if backend == 'memory':
+        return MemoryResultCache(SEARCH_RESULT_CACHE_SIZE)
+    if backend == 'file':
+        return FileResultCache(get_env('SEARCH_RESULT_CACHE_DIR', data_path('search_result_cache')), SEARCH_RESULT_CACHE_SIZE)
+    if backend == 'redis':
+        return RedisResultCache(get_env('SEARCH_RESULT_CACHE_URL', 'redis://localhost:6379/0'))
+    if backend == 'off':
+        return None
+    raise ValueError(f"Unknown SEARCH_RESULT_CACHE {backend}, expected memory, file, redis or off")
+
+
+# The search result cache of this worker
+result_cache = create_result_cache()
+
+
+def get_cached_results(key: str) -> Optional[dict]:
+    """
+    Returns the cache entry of a search, or None on a miss. Errors of the backend count as a miss.
+    """
+    if result_cache is None:
+        return None
+    try:
+        return result_cache.get(key)
+    except Exception as e:
+        logger.warning("Reading the result cache failed: %s", e)
+        return None
+
+
+def cache_results(key: str, results: List[dict], embedding: np.ndarray):
+    """
+    Caches the results of a search, searches without results for a shorter time.
+    """
+    if result_cache is None:
+        return
+    ttl = SEARCH_RESULT_CACHE_TTL if results else SEARCH_RESULT_CACHE_NEGATIVE_TTL
+    try:
+        result_cache.set(key, make_entry(results, embedding), ttl)
+    except Exception as e:
+        logger.warning("Writing the result cache failed: %s", e)
+
+
+def result_cache_stats() -> Optional[dict]:
+    if result_cache is None:
+        return None
+    return {'backend': SEARCH_RESULT_CACHE, **result_cache.stats()}
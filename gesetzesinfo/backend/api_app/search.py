@@ -3,9 +3,13 @@ from django.http import JsonResponse
 from django.http import HttpRequest
 from django.db.models import Q, Count, F, Value, IntegerField, FloatField, Sum, ExpressionWrapper, Case, When
 from django.db.models.functions import Greatest, Length, Cast
+from django.db import close_old_connections
 
 
 import os
+import logging
+import threading
+import time
 from typing import List
 import json
 import re
@@ -16,56 +20,136 @@ from together import Together
 import faiss
 import numpy as np
 
-from .models import SearchRequest, SearchQuery, EmbeddedLaw, SearchResponse
-from .util import clear_text, clamp_text_to_tokens, lerp
+from .models import EmbeddedLaw
+from .util import clear_text, clamp_text_to_tokens, lerp, get_env, normalize_query
+from .vector_index import law_index, law_prefix_index, truncate_embeddings, TWO_STAGE_SEARCH
+from .keyword_index import search_keyword_index
+from .term_stats import get_term_stats
+from .embedding_cache import embedding_cache
+from .cache import LRUCache
+from .clients import get_openai_client
+from .embedding_matrix import get_embedding_matrix
+from .snippets import KeywordMatcher, make_snippet
+from .analytics import log_search
+from .result_cache import result_cache_key, get_cached_results, cache_results, entry_embedding
+from .deadline import Deadline, client_with_deadline
+from .timing import stage
+from .singleflight import SingleFlight
+from .embedding_batcher import create_embedding_batcher
+from .local_keywords import local_keywords
+from .metrics import metrics
 
 from django.db.models import Q, QuerySet
 from typing import List, Dict, Any
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextvars import copy_context
 
 
-# Get the directory of the current script
+logger = logging.getLogger(__name__)
 
-# Load the environment variables
-env_vars = dotenv_values()
-print(env_vars.get('OPENAI_API_KEY'))
 
-parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-faiss_db_path = os.path.join(parent_dir, 'law_vector_db.faiss')
+# Settings are read with get_env, so the process environment (e.g. of a benchmark
+# pointing the upstream hosts to a local fake) takes precedence over the .env file.
 
-def query_to_keywords(query: str):
+# How many full text candidates are scored per requested keyword search result
+KEYWORD_CANDIDATE_FACTOR = 4
+
+# How many candidates of the first stage of the two stage vector search are rescored
+VECTOR_SEARCH_CANDIDATES = int(get_env('VECTOR_SEARCH_CANDIDATES', 256))
+
+# Threads that run the independent stages of a search concurrently
+search_executor = ThreadPoolExecutor(
+    max_workers=int(get_env('SEARCH_THREADS', 16)),
+    thread_name_prefix='search'
+)
+
+
+def submit_search_task(fn, *args, **kwargs) -> Future:
     """
-    This function converts a query to a list of keywords.
+    Runs a stage of a search on the search executor.
+
+    Database connections opened by the stage are handled like at the end of a request,
+    so pooled threads do not keep stale connections around. The stage runs in the
+    context of the caller, so its timings are reported with the request.
 
     Parameters:
-    query (str): The query to convert to keywords.
+    fn (Callable): The stage to run.
 
     Returns:
-    list: A list of keywords.
+    Future: The future of the result of the stage.
     """
-    query = clear_text(query)
-    # remove all non-alphanumeric characters
-    query = re.sub(r'[^\w\s]', '', query)
-    return query.split()
+    def task():
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return search_executor.submit(copy_context().run, task)
+
+
+# Keywords extracted by the llm, keyed by the normalized query
+keyword_cache = LRUCache(
+    int(get_env('KEYWORD_CACHE_SIZE', 4096)),
+    ttl=float(get_env('KEYWORD_CACHE_TTL', 7 * 24 * 60 * 60))
+)
+
+# With deterministic extraction (temperature 0) the same query always yields the same
+# keywords, so cached keywords never differ from a fresh extraction.
+LLM_KEYWORDS_DETERMINISTIC = get_env('LLM_KEYWORD_EXTRACTION_DETERMINISTIC', 'true').lower() in ('1', 'true', 'yes')
+
+# How the keywords of a search are extracted:
+#   llm    the llm extracts them in the search, the local extraction is the fallback
+#   async  the local extraction answers the search, the llm extracts the keywords in the
+#          background and later searches of the query get them from the keyword cache
+#   local  the llm is never called
+KEYWORD_EXTRACTION_MODE = get_env('KEYWORD_EXTRACTION_MODE', 'llm').lower()
+
+# Background llm extractions of the async mode, beyond the limit they are skipped
+keyword_refresh_executor = ThreadPoolExecutor(
+    max_workers=int(get_env('KEYWORD_REFRESH_THREADS', 2)),
+    thread_name_prefix='keyword-refresh'
+)
+KEYWORD_REFRESH_MAX_PENDING = int(get_env('KEYWORD_REFRESH_MAX_PENDING', 256))
+_pending_refreshes = set()
+_refresh_lock = threading.Lock()
+
+def query_to_keywords(query: str, max_keywords: int = 32):
+    """
+    This function converts a query to a list of keywords without the llm.
 
+    Stopwords are dropped, the words of the query are expanded with their other
+    spellings and related terms of the corpus (see local_keywords).
 
-def query_to_keywords_llm(query: str, max_keywords: int = 32):
-    """
-    This function converts a query to a list of keywords using an llm.
     Parameters:
     query (str): The query to convert to keywords.
+    max_keywords (int): The maximum number of keywords.
 
     Returns:
     list: A list of keywords.
     """
+    return local_keywords(clear_text(query), max_keywords)
 
-    llm_client = openai.OpenAI(
-        base_url=env_vars.get("LLM_KEYWORD_EXTRACTION_HOST"),
-        api_key=env_vars.get("GROQ_API_KEY")
-    )
 
-    query = clear_text(query)
+def keyword_cache_key(query: str, max_keywords: int) -> tuple:
+    """
+    Returns the key of the keyword cache for a query.
+    """
+    temperature = 0.0 if LLM_KEYWORDS_DETERMINISTIC else 0.7
+    return (normalize_query(query), max_keywords, get_env("LLM_KEYWORD_EXTRACTION_MODEL"), temperature)
+
 
+def keyword_extraction_request(query: str, max_keywords: int = 32) -> dict:
+    """
+    Builds the chat completion request that extracts keywords from a query.
+
+    Parameters:
+    query (str): The query to extract keywords from.
+    max_keywords (int): The maximum number of keywords to extract.
+
+    Returns:
+    dict: The arguments for chat.completions.create.
+    """
     system_prompt = """
     Sie sind ein erfahrener Jurist. 
     Extrahieren bzw. generieren sie 1 bis {max_keywords} relevante Keywords aus einer Suchanfrage.
@@ -96,88 +180,239 @@ def query_to_keywords_llm(query: str, max_keywords: int = 32):
     "{query}"
     """
 
+    return dict(
+        model=get_env("LLM_KEYWORD_EXTRACTION_MODEL"),
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message}
+        ],
+        max_tokens=max_keywords * 16,
+        temperature=keyword_cache_key(query, max_keywords)[-1],
+        response_format={ "type": "json_object" }
+    )
+
+
+def parse_keywords_response(response) -> list:
+    """
+    Returns the keywords of a chat completion created from keyword_extraction_request.
+    """
+    loaded_keywords = json.loads(response.choices[0].message.content)
+    return loaded_keywords.get("keywords", [])
+
+
+def extract_keywords_llm(query: str, max_keywords: int, deadline: Deadline, cache_key: tuple) -> tuple:
+    """
+    Asks the llm for the keywords of a (cleaned) query, retrying with backoff within
+    the deadline. Extracted keywords are cached under cache_key.
+
+    Returns:
+    tuple: The keywords (empty if every attempt failed) and the error of the last attempt.
+    """
+    llm_client = get_openai_client('llm')
+    request = keyword_extraction_request(query, max_keywords)
 
     max_retries = 3
-    retry_count = 0
 
     keywords = []
-    while retry_count < max_retries:
+    error = None
+    for attempt in range(max_retries):
         try:
-            response = llm_client.chat.completions.create(
-                model=env_vars.get("LLM_KEYWORD_EXTRACTION_MODEL"),
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                max_tokens=max_keywords * 16,
-                temperature=0.7,    
-                response_format={ "type": "json_object" }
-            )
-
-            loaded_keywords = json.loads(response.choices[0].message.content)
-            keywords = loaded_keywords.get("keywords", [])
+            response = client_with_deadline(llm_client, deadline).chat.completions.create(**request)
+            keywords = parse_keywords_response(response)
+
+            # Only llm results are cached, the fallback of query_to_keywords_llm is cheap anyway
+            if keywords:
+                keyword_cache.set(cache_key, tuple(keywords))
             break
 
         except Exception as e:
-            print(f"query_to_keywords_llm: Attempt {retry_count + 1} failed: {e}")
-            retry_count += 1
-            
+            logger.warning("query_to_keywords_llm: Attempt %d failed: %s", attempt + 1, e)
+            error = e
+
+            # Back off before the next attempt, as long as it fits into the budget
+            pause = deadline.retry_backoff(attempt) if attempt + 1 < max_retries else None
+            if pause is None:
+                break
+            time.sleep(pause)
+
+    return keywords, error
+
+
+# Concurrent extractions of the same query share one llm call
+keyword_flights = SingleFlight('keywords')
+
+
+def query_to_keywords_llm(query: str, max_keywords: int = 32, deadline: Deadline = None):
+    """
+    This function converts a query to a list of keywords using an llm.
+    Parameters:
+    query (str): The query to convert to keywords.
+    max_keywords (int): The maximum number of keywords to extract.
+    deadline (Deadline): The budget of the search. Attempts and the pauses between
+                         them stop when it runs out.
+
+    Results are cached per normalized query, a cache hit does not call the llm.
+    Concurrent calls for the same query wait for the first one and share its keywords.
+
+    With KEYWORD_EXTRACTION_MODE local or async the llm is not called in the search,
+    the keywords are extracted locally (see query_to_keywords). In async mode they are
+    marked provisional in the deadline until the refreshed llm keywords are cached.
+
+    Returns:
+    list: A list of keywords.
+    """
+    cache_key = keyword_cache_key(query, max_keywords)
+
+    cached_keywords = keyword_cache.get(cache_key)
+    if cached_keywords is not None:
+        metrics.increment('keyword_extractions_total', source='cache')
+        return list(cached_keywords)
+
+    if KEYWORD_EXTRACTION_MODE in ('local', 'async'):
+        if KEYWORD_EXTRACTION_MODE == 'async':
+            refresh_keywords_llm(query, max_keywords, cache_key)
+            # Results with the local keywords must not outlive the refresh
+            if deadline is not None:
+                deadline.mark_provisional('keywords')
+        metrics.increment('keyword_extractions_total', source='local')
+        return query_to_keywords(query, max_keywords)
+
+    deadline = deadline or Deadline(0)
+    query = clear_text(query)
+
+    try:
+        keywords, error = keyword_flights.do(
+            cache_key, partial(extract_keywords_llm, query, max_keywords, deadline, cache_key), deadline.remaining()
+        )
+    except TimeoutError as e:
+        keywords, error = [], e
+
     if not keywords:
-        print(f"query_to_keywords_llm: All {max_retries} attempts failed. Defaulting to non AI keyword extraction from query.")
-        keywords = query_to_keywords(query)
+        logger.info("query_to_keywords_llm: Defaulting to non AI keyword extraction from query.")
+        deadline.degrade('keywords', 'local_keywords', error)
+        metrics.increment('keyword_extractions_total', source='local')
+        return query_to_keywords(query, max_keywords)
 
-    return keywords
+    metrics.increment('keyword_extractions_total', source='llm')
+    return list(keywords)
 
 
-def get_embedding(text: str):
+def refresh_keywords_llm(query: str, max_keywords: int, cache_key: tuple) -> bool:
     """
-    This function uses the openai embedding model to get the embedding for a given text.
+    Extracts the keywords of a query with the llm in the background and caches them,
+    for the async KEYWORD_EXTRACTION_MODE. A query is refreshed once at a time.
+
+    Returns:
+    bool: False if the refresh was skipped (in flight already or too many pending).
+    """
+    with _refresh_lock:
+        if cache_key in _pending_refreshes or len(_pending_refreshes) >= KEYWORD_REFRESH_MAX_PENDING:
+            return False
+        _pending_refreshes.add(cache_key)
+
+    def refresh():
+        try:
+            keyword_flights.do(cache_key, partial(extract_keywords_llm, clear_text(query), max_keywords, Deadline(), cache_key))
+        finally:
+            with _refresh_lock:
+                _pending_refreshes.discard(cache_key)
+
+    keyword_refresh_executor.submit(refresh)
+    return True
+
+
+def get_embedding(text: str, deadline: Deadline = None):
+    """
+    This function returns the embedding for a given text.
+
+    Embeddings are served from the query embedding cache, the openai embedding model
+    is only called for texts that were never embedded before. Concurrent searches for
+    the same text share one call.
 
     Parameters:
     text (str): The text to get the embedding for.
+    deadline (Deadline): The budget of the search, limits the call of the embedding model.
 
     Returns:
-    list: A list of the embedding.
+    np.ndarray: The embedding.
     """
-    
-    openai_client = openai.OpenAI(
-        api_key=env_vars.get("OPENAI_API_KEY")
-    )
+    timeout = deadline.remaining() if deadline is not None else None
+    return embedding_cache.get_or_compute(text, partial(request_embedding, deadline=deadline), timeout)
+
+
+def embedding_request(text) -> dict:
+    """
+    Builds the embeddings request for a text.
 
+    Parameters:
+    text (str): The text to embed, or a list of texts to embed with one request.
+
+    Returns:
+    dict: The arguments for embeddings.create.
+    """
     # Combine and limit all texts to env EMBEDDING_MODEL_MAX_TOKENS
-    clamped_text = clamp_text_to_tokens(text, int(env_vars.get('EMBEDDING_MODEL_MAX_TOKENS', 8191)))
+    max_tokens = int(get_env('EMBEDDING_MODEL_MAX_TOKENS', 8191))
+    if isinstance(text, str):
+        clamped_text = clamp_text_to_tokens(text, max_tokens)
+    else:
+        clamped_text = [clamp_text_to_tokens(t, max_tokens) for t in text]
 
-    response = openai_client.embeddings.create(
-        model=env_vars.get('EMBEDDING_MODEL'),
+    return dict(
+        model=get_env('EMBEDDING_MODEL'),
         input=clamped_text,
         encoding_format='float',
-        dimensions = int(env_vars.get('EMBEDDING_MODEL_DIMS')) 
+        dimensions = int(get_env('EMBEDDING_MODEL_DIMS')) 
     )
 
+
+def request_embedding(text: str, deadline: Deadline = None):
+    """
+    This function uses the openai embedding model to get the embedding for a given text.
+
+    With EMBEDDING_BATCH_WINDOW_MS set, the text is embedded together with the texts of
+    concurrent searches in one call (see embedding_batcher).
+
+    Parameters:
+    text (str): The text to get the embedding for.
+    deadline (Deadline): The budget of the search, the call times out when it runs out.
+
+    Returns:
+    np.ndarray: The embedding.
+    """
+    if embedding_batcher is not None:
+        return embedding_batcher.embed(text, deadline)
+
+    openai_client = client_with_deadline(get_openai_client('openai'), deadline)
+
+    response = openai_client.embeddings.create(**embedding_request(text))
+
     embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
 
     return embedding
 
 
+def request_embeddings(texts: List[str], deadline: Deadline = None) -> np.ndarray:
+    """
+    Embeds several texts with one request to the openai embedding model.
 
-def calculate_keyword_score(law: EmbeddedLaw, keywords: list):
+    Parameters:
+    texts (List[str]): The texts to embed.
+    deadline (Deadline): The budget of the request, limits the timeout of the call.
 
-    title = law.title
-    text = law.text
-    title_word_count = len(title.split())
-    text_word_count = len(text.split())
-    
-    title_keyword_count = sum(keyword.lower() in title.lower() for keyword in keywords)
-    text_keyword_count = sum(keyword.lower() in text.lower() for keyword in keywords)
-    keyword_occurrences = sum(text.lower().count(keyword.lower()) for keyword in keywords)
+    Returns:
+    np.ndarray: The embeddings, one row per text.
+    """
+    openai_client = client_with_deadline(get_openai_client('openai'), deadline)
 
-    title_score_unique = (title_keyword_count / title_word_count) if title_keyword_count > 0 else 0.0
-    text_score_unique = (text_keyword_count / text_word_count) if text_keyword_count > 0 else 0.0
-    text_score_total = (keyword_occurrences / text_word_count) if keyword_occurrences > 0 else 0.0
+    response = openai_client.embeddings.create(**embedding_request(texts))
 
-    score = ((title_score_unique * 5) + (text_score_unique * 0.3) + (text_score_total * 0.1)) / len(keywords)
+    # The embeddings carry the position of their input
+    data = sorted(response.data, key=lambda item: item.index)
+    return np.asarray([item.embedding for item in data], dtype=np.float32)
 
-    return {'law_id': law.law_id, 'score': score}
+
+# Collects the queries of concurrent searches into one embeddings call, None if disabled
+embedding_batcher = create_embedding_batcher(request_embeddings)
 
 
 def multi_keyword_search(keywords: list, max_results: int = 64):
@@ -195,19 +430,40 @@ def multi_keyword_search(keywords: list, max_results: int = 64):
     if not keywords:
         return []
 
-    q_objects = Q()
-    for keyword in keywords:
-        q_objects |= Q(title__icontains=keyword) | Q(text_reduced__icontains=keyword)
+    candidate_ids = keyword_candidates(keywords, max_results)
 
-    db_query = EmbeddedLaw.objects.filter(q_objects)
+    # Score all candidates at once with the precomputed term statistics (BM25 by default)
+    scores = get_term_stats().score(candidate_ids, keywords)
 
-    # Map the score calculator over all laws in the query
-    results = list(map(lambda law: calculate_keyword_score(law, keywords), db_query))
+    return best_keyword_results(candidate_ids, scores, max_results)
 
-    # Sort the results by score and limit to max_results
-    results = sorted(results, key=lambda x: x['score'], reverse=True)[:max_results]
 
-    return results
+def keyword_candidates(keywords: list, max_results: int = 64) -> List[int]:
+    """
+    Returns the law_ids of the laws that match any of the keywords, the candidates of the keyword search.
+    """
+    # Get the best matching candidates from the full text index in one query
+    candidate_ids = search_keyword_index(keywords, max_results * KEYWORD_CANDIDATE_FACTOR)
+
+    if candidate_ids is None:
+        # Without a full text index, fall back to scanning the table
+        q_objects = Q()
+        for keyword in keywords:
+            q_objects |= Q(title__icontains=keyword) | Q(text_reduced__icontains=keyword)
+
+        candidate_ids = list(EmbeddedLaw.objects.filter(q_objects).values_list('law_id', flat=True))
+
+    return candidate_ids
+
+
+def best_keyword_results(candidate_ids: List[int], scores: np.ndarray, max_results: int) -> List[dict]:
+    """
+    Returns the best scored candidates of the keyword search (law_id and score).
+    """
+    results = [{'law_id': law_id, 'score': float(score)} for law_id, score in zip(candidate_ids, scores)]
+
+    # Sort the results by score and limit to max_results
+    return sorted(results, key=lambda x: x['score'], reverse=True)[:max_results]
 
 def rerate_keyword_search_results(keyword_search_results: List[dict], query_embedding: np.array) -> List[dict]:
 
@@ -225,30 +481,15 @@ def rerate_keyword_search_results(keyword_search_results: List[dict], query_embe
     if not keyword_search_results:
         return []
 
-    # Get the embeddings for the keyword search results
-    relevant_laws = EmbeddedLaw.objects.filter(law_id__in=[result['law_id'] for result in keyword_search_results])
-    embeddings = [law.get_embedding_base() for law in relevant_laws]
-
-    embedding_count = len(embeddings)
-    print("embeddings", embedding_count)
+    # Look up the rows of the laws in the resident embedding matrix
+    matrix = get_embedding_matrix()
+    law_ids, rows = matrix.lookup([result['law_id'] for result in keyword_search_results])
 
-
-
-    # build temproary index
-    index = faiss.IndexIDMap(faiss.IndexFlatL2(int(env_vars.get('EMBEDDING_MODEL_DIMS'))))
-    index.add_with_ids(np.array(embeddings, dtype=np.float32), np.array([law.law_id for law in relevant_laws]))
-
-    # search
-    distances, _ = index.search(np.array([query_embedding], dtype=np.float32), embedding_count)
+    # One gathered matrix-vector product, the distances stay aligned with law_ids
+    distances = matrix.squared_distances(rows, query_embedding)
 
     # Calculate the scores
-    scores = [1 / (1 + distance) for distance in distances[0]]
-
-    # Combine the scores with the keyword search results
-    results = [{'law_id': law.law_id, 'score': score} for law, score in zip(relevant_laws, scores)]
-
-    # # Sort the results by score and limit to max_results
-    # results = sorted(results, key=lambda x: x['score'], reverse=True)
+    results = [{'law_id': law_id, 'score': float(1 / (1 + distance))} for law_id, distance in zip(law_ids, distances)]
 
     return results
 
@@ -263,10 +504,11 @@ def natural_language_search(embedding: np.array, max_results: int = 64) -> List[
     Returns:
     list: A list of dictionaries containing the law_id and score for each matching law.
     """
-    vector_index = faiss.read_index(faiss_db_path)
+    if TWO_STAGE_SEARCH:
+        return two_stage_search(embedding, max_results)
 
-    # Get the nearest neighbors
-    distances, indices = vector_index.search(np.asarray([embedding], dtype=np.float32), max_results)
+    # Get the nearest neighbors from the resident index
+    distances, indices = law_index.search(embedding, max_results)
     distances, indices = distances[0], indices[0]
 
     # Sort indices by distances and create result list
@@ -278,31 +520,44 @@ def natural_language_search(embedding: np.array, max_results: int = 64) -> List[
     return results
 
 
-def search_results_to_output(search_results):
-    # Create a dictionary to map law_id to score
-    score_map = {result['law_id']: result['score'] for result in search_results}
+def two_stage_search(embedding: np.array, max_results: int = 64, candidates: int = None) -> List[dict]:
+    """
+    Two stage version of natural_language_search (VECTOR_SEARCH_TWO_STAGE).
 
-    # Get the laws based on law_ids
-    law_ids = [result['law_id'] for result in search_results]
-    laws = EmbeddedLaw.objects.filter(law_id__in=law_ids)
+    The truncated query embedding is searched in the small prefix index, the candidates
+    are then rescored with the full embeddings from the embedding matrix. The scores
+    are the same as the ones of the single stage search.
 
-    # Prepare the final results
-    final_results = []
-    for law in laws:
-        final_results.append({
-            'id': law.id,
-            'title': law.title,
-            'text': law.text,
-            'score': score_map.get(law.law_id, 0)  # Use the corresponding score or 0 if not found
-        })
+    Parameters:
+    embedding (np.array): The embedding of the query text.
+    max_results (int): The maximum number of results to return (default is 64).
+    candidates (int): Candidates of the first stage, defaults to VECTOR_SEARCH_CANDIDATES.
 
-    # print(final_results)
+    Returns:
+    list: A list of dictionaries containing the law_id and score for each matching law.
+    """
+    candidates = max(candidates or VECTOR_SEARCH_CANDIDATES, max_results)
 
-    # Sort the final results by score in descending order
-    final_results.sort(key=lambda x: x['score'], reverse=True)
-    return final_results
+    _, candidate_ids = law_prefix_index.search(truncate_embeddings(embedding), candidates)
+
+    return rescore_candidates(candidate_ids[0], embedding, max_results)
 
 
+def rescore_candidates(candidate_ids: np.ndarray, embedding: np.array, max_results: int) -> List[dict]:
+    """
+    Second stage of the two stage search: scores the candidates of the prefix index
+    with the full embeddings and returns the best.
+    """
+    matrix = get_embedding_matrix('optimized')
+    law_ids, rows = matrix.lookup([law_id for law_id in candidate_ids if law_id >= 0])
+    if not law_ids:
+        return []
+
+    distances = matrix.squared_distances(rows, np.asarray(embedding, dtype=np.float32).ravel())
+    best = np.argsort(distances, kind='stable')[:max_results]
+
+    return [{'law_id': int(law_ids[i]), 'score': float(1 / (1 + distances[i]))} for i in best]
+
 
 def clamp_text_to_tokens(text: str, max_tokens: int):
     """
@@ -319,7 +574,7 @@ def clamp_text_to_tokens(text: str, max_tokens: int):
     str: The clamped text.
     """
     if len(text) > max_tokens:
-        encoding = tiktoken.encoding_for_model(env_vars.get('EMBEDDING_MODEL'))
+        encoding = tiktoken.encoding_for_model(get_env('EMBEDDING_MODEL'))
         encoded_text = encoding.encode(text)
         num_tokens = len(encoded_text)
         if num_tokens > max_tokens:
@@ -328,60 +583,14 @@ def clamp_text_to_tokens(text: str, max_tokens: int):
     else:
         return text
 
-def get_or_create_search_query(query: str) -> SearchQuery:
-
-    """
-    Creates or retrieves a SearchQuery object from the database based on the given query.
-
-    The query is first truncated to fit the SearchRequest model's reduced_text_length, then
-    a SearchRequest object is created or retrieved from the database. If the SearchRequest
-    object is created, a new SearchQuery object is created with the truncated query and
-    an embedding generated from the original query. If the SearchRequest object already
-    exists, the corresponding SearchQuery object is retrieved.
-
-    Parameters:
-    query (str): The query to create or retrieve a SearchQuery object for.
-
-    Returns:
-    SearchQuery: The created or retrieved SearchQuery object.
-    """
-    
-    # Truncate the query to fit the SearchRequest model's reduced_text_length
-    search_text_reduced = query[:SearchRequest.reduced_text_length]
-
-    # Create or get a SearchRequest object
-    search_request, search_request_created = SearchRequest.objects.get_or_create(
-        search_text=query,
-        search_text_reduced=search_text_reduced,
-    )
-    search_request.save()
-
-    if not search_request_created:
-        print("SearchRequest already exists")
-
-    # Try to retrieve an existing SearchQuery object
-    search_query = SearchQuery.objects.filter(query_reduced=search_text_reduced).first()
-
-    if not search_query:
-        # Create and save a new SearchQuery object
-        search_query = SearchQuery.objects.create(
-            search_request=search_request,
-            query_text=query,
-            query_reduced=search_text_reduced,
-            embedding=get_embedding(query).tobytes()
-        )
-        search_query.save()
-
-    return search_query
-
-
-    
-
 def filter_search_results(search_results: List[dict], max_results: int = 64, agressiveness: float = 0.5) -> List[dict]: 
     """
     Filters a list of search results based on the given agressiveness parameter.
     """
 
+    if not search_results:
+        return []
+
     search_results.sort(key=lambda x: x['score'], reverse=True)
     search_results = search_results[:max_results*2]
 
@@ -398,56 +607,70 @@ def filter_search_results(search_results: List[dict], max_results: int = 64, agr
 
 
 
-def smart_search(query: str, max_results: int = 32) -> dict:
+def filter_vector_results(nl_search_results: List[dict], max_results: int = 32) -> List[dict]:
     """
-    Performs a smart search on the given query, combining natural language search and keyword search.
-    
-    Args:
-    query (str): The search query.
-    max_results (int): The maximum number of results to return. Defaults to 32.
-    
-    Returns:
-    dict: A dictionary containing the search results.
+    Returns the natural language search results that are part of the combined results.
+    They do not depend on the keyword search, so they can be shown before it finishes.
     """
+    return filter_search_results(nl_search_results, int(max_results * 0.5), agressiveness=0.1)
 
-    # Create a search query object with an embedding for the given query
-    search_query = get_or_create_search_query(query)
-
-    # Extract keywords from the query using a large language model
-    keywords = query_to_keywords_llm(query)
 
-    # Print the extracted keywords for debugging purposes
-    print("Keywords:", keywords)
-
-    # Calculate the maximum number of results for natural language search and keyword search
-    max_nl_results = int(max_results * 2.0)
-    max_keyword_results = int(max_results * 2.0)
+def combine_search_results(nl_search_results: List[dict], keyword_search_results: List[dict], query_embedding: np.ndarray, max_results: int = 32) -> List[dict]:
+    """
+    Combines the results of the natural language search and the keyword search.
 
-    query_embedding = search_query.get_embedding()
+    Parameters:
+    nl_search_results (List[dict]): The results of the natural language search.
+    keyword_search_results (List[dict]): The results of the keyword search.
+    query_embedding (np.ndarray): The embedding of the query, None if the vector search failed.
+    max_results (int): The maximum number of results to return. Defaults to 32.
 
-    # Perform natural language search and keyword search
-    nl_search_results = natural_language_search(query_embedding, max_nl_results)
-    keyword_search_results = multi_keyword_search(keywords, max_keyword_results)
+    Returns:
+    List[dict]: The combined search results (law_id and score).
+    """
 
     # # Filter search results to ensure a balanced mix of natural language and keyword search results
-    nl_search_results = filter_search_results(nl_search_results, int(max_results * 0.5), agressiveness=0.1)
+    nl_search_results = filter_vector_results(nl_search_results, max_results)
     keyword_search_results = filter_search_results(keyword_search_results, int(max_results * 0.5), agressiveness=0.5)
 
     # Remove keyword search results that are already included in the natural language search results
     keyword_search_results = [result for result in keyword_search_results if result['law_id'] not in [r['law_id'] for r in nl_search_results]]
 
     # Re-rate the keyword search results based on their embeddings
-    keyword_search_results = rerate_keyword_search_results(keyword_search_results, query_embedding)
+    if query_embedding is not None:
+        with stage('rerate'):
+            keyword_search_results = rerate_keyword_search_results(keyword_search_results, query_embedding)
+    else:
+        # Keyword only search (the vector search failed), scale the scores to the range of the vector scores
+        best = max((result['score'] for result in keyword_search_results), default=0.0) or 1.0
+        keyword_search_results = [{**result, 'score': result['score'] / best} for result in keyword_search_results]
 
     # Combine natural language search results and keyword search results
-    search_results = nl_search_results + keyword_search_results 
+    return nl_search_results + keyword_search_results
 
+
+def build_final_results(laws: List[EmbeddedLaw], search_results: List[dict], query_id: int, keywords: List[str] = ()) -> List[dict]:
+    """
+    Converts the laws of the combined search results to the output of the search endpoint.
+
+    The results only carry a snippet of the text with the keywords highlighted, the full
+    text is served by the law detail endpoint (/api/laws/<id>/).
+
+    Parameters:
+    laws (List[EmbeddedLaw]): The laws of the search results.
+    search_results (List[dict]): The combined search results (law_id and score).
+    query_id (int): The id of the SearchQuery, used to rate the results. None while the search is
+                    not logged yet, the results are then rated with the query text.
+    keywords (List[str]): The keywords of the search, highlighted in the snippets.
+
+    Returns:
+    List[dict]: The results, best first.
+    """
     # Create a dictionary to map law_id to score
     score_map = {result['law_id']: result['score'] for result in search_results}
 
-    # Get the laws based on law_ids
-    law_ids = [result['law_id'] for result in search_results]
-    laws = EmbeddedLaw.objects.filter(law_id__in=law_ids)
+    # One automaton for all keywords, every text is scanned once
+    matcher = KeywordMatcher(keywords)
 
     # Prepare the final results
     final_results = []
@@ -455,9 +678,10 @@ def smart_search(query: str, max_results: int = 32) -> dict:
         final_results.append({
             'id': law.id,
             'title': law.title,
-            'text': law.text,
+            'book_code': law.book_code,
+            **make_snippet(law.text, matcher),
             'score': score_map.get(law.law_id, 0), 
-            'query_id': search_query.id
+            'query_id': query_id
         })
 
     # Sort the final results by score in descending order
@@ -467,40 +691,169 @@ def smart_search(query: str, max_results: int = 32) -> dict:
     for i, result in enumerate(final_results):
         result['show_id'] = i + 1
 
+    return final_results
+
+
+def results_from_cache(query: str, entry: dict) -> List[dict]:
+    """
+    Returns the cached results of a search. The search is logged like a fresh one.
+
+    Parameters:
+    query (str): The search query.
+    entry (dict): The entry of the result cache.
 
-    # crate search result
+    Returns:
+    List[dict]: The results, carrying the query_id of this search.
+    """
+    results = entry['results']
     try:
-        search_response = SearchResponse.objects.create(
-            search_query=search_query,
-        )
-        search_response.laws.set(laws)
-        search_response.save()
+        with stage('logging'):
+            query_id = log_search(query, entry_embedding(entry), [result['id'] for result in results])
     except Exception as e:
-        print(e)
+        logger.warning("Logging the search failed: %s", e)
+        query_id = None
+
+    return [{**result, 'query_id': query_id} for result in results]
+
 
+def smart_search(query: str, max_results: int = 32, deadline: Deadline = None) -> dict:
+    """
+    Performs a smart search on the given query, combining natural language search and keyword search.
+
+    Every stage is limited by the deadline of the search. A stage that runs out of
+    budget falls back to a cheap local alternative (see Deadline.degrade): the llm
+    keywords to local keywords (see local_keywords), the keyword search to vector
+    only results and the vector search to keyword only results. Degraded results
+    are not cached.
     
+    Args:
+    query (str): The search query.
+    max_results (int): The maximum number of results to return. Defaults to 32.
+    deadline (Deadline): The budget of the search, defaults to SEARCH_DEADLINE. Holds
+                         the degradations that fired when the search returns.
+    
+    Returns:
+    dict: A dictionary containing the search results.
+    """
+    deadline = deadline or Deadline()
+
+    # Calculate the maximum number of results for natural language search and keyword search
+    max_nl_results = int(max_results * 2.0)
+    max_keyword_results = int(max_results * 2.0)
+
+    # Repeated queries are answered from the result cache until the index, the
+    # embeddings or the term statistics change
+    with stage('result_cache'):
+        cache_key = result_cache_key(query, max_results)
+        cached = get_cached_results(cache_key)
+    if cached is not None:
+        return results_from_cache(query, cached)
+
+    def vector_branch():
+        # The embedding of the query, from the query embedding cache when possible
+        with stage('embedding'):
+            query_embedding = get_embedding(query, deadline)
+        with stage('vector_search'):
+            return query_embedding, natural_language_search(query_embedding, max_nl_results)
+
+    def keyword_branch():
+        # Extract keywords from the query using a large language model
+        with stage('keywords'):
+            keywords = query_to_keywords_llm(query, deadline=deadline)
+
+        with stage('keyword_search'):
+            return keywords, multi_keyword_search(keywords, max_keyword_results)
+
+    # Both branches only depend on the query, so they run at the same time
+    keyword_future = submit_search_task(keyword_branch)
+    try:
+        query_embedding, nl_search_results = vector_branch()
+        vector_error = None
+    except Exception as e:
+        deadline.degrade('vector_search', 'keyword_only', e)
+        query_embedding, nl_search_results, vector_error = None, [], e
+
+    try:
+        keywords, keyword_search_results = keyword_future.result(timeout=deadline.remaining())
+    except Exception as e:
+        keywords, keyword_search_results = keyword_fallback(query, deadline, e)
+
+    if vector_error is not None and not keyword_search_results:
+        raise vector_error
+
+    search_results = combine_search_results(nl_search_results, keyword_search_results, query_embedding, max_results)
+
+    # Hydrate the results with one query, only the columns the results are built from
+    law_ids = [result['law_id'] for result in search_results]
+    with stage('hydration'):
+        laws = list(EmbeddedLaw.objects.for_results().filter(law_id__in=law_ids))
+
+    # Log the search (SearchRequest, SearchQuery, SearchResponse), written behind the request by default
+    query_id = None
+    if query_embedding is not None:
+        try:
+            with stage('logging'):
+                query_id = log_search(query, query_embedding, [law.id for law in laws])
+        except Exception as e:
+            logger.warning("Logging the search failed: %s", e)
+
+    with stage('snippets'):
+        final_results = build_final_results(laws, search_results, query_id, keywords)
+
+    # Searches without results are cached too, for a shorter time. Degraded searches
+    # and searches with provisional keywords are not, the next search gets another chance
+    if deadline.cacheable:
+        cache_results(cache_key, final_results, query_embedding)
+
     return final_results
 
 
+def keyword_fallback(query: str, deadline: Deadline, error: Exception) -> tuple:
+    """
+    The keyword search did not finish within the deadline: vector only results, the
+    local keywords of the query still highlight the snippets.
 
-def search_endpoint(request: HttpRequest) -> JsonResponse:
+    Returns:
+    tuple: The keywords and the (empty) keyword search results.
     """
-    Search for a query in the database.
+    deadline.degrade('keyword_search', 'vector_only', error)
+    return query_to_keywords(query), []
+
+
+def parse_search_query(request: HttpRequest):
+    """
+    Reads and validates the query parameter of a search request.
 
     Parameters:
-    request (HttpRequest): The HTTP request with the following query parameter:
-        q (str): The search query
+    request (HttpRequest): The HTTP request with the query parameter q.
 
     Returns:
-    JsonResponse: A JSON response containing the search results or an error message
+    tuple: The cleaned query and None, or None and the JsonResponse with the error.
     """
     # Get the query parameter from the request
     query: str = request.GET.get('q', None)
 
     # Validate the query parameter
     if not query:
-        return JsonResponse({'error': 'q is required'}, status=400)
+        return None, JsonResponse({'error': 'q is required'}, status=400)
+
+    query, error = clean_search_query(query)
+    if error:
+        return None, JsonResponse({'error': error}, status=200)
+
+    return query, None
+
+
+def clean_search_query(query: str):
+    """
+    Cleans a search query and checks its minimum length.
+
+    Parameters:
+    query (str): The query as sent by the client.
 
+    Returns:
+    tuple: The cleaned query and None, or None and the error message.
+    """
     # Clear the query text
     query = clear_text(query)
 
@@ -510,16 +863,35 @@ def search_endpoint(request: HttpRequest) -> JsonResponse:
     # Check the minimum query length
     min_query_length = 4
     if len(query) < min_query_length:
-        return JsonResponse({'error': f'Die Anfrage muss mindestens {min_query_length} Zeichen lang sein.'}, status=200)
+        return None, f'Die Anfrage muss mindestens {min_query_length} Zeichen lang sein.'
+
+    return query, None
+
+
+def search_endpoint(request: HttpRequest) -> JsonResponse:
+    """
+    Search for a query in the database.
+
+    Parameters:
+    request (HttpRequest): The HTTP request with the following query parameter:
+        q (str): The search query
+
+    Returns:
+    JsonResponse: A JSON response containing the search results or an error message
+    """
+    query, error_response = parse_search_query(request)
+    if error_response:
+        return error_response
 
+    deadline = Deadline()
     try:
         # Perform the search
-        results = smart_search(query)
+        results = smart_search(query, deadline=deadline)
     except Exception as e:
-        return JsonResponse({'error': f"Error searching for query: {str(e)}"}, status=400)
+        return JsonResponse({'error': f"Error searching for query: {str(e)}", 'meta': deadline.meta()}, status=400)
     
     if not results:
-        return JsonResponse({'error': 'Keine Ergebnisse gefunden.'}, status=200)
+        return JsonResponse({'error': 'Keine Ergebnisse gefunden.', 'meta': deadline.meta()}, status=200)
 
-    # Return the search results
-    return JsonResponse({'query': query, 'results': results}, status=200)
\ No newline at end of file
+    # Return the search results, the meta data reports which stages were degraded
+    return JsonResponse({'query': query, 'results': results, 'meta': deadline.meta()}, status=200)
\ No newline at end of file
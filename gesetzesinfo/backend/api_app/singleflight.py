@@ -0,0 +1,127 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from .metrics import metrics
+
+
+class _Call:
+    """A call in flight and the result it shares with its waiters."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one call (the threads of a worker).
+
+    The first caller of a key runs the function, every caller that arrives while it is
+    running waits for it and gets the same result, or the same exception. Once the call
+    returned, the next caller of the key starts a new call, so results are only shared
+    between concurrent callers (caching them is up to the caller).
+
+    Calls are counted in singleflight_calls_total{group, role}: role is leader for
+    the callers that ran the function and shared for the callers that waited.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: Optional[float] = None):
+        """
+        Runs fn, unless a call with the same key is in flight already.
+
+        Parameters:
+        key (Hashable): The key of the call, e.g. the normalized query.
+        fn (Callable): The call, without arguments.
+        timeout (float): How long a waiter waits for the call in flight, None waits until it returns.
+
+        Returns:
+        The result of the call.
+
+        Raises:
+        TimeoutError: If the call in flight did not return within the timeout.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        metrics.increment('singleflight_calls_total', group=self.name, role='leader' if leader else 'shared')
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError(f"The {self.name} call in flight did not return within {timeout}s")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self) -> int:
+        """The number of calls in flight."""
+        return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    Async version of SingleFlight, for the coroutines of an event loop.
+
+    The call runs as a task of its own, so a caller that is cancelled (e.g. by its
+    deadline) does not cancel the call for the other callers.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]], timeout: Optional[float] = None):
+        """
+        Async version of SingleFlight.do, fn is a coroutine function.
+
+        Raises:
+        TimeoutError: If the call in flight did not return within the timeout.
+        """
+        loop = asyncio.get_running_loop()
+        call_key = (loop, key)
+
+        task = self._calls.get(call_key)
+        leader = task is None
+        if leader:
+            task = self._calls[call_key] = loop.create_task(fn())
+            task.add_done_callback(lambda done: self._finish(call_key, done))
+
+        metrics.increment('singleflight_calls_total', group=self.name, role='leader' if leader else 'shared')
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            if task.done():
+                raise
+            raise TimeoutError(f"The {self.name} call in flight did not return within {timeout}s") from None
+
+    def _finish(self, call_key: tuple, task: asyncio.Task):
+        if self._calls.get(call_key) is task:
+            del self._calls[call_key]
+        # Mark the exception as retrieved, the callers that waited for it have raised it already
+        if not task.cancelled():
+            task.exception()
+
+    def in_flight(self) -> int:
+        """The number of calls in flight."""
+        return len(self._calls)
@@ -0,0 +1,140 @@
+from collections import deque
+from typing import Iterable, List, Tuple
+
+from .util import get_env
+
+
+# The length of the snippets of the search results in characters
+SNIPPET_LENGTH = int(get_env('SEARCH_SNIPPET_LENGTH', 300))
+
+
+def _lower(text: str) -> str:
+    """Lowercases text without changing its length, so offsets stay valid."""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return ''.join(c if len(c.lower()) != 1 else c.lower() for c in text)
+
+
+class KeywordMatcher:
+    """
+    Finds all keywords in a text in a single pass (Aho-Corasick automaton).
+
+    Matching is case insensitive and a match has to start at the beginning of a word,
+    like the prefix matching of the keyword search ("miet" matches "Mietvertrag").
+    The automaton is built once per search and reused for all results.
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        # Trie transitions, failure links and the keyword lengths that end in each node
+        self.goto = [{}]
+        self.fail = [0]
+        self.lengths = [()]
+
+        for keyword in {_lower(k.strip()) for k in keywords if k and k.strip()}:
+            node = 0
+            for char in keyword:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.lengths.append(())
+                node = next_node
+            self.lengths[node] = (len(keyword),)
+
+        # Breadth first, so the failure link of every parent is known before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_node] = self.goto[fail].get(char, 0)
+                self.lengths[next_node] = tuple(sorted(
+                    set(self.lengths[next_node] + self.lengths[self.fail[next_node]]), reverse=True
+                ))
+
+    def __bool__(self):
+        return len(self.goto) > 1
+
+    def find(self, text: str) -> List[Tuple[int, int]]:
+        """
+        Returns the (start, end) offsets of the keywords in the text.
+
+        Overlapping matches are resolved leftmost-longest, so the result is sorted and
+        free of overlaps.
+        """
+        if not self:
+            return []
+
+        goto, fail, lengths = self.goto, self.fail, self.lengths
+        matches = []
+        node = 0
+        for i, char in enumerate(_lower(text)):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            for length in lengths[node]:
+                start = i - length + 1
+                if start == 0 or not text[start - 1].isalnum():
+                    matches.append((start, i + 1))
+                    break
+
+        matches.sort(key=lambda match: (match[0], -match[1]))
+        resolved = []
+        for start, end in matches:
+            if not resolved or start >= resolved[-1][1]:
+                resolved.append((start, end))
+        return resolved
+
+
+def make_snippet(text: str, matcher: KeywordMatcher = None, length: int = None) -> dict:
+    """
+    Cuts the part of a text with the most keyword matches.
+
+    Parameters:
+    text (str): The text of the law.
+    matcher (KeywordMatcher): The keywords of the search, None for the beginning of the text.
+    length (int): The maximum length of the snippet, defaults to SNIPPET_LENGTH.
+
+    Returns:
+    dict: The snippet and the [start, end] offsets of the keywords within the snippet.
+    """
+    length = length or SNIPPET_LENGTH
+    matches = matcher.find(text) if matcher else []
+
+    # The window of the given length that starts at a match and covers most matches
+    start, best, last = 0, 0, 0
+    for first in range(len(matches)):
+        while last < len(matches) and matches[last][1] <= matches[first][0] + length:
+            last += 1
+        if last - first > best:
+            start, best = matches[first][0], last - first
+
+    # Show a bit of the text before the first match, without cutting words
+    anchor = start
+    if best:
+        start = max(0, start - length // 6)
+    if start > 0:
+        space = text.find(' ', start, anchor)
+        start = space + 1 if space != -1 else start
+
+    end = min(len(text), start + length)
+    if end < len(text):
+        space = text.rfind(' ', start, end)
+        end = space if space > anchor else end
+
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if end < len(text) else ''
+    highlights = [
+        [match_start - start + len(prefix), match_end - start + len(prefix)]
+        for match_start, match_end in matches
+        if match_start >= start and match_end <= end
+    ]
+
+    return {'snippet': prefix + text[start:end] + suffix, 'highlights': highlights}
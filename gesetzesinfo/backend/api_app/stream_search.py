@@ -0,0 +1,181 @@
+import json
+import logging
+import time
+from typing import Iterator
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpRequest, StreamingHttpResponse
+
+from .models import EmbeddedLaw
+from .analytics import log_search
+from .result_cache import result_cache_key, get_cached_results, cache_results
+from .search import (
+    get_embedding, query_to_keywords_llm, natural_language_search, multi_keyword_search,
+    filter_vector_results, combine_search_results, build_final_results, results_from_cache,
+    parse_search_query, submit_search_task, keyword_fallback,
+)
+from .deadline import Deadline
+from .timing import stage
+
+
+logger = logging.getLogger(__name__)
+
+
+def smart_search_stream(query: str, max_results: int = 32, deadline: Deadline = None) -> Iterator[dict]:
+    """
+    Streaming version of smart_search, yields the results as they become available.
+
+    The vector search usually finishes long before the keyword extraction of the llm.
+    Its hits are final (the keyword search only adds laws), so they are sent right away:
+
+        results  the ranked vector search hits, snippets without keyword highlights
+        merge    the hits found by the keyword search (and re-rated with the query embedding)
+        update   id, snippet, highlights, show_id and query_id of every result, now that the
+                 keywords are known: the final order of the combined results
+        done     the number of results and the meta data of the deadline (degradations)
+        error    the search failed, nothing follows
+
+    If the vector search fails, the search degrades to keyword only results (see
+    Deadline.degrade): the results event is empty and all hits arrive with merge.
+
+    A search that is answered from the result cache sends all results at once.
+    Every event carries the milliseconds since the search started (elapsed_ms).
+
+    Parameters:
+    query (str): The search query.
+    max_results (int): The maximum number of results to return. Defaults to 32.
+    deadline (Deadline): The budget of the search, defaults to SEARCH_DEADLINE. A keyword
+                         search that does not finish in time is dropped (vector only), a
+                         failed vector search leaves the keyword results (keyword only).
+
+    Yields:
+    dict: The events, with their type in the field "event".
+    """
+    start = time.perf_counter()
+    deadline = deadline or Deadline()
+
+    def event(name: str, **fields) -> dict:
+        return {'event': name, 'elapsed_ms': round((time.perf_counter() - start) * 1000, 1), **fields}
+
+    try:
+        with stage('result_cache'):
+            cache_key = result_cache_key(query, max_results)
+            cached = get_cached_results(cache_key)
+        if cached is not None:
+            results = results_from_cache(query, cached)
+            yield event('results', results=results)
+            yield event('done', count=len(results), meta=deadline.meta())
+            return
+
+        max_nl_results = int(max_results * 2.0)
+        max_keyword_results = int(max_results * 2.0)
+
+        def keyword_branch():
+            with stage('keywords'):
+                keywords = query_to_keywords_llm(query, deadline=deadline)
+            with stage('keyword_search'):
+                return keywords, multi_keyword_search(keywords, max_keyword_results)
+
+        # The keyword branch runs in the background while the vector hits are sent
+        keyword_future = submit_search_task(keyword_branch)
+
+        # A failed vector search degrades to keyword only results, like in smart_search
+        try:
+            with stage('embedding'):
+                query_embedding = get_embedding(query, deadline)
+            with stage('vector_search'):
+                nl_search_results = natural_language_search(query_embedding, max_nl_results)
+            vector_error = None
+        except Exception as e:
+            deadline.degrade('vector_search', 'keyword_only', e)
+            query_embedding, nl_search_results, vector_error = None, [], e
+
+        vector_results = filter_vector_results(nl_search_results, max_results)
+        with stage('hydration'):
+            laws = {
+                law.law_id: law
+                for law in EmbeddedLaw.objects.for_results().filter(law_id__in=[r['law_id'] for r in vector_results])
+            }
+        yield event('results', results=build_final_results(list(laws.values()), vector_results, None))
+
+        try:
+            keywords, keyword_search_results = keyword_future.result(timeout=deadline.remaining())
+        except Exception as e:
+            keywords, keyword_search_results = keyword_fallback(query, deadline, e)
+
+        if vector_error is not None and not keyword_search_results:
+            raise vector_error
+
+        search_results = combine_search_results(nl_search_results, keyword_search_results, query_embedding, max_results)
+
+        # Only the laws found by the keyword search still have to be read
+        new_law_ids = [r['law_id'] for r in search_results if r['law_id'] not in laws]
+        if new_law_ids:
+            with stage('hydration'):
+                laws.update((law.law_id, law) for law in EmbeddedLaw.objects.for_results().filter(law_id__in=new_law_ids))
+
+        result_laws = [laws[law_id] for law_id in dict.fromkeys(r['law_id'] for r in search_results) if law_id in laws]
+
+        query_id = None
+        if query_embedding is not None:
+            try:
+                with stage('logging'):
+                    query_id = log_search(query, query_embedding, [law.id for law in result_laws])
+            except Exception as e:
+                logger.warning("Logging the search failed: %s", e)
+
+        final_results = build_final_results(result_laws, search_results, query_id, keywords)
+        if deadline.cacheable:
+            cache_results(cache_key, final_results, query_embedding)
+
+        new_ids = {law.id for law in result_laws if law.law_id in new_law_ids}
+        yield event('merge', results=[result for result in final_results if result['id'] in new_ids])
+        yield event('update', results=[
+            {key: result[key] for key in ('id', 'snippet', 'highlights', 'show_id', 'query_id')}
+            for result in final_results
+        ])
+        yield event('done', count=len(final_results), meta=deadline.meta())
+
+    except Exception as e:
+        yield event('error', error=f"Error searching for query: {str(e)}", meta=deadline.meta())
+
+
+def ndjson_event(event: dict) -> str:
+    """Formats an event as one line of newline delimited JSON."""
+    return json.dumps(event, cls=DjangoJSONEncoder) + '\n'
+
+
+def sse_event(event: dict) -> str:
+    """Formats an event as server-sent event, the type of the event is its SSE event name."""
+    fields = {key: value for key, value in event.items() if key != 'event'}
+    return f"event: {event['event']}\ndata: {json.dumps(fields, cls=DjangoJSONEncoder)}\n\n"
+
+
+def stream_search_endpoint(request: HttpRequest):
+    """
+    Streaming version of search_endpoint, see smart_search_stream for the events.
+
+    Parameters:
+    request (HttpRequest): The HTTP request with the following query parameters:
+        q (str): The search query
+        format (str): ndjson (default) or sse. Clients that accept text/event-stream get sse.
+
+    Returns:
+    StreamingHttpResponse: The events, or a JsonResponse with the error of an invalid query.
+    """
+    query, error_response = parse_search_query(request)
+    if error_response:
+        return error_response
+
+    sse = request.GET.get('format') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+    events = smart_search_stream(query)
+
+    if sse:
+        response = StreamingHttpResponse((sse_event(event) for event in events), content_type='text/event-stream')
+    else:
+        response = StreamingHttpResponse((ndjson_event(event) for event in events), content_type='application/x-ndjson')
+
+    # Every event has to reach the client right away, not when a proxy buffer is full
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -6,4 +6,12 @@ def long_running_task():
     print("Task Started")
     time.sleep(5)  # Simulate a long-running task
     print("Task Finished")
-    return "Task Completed"
\ No newline at end of file
+    return "Task Completed"
+
+@shared_task(ignore_result=True)
+def write_search_events_task(events):
+    """
+    Writes search events queued with SEARCH_LOG_MODE=celery (see analytics.log_search).
+    """
+    from .analytics import write_search_events, event_from_json
+    write_search_events([event_from_json(event) for event in events])
@@ -0,0 +1,290 @@
+import os
+import threading
+from collections import Counter
+from typing import List, Dict
+
+import numpy as np
+from scipy import sparse
+
+from .models import EmbeddedLaw
+from .util import get_env, data_path, tokenize
+
+
+TERM_STATS_PATH = data_path('law_term_stats.npz')
+
+# Every title token counts like this many text tokens
+TITLE_BOOST = 3
+
+# Query tokens with at least this many characters also match longer words they are a prefix of
+MIN_PREFIX_LENGTH = 3
+MAX_PREFIX_EXPANSIONS = 64
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def bm25_weights(counts: sparse.csr_matrix, doc_lengths: np.ndarray, idf: np.ndarray) -> sparse.csr_matrix:
+    """Okapi BM25 weight of every term in every law."""
+    avg_length = max(float(doc_lengths.mean()), 1.0)
+    row_lengths = np.repeat(doc_lengths, np.diff(counts.indptr))
+    tf = counts.data
+    norm = BM25_K1 * (1.0 - BM25_B + BM25_B * row_lengths / avg_length)
+    data = idf[counts.indices] * tf * (BM25_K1 + 1.0) / (tf + norm)
+    return sparse.csr_matrix((data.astype(np.float32), counts.indices, counts.indptr), shape=counts.shape)
+
+
+def tfidf_weights(counts: sparse.csr_matrix, doc_lengths: np.ndarray, idf: np.ndarray) -> sparse.csr_matrix:
+    """Length normalized tf-idf weight of every term in every law."""
+    row_lengths = np.repeat(np.maximum(doc_lengths, 1), np.diff(counts.indptr))
+    data = idf[counts.indices] * counts.data / row_lengths
+    return sparse.csr_matrix((data.astype(np.float32), counts.indices, counts.indptr), shape=counts.shape)
+
+
+SCORING_FUNCTIONS = {
+    'bm25': bm25_weights,
+    'tfidf': tfidf_weights,
+}
+
+
+class TermStats:
+    """
+    Precomputed term statistics of all laws, used to score keyword search results.
+
+    Holds the per law token counts as sparse law x term matrix, the document lengths
+    and the idf of every term. The weights of the selected scoring function are
+    computed once when the statistics are loaded, so scoring a set of candidates is a
+    single sparse matrix-vector product.
+    """
+
+    def __init__(self, law_ids: np.ndarray, terms: np.ndarray, counts: sparse.csr_matrix, doc_lengths: np.ndarray, scoring: str = 'bm25'):
+        self.law_ids = law_ids
+        self.terms = terms
+        self.counts = counts
+        self.doc_lengths = doc_lengths
+
+        self.row_of = {int(law_id): row for row, law_id in enumerate(law_ids)}
+        self.column_of = {str(term): column for column, term in enumerate(terms)}
+
+        document_count = len(law_ids)
+        document_frequency = np.bincount(counts.indices, minlength=len(terms))
+        self.idf = np.log(1.0 + (document_count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+        self.weights = SCORING_FUNCTIONS[scoring](counts, doc_lengths, self.idf)
+
+    @classmethod
+    def build(cls, laws, scoring: str = 'bm25') -> 'TermStats':
+        """
+        Builds the statistics from (law_id, title, text) tuples.
+        """
+        vocabulary = {}
+        law_ids, doc_lengths = [], []
+        indptr, indices, data = [0], [], []
+
+        for law_id, title, text in laws:
+            title_counts = Counter(tokenize(title))
+            counts = Counter(tokenize(text))
+            for term, count in title_counts.items():
+                counts[term] += TITLE_BOOST * count
+
+            for term, count in counts.items():
+                indices.append(vocabulary.setdefault(term, len(vocabulary)))
+                data.append(count)
+            indptr.append(len(indices))
+
+            law_ids.append(law_id)
+            doc_lengths.append(sum(counts.values()))
+
+        # Sort the vocabulary, so prefixes can be looked up with a binary search
+        terms = np.array(sorted(vocabulary), dtype=str)
+        remap = np.empty(len(vocabulary), dtype=np.int32)
+        for column, term in enumerate(terms):
+            remap[vocabulary[term]] = column
+
+        counts = sparse.csr_matrix(
+            (np.array(data, dtype=np.float32), remap[np.array(indices, dtype=np.int32)], np.array(indptr, dtype=np.int64)),
+            shape=(len(law_ids), len(terms))
+        )
+        counts.sort_indices()
+
+        return cls(np.array(law_ids, dtype=np.int64), terms, counts, np.array(doc_lengths, dtype=np.float32), scoring)
+
+    def save(self, path: str):
+        """Saves the statistics atomically, so other workers never read a half written file."""
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            law_ids=self.law_ids,
+            terms=self.terms,
+            data=self.counts.data,
+            indices=self.counts.indices,
+            indptr=self.counts.indptr,
+            doc_lengths=self.doc_lengths,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, scoring: str = 'bm25') -> 'TermStats':
+        with np.load(path) as stats:
+            law_ids, terms = stats['law_ids'], stats['terms']
+            counts = sparse.csr_matrix(
+                (stats['data'], stats['indices'], stats['indptr']),
+                shape=(len(law_ids), len(terms))
+            )
+            return cls(law_ids, terms, counts, stats['doc_lengths'], scoring)
+
+    def query_vector(self, keywords: List[str]) -> Dict[int, float]:
+        """
+        Maps the keywords to term columns. Every word of a keyword counts once, words
+        that are long enough also match all terms they are a prefix of.
+        """
+        query = Counter()
+        for token in set(token for keyword in keywords for token in tokenize(keyword)):
+            if len(token) < MIN_PREFIX_LENGTH:
+                column = self.column_of.get(token)
+                if column is not None:
+                    query[column] += 1.0
+                continue
+
+            start = np.searchsorted(self.terms, token, side='left')
+            end = np.searchsorted(self.terms, token + '\uffff', side='left')
+            for column in range(start, min(end, start + MAX_PREFIX_EXPANSIONS)):
+                query[column] += 1.0
+
+        return query
+
+    def score(self, law_ids: List[int], keywords: List[str]) -> np.ndarray:
+        """
+        Scores the given laws against the keywords.
+
+        Parameters:
+        law_ids (list): The laws to score.
+        keywords (list): The keywords of the query.
+
+        Returns:
+        np.ndarray: One score per law, 0 for laws without statistics or matching terms.
+        """
+        scores = np.zeros(len(law_ids), dtype=np.float32)
+        query = self.query_vector(keywords)
+        if not query or not law_ids:
+            return scores
+
+        positions, rows = [], []
+        for position, law_id in enumerate(law_ids):
+            row = self.row_of.get(int(law_id))
+            if row is not None:
+                positions.append(position)
+                rows.append(row)
+        if not rows:
+            return scores
+
+        columns = np.fromiter(query.keys(), dtype=np.int64)
+        values = np.fromiter(query.values(), dtype=np.float32)
+
+        # One sparse matrix-vector product over the candidate rows and query columns
+        scores[positions] = self.weights[rows][:, columns] @ values
+        return scores
+
+    def score_batch(self, law_id_lists: List[List[int]], keyword_lists: List[List[str]]) -> List[np.ndarray]:
+        """
+        Scores the candidates of several queries at once, like score.
+
+        The queries are stacked into one sparse term x query matrix, so all candidates
+        of all queries are scored with a single sparse matrix product.
+
+        Parameters:
+        law_id_lists (list): The laws to score, one list per query.
+        keyword_lists (list): The keywords, one list per query.
+
+        Returns:
+        list: One array of scores per query.
+        """
+        query_columns, query_indices, query_values = [], [], []
+        for i, keywords in enumerate(keyword_lists):
+            for column, value in self.query_vector(keywords).items():
+                query_columns.append(column)
+                query_indices.append(i)
+                query_values.append(value)
+
+        positions = [[] for _ in law_id_lists]
+        candidate_rows = [[] for _ in law_id_lists]
+        for i, law_ids in enumerate(law_id_lists):
+            for position, law_id in enumerate(law_ids):
+                row = self.row_of.get(int(law_id))
+                if row is not None:
+                    positions[i].append(position)
+                    candidate_rows[i].append(row)
+
+        scores = [np.zeros(len(law_ids), dtype=np.float32) for law_ids in law_id_lists]
+        all_rows = [row for rows in candidate_rows for row in rows]
+        if not query_values or not all_rows:
+            return scores
+
+        # Only the rows of the candidates and the columns of the keywords take part
+        rows, row_index = np.unique(np.array(all_rows, dtype=np.int64), return_inverse=True)
+        columns, column_index = np.unique(np.array(query_columns, dtype=np.int64), return_inverse=True)
+        queries = sparse.csr_matrix(
+            (np.array(query_values, dtype=np.float32), (column_index, np.array(query_indices))),
+            shape=(len(columns), len(keyword_lists))
+        )
+        product = (self.weights[rows][:, columns] @ queries).toarray()
+
+        offset = 0
+        for i, query_positions in enumerate(positions):
+            count = len(query_positions)
+            scores[i][query_positions] = product[row_index[offset:offset + count], i]
+            offset += count
+        return scores
+
+
+def build_term_stats(path: str = TERM_STATS_PATH) -> TermStats:
+    """
+    Builds the term statistics from the EmbeddedLaw table and saves them to disk.
+
+    Parameters:
+    path (str): Where to save the statistics.
+
+    Returns:
+    TermStats: The new statistics.
+    """
+    laws = EmbeddedLaw.objects.values_list('law_id', 'title', 'text').iterator()
+    stats = TermStats.build(laws, get_env('KEYWORD_SCORING', 'bm25'))
+    stats.save(path)
+    print(f"Built term statistics for {len(stats.law_ids)} laws and {len(stats.terms)} terms")
+
+    _loaded.update(stats=stats, stamp=_file_stamp(path))
+    return stats
+
+
+_loaded = {'stats': None, 'stamp': None}
+_load_lock = threading.Lock()
+
+
+def _file_stamp(path: str):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def get_term_stats(path: str = TERM_STATS_PATH) -> TermStats:
+    """
+    Returns the term statistics of this worker. They are loaded once, reloaded when the
+    file changes and built from the database if no file exists yet.
+
+    Returns:
+    TermStats: The term statistics.
+    """
+    stamp = _file_stamp(path)
+    if _loaded['stats'] is not None and stamp in (None, _loaded['stamp']):
+        return _loaded['stats']
+
+    with _load_lock:
+        if _loaded['stats'] is not None and _loaded['stamp'] == stamp:
+            return _loaded['stats']
+        if stamp is None:
+            return build_term_stats(path)
+
+        _loaded.update(stats=TermStats.load(path, get_env('KEYWORD_SCORING', 'bm25')), stamp=stamp)
+        return _loaded['stats']
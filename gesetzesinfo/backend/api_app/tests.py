@@ -1,3 +1,1256 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import faiss
+import numpy as np
+from django.http import JsonResponse
+from django.test import RequestFactory, TestCase
+
+from . import analytics, batch_search, clients, deadline, embedding_matrix, embedding_store, endpoints, quantization, result_cache, search, stream_search
+from .embedding_batcher import EmbeddingBatcher
+from .embedding_cache import QueryEmbeddingCache
+from .embedding_matrix import EmbeddingMatrix
+from .keyword_index import build_fts_query, ensure_keyword_index, search_keyword_index
+from .local_keywords import KeywordModel, stem
+from .metrics import Histogram, MetricsRegistry, metrics
+from .middleware import ServerTimingMiddleware
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .snippets import KeywordMatcher, make_snippet
+from .models import CachedEmbedding, EmbeddedLaw, SearchQuery, SearchRequest, SearchResponse
+from .quantization import BLOB_HEADER_SIZE, BLOB_MARKER, decode_embedding, dequantize, encode_embedding, quantize_matrix, quantize_rows
+from .term_stats import TermStats
+from .timing import stage
+from .vector_index import VectorIndex
+
+
+LAWS = [
+    ('Kündigung des Mietvertrags', 'Der Mietvertrag kann von beiden Seiten schriftlich gekündigt werden.'),
+    ('Miete', 'Die Miete ist zu Beginn eines jeden Monats zu zahlen.'),
+    ('Mietminderung', 'Ist die Mietsache mangelhaft, ist der Mieter von der Entrichtung der Miete befreit.'),
+    ('Diebstahl', 'Wer eine fremde bewegliche Sache einem anderen wegnimmt, wird bestraft.'),
+    ('Kaufvertrag', 'Durch den Kaufvertrag wird der Verkäufer einer Sache verpflichtet.'),
+    ('Schenkung', 'Eine Zuwendung, durch die jemand einen anderen bereichert, ist Schenkung.'),
+]
+DIMS = 8
+
+
+def run_inline(fn, *args, **kwargs) -> Future:
+    """Runs a search stage in the calling thread, so its queries use the connection of the test."""
+    future = Future()
+    future.set_result(fn(*args, **kwargs))
+    return future
+
+
+class SearchTestCase(TestCase):
+    """
+    The laws and their embeddings shared by the search tests.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # Outside of the test transactions: SQLite breaks the connection when the creation
+        # of a virtual table is rolled back. Its triggers index the laws of every test.
+        ensure_keyword_index()
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = np.random.default_rng(0)
+        cls.embeddings = rng.standard_normal((len(LAWS), DIMS)).astype(np.float32)
+
+        EmbeddedLaw.objects.bulk_create([
+            EmbeddedLaw(
+                law_id=100 + i,
+                book_code='BGB',
+                title=title,
+                text=text,
+                text_reduced=text[:EmbeddedLaw.reduced_text_length],
+                embedding_base=encode_embedding(embedding, 'float32'),
+                embedding_optimized=encode_embedding(embedding, 'float32'),
+            ) for i, ((title, text), embedding) in enumerate(zip(LAWS, cls.embeddings))
+        ])
+
+
+class SmartSearchQueryCountTests(SearchTestCase):
+    """
+    Pins the number of database queries of one search.
+
+    The upstream apis and the FAISS index are replaced, the embedding matrix and the
+    term statistics are built in memory. Everything that reads the database runs for real.
+    """
+
+    def setUp(self):
+        law_ids = np.array([100 + i for i in range(len(LAWS))], dtype=np.int64)
+        matrix = EmbeddingMatrix(law_ids, self.embeddings)
+        term_stats = TermStats.build((100 + i, title, text) for i, (title, text) in enumerate(LAWS))
+
+        patches = [
+            mock.patch.object(search, 'get_embedding', return_value=self.embeddings[0]),
+            mock.patch.object(search, 'query_to_keywords_llm', return_value=['Mietvertrag', 'Miete']),
+            mock.patch.object(search, 'natural_language_search', return_value=[
+                {'law_id': 100, 'score': 0.9}, {'law_id': 102, 'score': 0.5}, {'law_id': 103, 'score': 0.2},
+            ]),
+            mock.patch.object(search, 'get_embedding_matrix', return_value=matrix),
+            mock.patch.object(search, 'get_term_stats', return_value=term_stats),
+            mock.patch.object(search, 'submit_search_task', side_effect=run_inline),
+            # The writer thread would share the connection of the test
+            mock.patch.object(analytics.search_log_queue, 'put', return_value=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        result_cache.result_cache.clear()
+
+    def test_queued_logging(self):
+        # Keyword index and hydration, the search log is written behind the request
+        with self.assertNumQueries(2):
+            results = search.smart_search('Kann ich meinen Mietvertrag kündigen?')
+
+        self.assertTrue(results)
+        self.assertIsNone(results[0]['query_id'])
+        event = analytics.search_log_queue.put.call_args[0][0]
+        self.assertEqual(len(event['law_ids']), len(results))
+        self.assertEqual(SearchQuery.objects.count(), 0)
+
+    def test_sync_logging_new_query(self):
+        # Keyword index, hydration and the search log in one transaction (savepoint, SearchQuery lookup,
+        # SearchRequest insert, SearchRequest ids, SearchQuery insert, SearchQuery ids, SearchResponse,
+        # its laws, release)
+        with mock.patch.object(analytics, 'SEARCH_LOG_MODE', 'sync'):
+            with self.assertNumQueries(11):
+                results = search.smart_search('Kann ich meinen Mietvertrag kündigen?')
+
+        self.assertEqual(results[0]['query_id'], SearchQuery.objects.get().id)
+        self.assertEqual(SearchResponse.objects.get().laws.count(), len(results))
+
+    def test_sync_logging_repeated_query(self):
+        with mock.patch.object(analytics, 'SEARCH_LOG_MODE', 'sync'):
+            search.smart_search('Kann ich meinen Mietvertrag kündigen?')
+
+            # Served from the result cache, only the search log is written: savepoint,
+            # SearchQuery lookup, SearchRequest insert, SearchResponse, its laws, release
+            with self.assertNumQueries(6):
+                results = search.smart_search('Kann ich meinen Mietvertrag kündigen?')
+
+        self.assertEqual(SearchRequest.objects.count(), 1)
+        self.assertEqual(SearchResponse.objects.count(), 2)
+        self.assertIn('Kündigung des Mietvertrags', [result['title'] for result in results])
+
+    def test_batched_search_log(self):
+        laws = list(EmbeddedLaw.objects.values_list('id', flat=True))
+        events = [
+            analytics.search_event(query, self.embeddings[0], laws[:3])
+            for query in ('Miete zahlen', 'Mietvertrag kündigen', 'Miete zahlen')
+        ]
+
+        # One statement per table, no matter how many events the batch holds
+        with self.assertNumQueries(9):
+            query_ids = analytics.write_search_events(events)
+
+        self.assertEqual(set(query_ids), {'Miete zahlen', 'Mietvertrag kündigen'})
+        self.assertEqual(SearchRequest.objects.count(), 2)
+        self.assertEqual(SearchResponse.objects.count(), 3)
+        self.assertEqual(SearchResponse.laws.through.objects.count(), 9)
+
+    def test_cached_results(self):
+        results = search.smart_search('Kann ich meinen Mietvertrag kündigen?')
+
+        # Same normalized query: no upstream call, no database query, but still logged
+        search.natural_language_search.reset_mock()
+        with self.assertNumQueries(0):
+            cached = search.smart_search('kann ich meinen  Mietvertrag kündigen')
+
+        self.assertEqual(cached, results)
+        search.natural_language_search.assert_not_called()
+        self.assertEqual(analytics.search_log_queue.put.call_count, 2)
+
+    def test_result_cache_follows_search_version(self):
+        search.smart_search('Kann ich meinen Mietvertrag kündigen?')
+
+        # A rebuilt index (or new embeddings, term statistics) changes the key
+        with mock.patch.object(result_cache, 'search_version', return_value='rebuilt'):
+            search.natural_language_search.reset_mock()
+            search.smart_search('Kann ich meinen Mietvertrag kündigen?')
+
+        search.natural_language_search.assert_called_once()
+
+    def test_negative_caching(self):
+        with mock.patch.object(search, 'combine_search_results', return_value=[]):
+            self.assertEqual(search.smart_search('Gibt es nicht'), [])
+
+        with mock.patch.object(result_cache.result_cache, 'set') as cache_set:
+            with self.assertNumQueries(0):
+                self.assertEqual(search.smart_search('Gibt es nicht'), [])
+        cache_set.assert_not_called()
+
+    def test_results_carry_snippets_instead_of_texts(self):
+        results = search.smart_search('Kann ich meinen Mietvertrag kündigen?')
+
+        for result in results:
+            self.assertNotIn('text', result)
+            self.assertIn('snippet', result)
+            self.assertIn('book_code', result)
+
+
+class WriteBehindQueueTests(TestCase):
+
+    def test_batches_and_back_pressure(self):
+        writing, release = threading.Event(), threading.Event()
+        batches = []
+
+        def flush(batch):
+            writing.set()
+            release.wait(5)
+            batches.append(batch)
+
+        write_behind = analytics.WriteBehindQueue(flush, max_size=2, batch_size=10, flush_interval=0.0)
+
+        # The first item is taken by the (blocked) writer, two more fill the queue
+        self.assertTrue(write_behind.put(1))
+        self.assertTrue(writing.wait(5))
+        self.assertTrue(write_behind.put(2))
+        self.assertTrue(write_behind.put(3))
+        self.assertFalse(write_behind.put(4))
+
+        release.set()
+        self.assertTrue(write_behind.join(5))
+        self.assertEqual(batches, [[1], [2, 3]])
+        self.assertEqual(write_behind.stats()['dropped'], 1)
+
+
+class BatchSearchTests(SearchTestCase):
+    """
+    The batch search with the upstream apis and the FAISS index replaced, like SmartSearchQueryCountTests.
+    """
+
+    def setUp(self):
+        law_ids = np.array([100 + i for i in range(len(LAWS))], dtype=np.int64)
+        self.term_stats = TermStats.build((100 + i, title, text) for i, (title, text) in enumerate(LAWS))
+
+        def index_search(embeddings, k):
+            # Every query finds the first, third and fourth law
+            count = len(embeddings)
+            return np.tile([[0.1, 1.0, 4.0]], (count, 1)).astype(np.float32), np.tile([[100, 102, 103]], (count, 1))
+
+        def embeddings(texts, deadline=None):
+            return self.embeddings[:len(texts)]
+
+        self.law_index = mock.Mock(search=mock.Mock(side_effect=index_search))
+        self.request_embeddings = mock.Mock(side_effect=embeddings)
+
+        patches = [
+            mock.patch.object(batch_search, 'request_embeddings', self.request_embeddings),
+            mock.patch.object(batch_search, 'law_index', self.law_index),
+            mock.patch.object(batch_search, 'query_to_keywords_llm', return_value=['Mietvertrag', 'Miete']),
+            mock.patch.object(batch_search, 'get_term_stats', return_value=self.term_stats),
+            mock.patch.object(batch_search, 'submit_search_task', side_effect=run_inline),
+            mock.patch.object(search, 'get_embedding_matrix', return_value=EmbeddingMatrix(law_ids, self.embeddings)),
+            mock.patch.object(analytics.search_log_queue, 'put', return_value=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        result_cache.result_cache.clear()
+
+    def test_one_upstream_call_and_one_index_search(self):
+        queries = ['Kann ich meinen Mietvertrag kündigen?', 'Wann ist die Miete zu zahlen?', 'Kann ich meinen Mietvertrag kündigen?']
+
+        # Embedding cache lookup and insert, one full text query per distinct query, hydration
+        with self.assertNumQueries(5):
+            results = batch_search.smart_search_batch(queries)
+
+        self.request_embeddings.assert_called_once_with(queries[:2], mock.ANY)
+        self.assertEqual(self.law_index.search.call_count, 1)
+        self.assertEqual(self.law_index.search.call_args[0][0].shape, (2, DIMS))
+        self.assertEqual(CachedEmbedding.objects.count(), 2)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], results[2])
+        self.assertIn('Kündigung des Mietvertrags', [result['title'] for result in results[0]])
+
+        # Answered from the result cache
+        with self.assertNumQueries(0):
+            self.assertEqual(batch_search.smart_search_batch(queries[:1]), results[:1])
+
+    def test_only_degraded_queries_are_not_cached(self):
+        queries = ['Kann ich meinen Mietvertrag kündigen?', 'Wann ist die Miete zu zahlen?']
+
+        def keywords(query, deadline=None):
+            # The llm does not answer in time for the second query
+            if query == queries[1]:
+                deadline.degrade('keywords', 'local_keywords', TimeoutError())
+                return search.query_to_keywords(query)
+            return ['Mietvertrag', 'Miete']
+
+        budget = deadline.Deadline()
+        with mock.patch.object(batch_search, 'query_to_keywords_llm', side_effect=keywords), \
+                mock.patch.object(result_cache.result_cache, 'set') as cache_set:
+            results = batch_search.smart_search_batch(queries, deadline=budget)
+
+        self.assertTrue(all(results))
+        self.assertEqual([call[0][0] for call in cache_set.call_args_list], [result_cache.result_cache_key(queries[0], 32)])
+        self.assertEqual(budget.meta()['degraded'], [
+            {'stage': 'keywords', 'fallback': 'local_keywords', 'reason': 'deadline', 'query': queries[1]},
+        ])
+
+    def test_bulk_keyword_scores_match_single_scores(self):
+        candidates = [[100, 101, 102, 999], [], [103, 104, 105]]
+        keywords = [['Mietvertrag', 'Miete'], ['Miete'], ['Sache', 'bestraft']]
+
+        for law_ids, kws, scores in zip(candidates, keywords, self.term_stats.score_batch(candidates, keywords)):
+            np.testing.assert_allclose(scores, self.term_stats.score(law_ids, kws), rtol=1e-6)
+
+    def test_endpoint_reports_errors_per_query(self):
+        factory = RequestFactory()
+
+        def post(body):
+            return batch_search.batch_search_endpoint(
+                factory.post('/api/search/batch/', data=body, content_type='application/json')
+            )
+
+        response = post({'queries': ['Mietvertrag kündigen', 'abc']})
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertTrue(results[0]['results'])
+        self.assertIn('error', results[1])
+
+        self.assertEqual(post({'queries': []}).status_code, 400)
+        self.assertEqual(batch_search.batch_search_endpoint(factory.get('/api/search/batch/')).status_code, 405)
+
+
+class StreamSearchTests(SearchTestCase):
+    """
+    The streaming search with the upstream apis and the FAISS index replaced, like SmartSearchQueryCountTests.
+    """
+
+    def setUp(self):
+        law_ids = np.array([100 + i for i in range(len(LAWS))], dtype=np.int64)
+        self.keywords = mock.Mock(return_value=['Mietvertrag', 'Miete'])
+
+        def submit_lazily(fn, *args, **kwargs):
+            # The background stage only runs when its result is needed
+            return mock.Mock(result=lambda timeout=None: fn(*args, **kwargs))
+
+        patches = [
+            mock.patch.object(stream_search, 'get_embedding', return_value=self.embeddings[0]),
+            mock.patch.object(stream_search, 'query_to_keywords_llm', self.keywords),
+            mock.patch.object(stream_search, 'natural_language_search', return_value=[
+                {'law_id': 100, 'score': 0.9}, {'law_id': 102, 'score': 0.5}, {'law_id': 103, 'score': 0.2},
+            ]),
+            mock.patch.object(stream_search, 'submit_search_task', side_effect=submit_lazily),
+            mock.patch.object(search, 'get_embedding_matrix', return_value=EmbeddingMatrix(law_ids, self.embeddings)),
+            mock.patch.object(search, 'get_term_stats', return_value=TermStats.build(
+                (100 + i, title, text) for i, (title, text) in enumerate(LAWS)
+            )),
+            mock.patch.object(analytics.search_log_queue, 'put', return_value=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        result_cache.result_cache.clear()
+
+    def test_vector_hits_before_keywords(self):
+        events = stream_search.smart_search_stream('Kann ich meinen Mietvertrag kündigen?')
+
+        first = next(events)
+        self.assertEqual(first['event'], 'results')
+        self.assertTrue(first['results'])
+        self.keywords.assert_not_called()
+
+        events = [first, *events]
+        self.assertEqual([event['event'] for event in events], ['results', 'merge', 'update', 'done'])
+
+        shown = {result['id'] for event in events[:2] for result in event['results']}
+        final = events[2]['results']
+        self.assertEqual({result['id'] for result in final}, shown)
+        self.assertEqual([result['show_id'] for result in final], list(range(1, len(final) + 1)))
+        self.assertEqual(events[3]['count'], len(final))
+
+        # Answered from the result cache at once
+        cached = list(stream_search.smart_search_stream('Kann ich meinen Mietvertrag kündigen?'))
+        self.assertEqual([event['event'] for event in cached], ['results', 'done'])
+        self.assertEqual([result['id'] for result in cached[0]['results']], [result['id'] for result in final])
+
+    def test_vector_failure_degrades_to_keyword_only(self):
+        with mock.patch.object(stream_search, 'natural_language_search', side_effect=RuntimeError('index missing')), \
+                mock.patch.object(result_cache.result_cache, 'set') as cache_set:
+            events = list(stream_search.smart_search_stream('Kann ich meinen Mietvertrag kündigen?'))
+
+        self.assertEqual([event['event'] for event in events], ['results', 'merge', 'update', 'done'])
+        self.assertEqual(events[0]['results'], [])
+        self.assertTrue(events[1]['results'])
+        self.assertEqual({result['id'] for result in events[2]['results']}, {result['id'] for result in events[1]['results']})
+        self.assertEqual([d['fallback'] for d in events[3]['meta']['degraded']], ['keyword_only'])
+
+        # Degraded results are not cached, without keyword hits the search fails
+        cache_set.assert_not_called()
+        self.keywords.return_value = ['Steuer']
+        with mock.patch.object(stream_search, 'get_embedding', side_effect=RuntimeError('upstream down')):
+            events = list(stream_search.smart_search_stream('Wie hoch ist die Steuer?'))
+        self.assertEqual([event['event'] for event in events], ['results', 'error'])
+
+    def test_formats(self):
+        event = {'event': 'done', 'elapsed_ms': 1.0, 'count': 2}
+        self.assertEqual(json.loads(stream_search.ndjson_event(event)), event)
+        self.assertEqual(stream_search.sse_event(event), 'event: done\ndata: {"elapsed_ms": 1.0, "count": 2}\n\n')
+
+        response = stream_search.stream_search_endpoint(RequestFactory().get('/api/search/stream/', {'q': 'Mietvertrag kündigen', 'format': 'sse'}))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertTrue(content.startswith('event: results\n'))
+        self.assertIn('\n\nevent: done\n', content)
+
+
+class DeadlineTests(SearchTestCase):
+    """
+    Stages that run out of budget fall back to their local alternative, like SmartSearchQueryCountTests.
+    """
+
+    def setUp(self):
+        law_ids = np.array([100 + i for i in range(len(LAWS))], dtype=np.int64)
+        self.llm = mock.Mock()
+        self.llm.with_options.return_value = self.llm
+
+        patches = [
+            mock.patch.object(search, 'get_embedding', return_value=self.embeddings[0]),
+            mock.patch.object(search, 'get_openai_client', return_value=self.llm),
+            mock.patch.object(search, 'natural_language_search', return_value=[
+                {'law_id': 100, 'score': 0.9}, {'law_id': 102, 'score': 0.5}, {'law_id': 103, 'score': 0.2},
+            ]),
+            mock.patch.object(search, 'get_embedding_matrix', return_value=EmbeddingMatrix(law_ids, self.embeddings)),
+            mock.patch.object(search, 'get_term_stats', return_value=TermStats.build(
+                (100 + i, title, text) for i, (title, text) in enumerate(LAWS)
+            )),
+            mock.patch.object(search, 'submit_search_task', side_effect=run_inline),
+            mock.patch.object(analytics.search_log_queue, 'put', return_value=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        search.keyword_cache.clear()
+        result_cache.result_cache.clear()
+
+    def test_llm_timeouts_fall_back_to_local_keywords(self):
+        self.llm.chat.completions.create.side_effect = TimeoutError('read timed out')
+        budget = deadline.Deadline(5.0)
+
+        with mock.patch.object(search.time, 'sleep') as sleep:
+            keywords = search.query_to_keywords_llm('Kann ich meinen Mietvertrag kündigen?', deadline=budget)
+
+        self.assertEqual(keywords, search.query_to_keywords(search.clear_text('Kann ich meinen Mietvertrag kündigen?')))
+        self.assertEqual(self.llm.chat.completions.create.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertLess(sleep.call_args_list[0][0][0], sleep.call_args_list[1][0][0])
+        self.llm.with_options.assert_called_with(timeout=mock.ANY)
+        self.assertEqual(budget.meta()['degraded'], [{'stage': 'keywords', 'fallback': 'local_keywords', 'reason': 'deadline'}])
+
+    def test_no_retry_without_budget(self):
+        self.llm.chat.completions.create.side_effect = ValueError('bad response')
+
+        with mock.patch.object(deadline, 'SEARCH_DEADLINE_RESERVE', 0.0), mock.patch.object(search.time, 'sleep') as sleep:
+            search.query_to_keywords_llm('Mietvertrag kündigen', deadline=deadline.Deadline(0.001))
+
+        self.assertEqual(self.llm.chat.completions.create.call_count, 1)
+        sleep.assert_not_called()
+
+    @mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test', 'GROQ_API_KEY': 'test'})
+    def test_shared_clients_leave_retries_to_the_caller(self):
+        with mock.patch.dict(clients._clients, clear=True):
+            self.assertEqual(clients.get_openai_client('llm').max_retries, 0)
+
+        async def async_client():
+            return clients.get_async_openai_client('openai')
+
+        self.assertEqual(asyncio.run(async_client()).max_retries, 0)
+
+    def test_late_keyword_search_gives_vector_only_results(self):
+        self.llm.chat.completions.create.return_value = mock.Mock(
+            choices=[mock.Mock(message=mock.Mock(content='{"keywords": ["Mietvertrag", "Miete"]}'))]
+        )
+
+        def keyword_search_times_out(fn, *args, **kwargs):
+            future = Future()
+            future.set_exception(TimeoutError())
+            return future
+
+        budget = deadline.Deadline()
+        with mock.patch.object(search, 'submit_search_task', side_effect=keyword_search_times_out):
+            with mock.patch.object(result_cache.result_cache, 'set') as cache_set:
+                results = search.smart_search('Kann ich meinen Mietvertrag kündigen?', deadline=budget)
+
+        # Only hits of the vector search, the keyword search would have added "Miete"
+        titles = [result['title'] for result in results]
+        self.assertIn('Kündigung des Mietvertrags', titles)
+        self.assertLessEqual(set(titles), {'Kündigung des Mietvertrags', 'Mietminderung', 'Diebstahl'})
+        self.assertEqual(budget.meta()['degraded'], [{'stage': 'keyword_search', 'fallback': 'vector_only', 'reason': 'deadline'}])
+
+        # Degraded results are not cached, the next search gets another chance
+        cache_set.assert_not_called()
+
+    def test_async_keywords_are_not_cached_until_the_refresh(self):
+        self.llm.chat.completions.create.return_value = mock.Mock(
+            choices=[mock.Mock(message=mock.Mock(content='{"keywords": ["Miete"]}'))]
+        )
+        query = 'Kann ich meinen Mietvertrag kündigen?'
+        refreshes = []
+
+        with mock.patch.object(search, 'KEYWORD_EXTRACTION_MODE', 'async'), \
+                mock.patch.object(search.keyword_refresh_executor, 'submit', side_effect=refreshes.append), \
+                mock.patch.object(search, 'multi_keyword_search', wraps=search.multi_keyword_search) as keyword_search:
+            budget = deadline.Deadline()
+            search.smart_search(query, deadline=budget)
+            self.assertEqual(budget.provisional, ['keywords'])
+            self.assertEqual(budget.meta()['degraded'], [])
+            self.assertNotEqual(keyword_search.call_args[0][0], ['Miete'])
+
+            # The refresh completes, the repeated search uses the llm keywords
+            self.assertEqual(len(refreshes), 1)
+            refreshes[0]()
+            search.smart_search(query)
+            self.assertEqual(keyword_search.call_args[0][0], ['Miete'])
+
+            # Those results are final and answered from the cache
+            search.smart_search(query)
+            self.assertEqual(keyword_search.call_count, 2)
+
+    def test_endpoint_reports_degradations(self):
+        self.llm.chat.completions.create.side_effect = TimeoutError()
+
+        with mock.patch.object(search.time, 'sleep'):
+            response = search.search_endpoint(RequestFactory().get('/api/search/', {'q': 'Mietvertrag kündigen'}))
+
+        meta = json.loads(response.content)['meta']
+        self.assertEqual([d['fallback'] for d in meta['degraded']], ['local_keywords'])
+        self.assertEqual(meta['deadline_ms'], round(deadline.SEARCH_DEADLINE * 1000))
+
+
+class FileResultCacheTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = result_cache.FileResultCache(directory.name, max_entries=8)
+
+    def test_expiry_and_eviction(self):
+        entry = {'results': [{'id': 1, 'score': np.float32(0.5)}], 'embedding': ''}
+
+        self.cache.set('expired', entry, ttl=-1)
+        self.assertIsNone(self.cache.get('expired'))
+
+        for i in range(16):
+            self.cache.set(f'key{i}', entry, ttl=60)
+        self.assertLessEqual(self.cache.stats()['entries'], 8)
+        self.assertEqual(self.cache.get('key15')['results'], [{'id': 1, 'score': 0.5}])
+
+
+class MetricsTests(TestCase):
+
+    def test_histogram_quantiles(self):
+        histogram = Histogram(buckets=(0.1, 0.2, 0.4))
+        self.assertIsNone(histogram.quantile(0.5))
+
+        for value in (0.05, 0.15, 0.15, 0.3, 5.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.cumulative_counts(), [1, 3, 4, 5])
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.175)
+        # Above the largest bucket only its bound is known
+        self.assertEqual(histogram.quantile(0.99), 0.4)
+
+    def test_prometheus_text(self):
+        registry = MetricsRegistry()
+        registry.increment('upstream_errors_total', upstream='llm')
+        registry.observe('search_stage_duration_seconds', 0.02, stage='embedding')
+        registry.observe('search_stage_duration_seconds', 0.3, stage='keywords')
+
+        text = registry.prometheus()
+        self.assertIn('# TYPE upstream_errors_total counter\nupstream_errors_total{upstream="llm"} 1\n', text)
+        self.assertIn('search_stage_duration_seconds_bucket{stage="embedding",le="0.025"} 1\n', text)
+        self.assertIn('search_stage_duration_seconds_bucket{stage="keywords",le="+Inf"} 1\n', text)
+        self.assertIn('search_stage_duration_seconds_count{stage="keywords"} 1\n', text)
+        self.assertIn('search_stage_duration_seconds_quantile{stage="keywords",quantile="0.95"}', text)
+
+    def test_server_timing_header(self):
+        def keywords():
+            with stage('keywords'):
+                pass
+
+        def view(request):
+            with stage('embedding'):
+                pass
+            # Stages on the search executor are reported with their request
+            search.submit_search_task(keywords).result()
+            with stage('hydration'), stage('hydration'):
+                pass
+            return JsonResponse({})
+
+        response = ServerTimingMiddleware(view)(RequestFactory().get('/api/search/'))
+
+        names = [part.split(';')[0] for part in response['Server-Timing'].split(', ')]
+        self.assertEqual(names, ['embedding', 'keywords', 'hydration', 'total'])
+        self.assertGreater(metrics.histogram('search_stage_duration_seconds', stage='embedding').count, 0)
+
+    def test_async_server_timing_header(self):
+        async def view(request):
+            with stage('embedding'):
+                await asyncio.sleep(0)
+            return JsonResponse({})
+
+        middleware = ServerTimingMiddleware(view)
+        response = asyncio.run(middleware(RequestFactory().get('/api/search/async/')))
+
+        self.assertTrue(response['Server-Timing'].startswith('embedding;dur='))
+
+    def test_metrics_endpoint(self):
+        with stage('vector_search'):
+            pass
+
+        response = endpoints.prometheus_metrics(RequestFactory().get('/metrics'))
+
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode('utf-8')
+        self.assertIn('search_stage_duration_seconds_bucket{stage="vector_search"', text)
+        self.assertIn('cache_hit_ratio{cache="result"}', text)
+
+
+def wait_for_waiters(group: str, count: int, before: float):
+    """Waits until count callers of a singleflight group joined a call in flight."""
+    for _ in range(500):
+        if metrics.get('singleflight_calls_total', group=group, role='shared') >= before + count:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError(f"{count} waiters did not join the {group} call")
+
+
+class SingleFlightTests(TestCase):
+
+    def test_concurrent_calls_share_one_call(self):
+        flights = SingleFlight('test_share')
+        release = threading.Event()
+        calls = []
+
+        def call():
+            calls.append(1)
+            release.wait(5)
+            return ['Mietvertrag']
+
+        before = metrics.get('singleflight_calls_total', group='test_share', role='shared')
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(flights.do, 'key', call) for _ in range(4)]
+            wait_for_waiters('test_share', 3, before)
+            release.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(flights.in_flight(), 0)
+
+        # The next call after the flight landed runs again
+        flights.do('key', call)
+        self.assertEqual(len(calls), 2)
+
+    def test_errors_and_timeouts(self):
+        flights = SingleFlight('test_errors')
+        release = threading.Event()
+
+        def failing():
+            release.wait(5)
+            raise ValueError('upstream failed')
+
+        before = metrics.get('singleflight_calls_total', group='test_errors', role='shared')
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            leader = pool.submit(flights.do, 'key', failing)
+            waiter = pool.submit(flights.do, 'key', failing)
+            wait_for_waiters('test_errors', 1, before)
+
+            # A waiter gives up after its timeout, the call goes on for the others
+            with self.assertRaises(TimeoutError):
+                flights.do('key', failing, timeout=0.01)
+
+            release.set()
+            for future in (leader, waiter):
+                with self.assertRaisesRegex(ValueError, 'upstream failed'):
+                    future.result()
+
+    def test_async_calls_share_one_task(self):
+        flights = AsyncSingleFlight('test_async')
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 42
+
+        async def run():
+            leader = asyncio.ensure_future(flights.do('key', call))
+            await asyncio.sleep(0)
+            waiters = [flights.do('key', call) for _ in range(3)]
+
+            # The leader is cancelled, the call goes on for the waiters
+            leader.cancel()
+            return await asyncio.gather(*waiters)
+
+        self.assertEqual(asyncio.run(run()), [42, 42, 42])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_concurrent_keyword_extractions_share_one_llm_call(self):
+        release = threading.Event()
+        response = mock.Mock(choices=[mock.Mock(message=mock.Mock(content='{"keywords": ["Mietvertrag", "kündigen"]}'))])
+
+        def create(**request):
+            release.wait(5)
+            return response
+
+        llm = mock.Mock()
+        llm.with_options.return_value = llm
+        llm.chat.completions.create.side_effect = create
+        search.keyword_cache.clear()
+
+        before = metrics.get('singleflight_calls_total', group='keywords', role='shared')
+        with mock.patch.object(search, 'get_openai_client', return_value=llm):
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                futures = [pool.submit(search.query_to_keywords_llm, query) for query in (
+                    'Mietvertrag kündigen', 'mietvertrag  kündigen', 'Mietvertrag kündigen', 'MIETVERTRAG kündigen',
+                )]
+                wait_for_waiters('keywords', 3, before)
+                release.set()
+                results = [future.result() for future in futures]
+
+        self.assertEqual(llm.chat.completions.create.call_count, 1)
+        self.assertEqual(results, [['Mietvertrag', 'kündigen']] * 4)
+
+
+class EmbeddingBatcherTests(TestCase):
+
+    def test_concurrent_queries_share_one_call(self):
+        calls = []
+
+        def embed_many(texts, deadline):
+            calls.append(texts)
+            return np.stack([np.full(DIMS, len(text), dtype=np.float32) for text in texts])
+
+        # The batch is sent once it is full, long before its window is over
+        batcher = EmbeddingBatcher(embed_many, window=5.0, max_size=4)
+        texts = ['Miete', 'Kaution', 'Miete', 'Eigenbedarf']
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            embeddings = list(pool.map(batcher.embed, texts))
+
+        self.assertEqual(len(calls), 1)
+        self.assertCountEqual(calls[0], ['Miete', 'Kaution', 'Eigenbedarf'])
+        for text, embedding in zip(texts, embeddings):
+            self.assertEqual(embedding[0], len(text))
+
+    def test_failed_call_fails_every_query(self):
+        embed_many = mock.Mock(side_effect=ValueError('upstream failed'))
+        batcher = EmbeddingBatcher(embed_many, window=0.01, max_size=8)
+
+        futures = [batcher.submit(text) for text in ('Miete', 'Kaution')]
+        for future in futures:
+            with self.assertRaisesRegex(ValueError, 'upstream failed'):
+                future.result(5)
+
+        # Queries without time left are not sent
+        expired = deadline.Deadline(0.001)
+        with mock.patch.object(expired, 'remaining', return_value=0.0):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                batcher.submit('Miete', expired).result(5)
+        self.assertEqual(embed_many.call_count, 1)
+
+
+THEFT_LAWS = [
+    ('Diebstahl', 'Wer eine fremde Sache entwendet, wird wegen Diebstahl bestraft, die Wegnahme genügt.'),
+    ('Diebstahl mit Waffen', 'Die Entwendung mit Waffen ist schwerer Diebstahl, wenn die Wegnahme gelingt.'),
+    ('Diebstahl geringwertiger Sachen', 'Wer geringwertige Sachen entwenden will, begeht Diebstahl durch Wegnahme.'),
+]
+
+
+class LocalKeywordTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Laws of other topics, so the theft terms are not common in the corpus
+        fillers = [(f"Vorschrift {i}", f"Text über Thema{i}") for i in range(15)]
+        cls.model = KeywordModel.build(THEFT_LAWS + LAWS + fillers)
+
+    def test_inflections_share_a_stem(self):
+        self.assertEqual({stem(word) for word in ('entwenden', 'entwendet', 'entwendung', 'entwendungen')}, {'entwend'})
+        self.assertEqual(stem('vermieters'), stem('vermietung'))
+        self.assertEqual(stem('107c'), '107c')
+
+    def test_keywords_are_expanded_from_the_corpus(self):
+        keywords = self.model.extract('Was ist ein Diebstahl?')
+
+        self.assertEqual(keywords[0], 'Diebstahl')
+        self.assertNotIn('Was', keywords)
+        self.assertIn('Wegnahme', keywords)
+        self.assertIn('entwendet', keywords)
+
+        # The other spellings of a term come before the related terms
+        keywords = self.model.extract('Entwendung')
+        self.assertEqual(keywords[:3], ['Entwendung', 'entwendet', 'entwenden'])
+        self.assertEqual(len(self.model.extract('Entwendung', max_keywords=2)), 2)
+
+        # Terms of every law and queries of stopwords only
+        self.assertNotIn('Text', self.model.extract('Text zur Miete'))
+        self.assertEqual(self.model.extract('was ist das'), ['was', 'ist', 'das'])
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/law_keyword_model.json"
+            self.model.save(path)
+            loaded = KeywordModel.load(path)
+
+        self.assertEqual(loaded.terms, self.model.terms)
+        self.assertEqual(loaded.extract('Diebstahl'), self.model.extract('Diebstahl'))
+
+    def test_extraction_modes(self):
+        response = mock.Mock(choices=[mock.Mock(message=mock.Mock(content='{"keywords": ["Diebstahl", "Wegnahme"]}'))])
+        llm = mock.Mock()
+        llm.with_options.return_value = llm
+        llm.chat.completions.create.return_value = response
+        search.keyword_cache.clear()
+
+        with mock.patch.object(search, 'get_openai_client', return_value=llm):
+            with mock.patch.object(search, 'KEYWORD_EXTRACTION_MODE', 'local'):
+                keywords = search.query_to_keywords_llm('Was ist Diebstahl?')
+            self.assertEqual(keywords, search.query_to_keywords('Was ist Diebstahl?'))
+            llm.chat.completions.create.assert_not_called()
+
+            # The search gets the local keywords, the llm keywords are cached for the next one
+            with mock.patch.object(search, 'KEYWORD_EXTRACTION_MODE', 'async'), \
+                    mock.patch.object(search.keyword_refresh_executor, 'submit', side_effect=lambda fn: fn()):
+                first = search.query_to_keywords_llm('Was ist Diebstahl?')
+                second = search.query_to_keywords_llm('Was ist Diebstahl?')
+
+        self.assertEqual(first, keywords)
+        self.assertEqual(second, ['Diebstahl', 'Wegnahme'])
+        self.assertEqual(llm.chat.completions.create.call_count, 1)
+
+
+class KeywordIndexTests(SearchTestCase):
+
+    def test_fts_query(self):
+        # Folded like the indexed texts, single words also match as prefix
+        self.assertEqual(build_fts_query(['Straße']), '"strasse"*')
+        self.assertEqual(build_fts_query(['Schäden', 'Schaeden']), '"schaeden"*')
+
+        # Phrases, short words and duplicates
+        self.assertEqual(build_fts_query(['fristlose Kündigung']), '"fristlose kuendigung"')
+        self.assertEqual(build_fts_query(['ab']), '"ab"')
+        self.assertEqual(build_fts_query(['Miete', 'miete']), '"miete"*')
+        self.assertEqual(build_fts_query(['!!']), '')
+
+    def test_prefix_and_folding(self):
+        self.assertEqual(set(search_keyword_index(['Miet'])), {100, 101, 102})
+        self.assertEqual(search_keyword_index(['Kündigung']), [100])
+        self.assertEqual(search_keyword_index(['Kuendigung']), [100])
+        self.assertEqual(search_keyword_index(['Verkaeufer']), [104])
+        self.assertEqual(search_keyword_index(['!!']), [])
+
+    def test_index_and_term_statistics_agree(self):
+        stats = TermStats.build((100 + i, title, text) for i, (title, text) in enumerate(LAWS))
+        for keyword in ('Kündigung', 'Kuendigung', 'Verkäufer', 'gekündigt'):
+            law_ids = search_keyword_index([keyword])
+            self.assertTrue(law_ids, keyword)
+            self.assertTrue(all(stats.score(law_ids, [keyword]) > 0), keyword)
+
+        # Laws that only share the base letter of an umlaut are different words
+        self.assertEqual(search_keyword_index(['Kundigung']), [])
+
+    def test_triggers_keep_the_index_in_sync(self):
+        law = EmbeddedLaw.objects.create(
+            law_id=200, book_code='StGB', title='Betrug', text='Wer einen Irrtum erregt, wird bestraft.',
+            text_reduced='', embedding_base=b'', embedding_optimized=b'',
+        )
+        self.assertEqual(search_keyword_index(['Irrtum']), [200])
+
+        EmbeddedLaw.objects.filter(id=law.id).update(title='Untreue', text='Wer eine Vermögensbetreuungspflicht verletzt.')
+        self.assertEqual(search_keyword_index(['Irrtum']), [])
+        self.assertEqual(search_keyword_index(['Untreue']), [200])
+
+        EmbeddedLaw.objects.filter(id=law.id).delete()
+        self.assertEqual(search_keyword_index(['Untreue']), [])
+
+
+class TermStatsTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.law_ids = [100 + i for i in range(len(LAWS))]
+        cls.stats = TermStats.build((law_id, title, text) for law_id, (title, text) in zip(cls.law_ids, LAWS))
+
+    def test_prefix_expansion(self):
+        scores = dict(zip(self.law_ids, self.stats.score(self.law_ids, ['Miet'])))
+        self.assertEqual({law_id for law_id, score in scores.items() if score > 0}, {100, 101, 102})
+
+        # Prefixes match at the start of a word only, short words match exactly
+        scores = dict(zip(self.law_ids, self.stats.score(self.law_ids, ['Sache'])))
+        self.assertEqual({law_id for law_id, score in scores.items() if score > 0}, {103, 104})
+        scores = dict(zip(self.law_ids, self.stats.score(self.law_ids, ['zu'])))
+        self.assertEqual({law_id for law_id, score in scores.items() if score > 0}, {101})
+
+        # Longer prefixes narrow the matches, umlauts are folded
+        scores = dict(zip(self.law_ids, self.stats.score(self.law_ids, ['Mieter'])))
+        self.assertEqual({law_id for law_id, score in scores.items() if score > 0}, {102})
+        self.assertGreater(self.stats.score([104], ['Verkaeufer'])[0], 0)
+
+    def test_score_batch_matches_score(self):
+        law_id_lists = [self.law_ids, [105, 999, 100], [], [103, 102]]
+        keyword_lists = [['Mietvertrag', 'kündigen'], ['Schenkung'], ['Miete'], ['fremde Sache', 'Miet']]
+
+        batch = self.stats.score_batch(law_id_lists, keyword_lists)
+
+        self.assertEqual(len(batch), len(law_id_lists))
+        for law_ids, keywords, scores in zip(law_id_lists, keyword_lists, batch):
+            np.testing.assert_allclose(scores, self.stats.score(law_ids, keywords), rtol=1e-6)
+        self.assertEqual(batch[1][1], 0)
+        self.assertEqual(len(batch[2]), 0)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/law_term_stats.npz"
+            self.stats.save(path)
+            loaded = TermStats.load(path)
+
+        np.testing.assert_allclose(loaded.score(self.law_ids, ['Miete']), self.stats.score(self.law_ids, ['Miete']))
+
+
+class KeywordCacheTests(TestCase):
+
+    def setUp(self):
+        self.llm = mock.Mock()
+        self.llm.with_options.return_value = self.llm
+        self.llm.chat.completions.create.return_value = mock.Mock(
+            choices=[mock.Mock(message=mock.Mock(content='{"keywords": ["Mord", "Totschlag"]}'))]
+        )
+        patches = [
+            mock.patch.object(search, 'get_openai_client', return_value=self.llm),
+            mock.patch.object(search, 'KEYWORD_EXTRACTION_MODE', 'llm'),
+            mock.patch.object(search.time, 'sleep'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        search.keyword_cache.clear()
+        self.addCleanup(search.keyword_cache.clear)
+
+    def test_normalized_queries_share_the_llm_keywords(self):
+        first = search.query_to_keywords_llm('Was ist Mord?')
+        second = search.query_to_keywords_llm('was ist  MORD')
+
+        self.assertEqual(first, ['Mord', 'Totschlag'])
+        self.assertEqual(second, first)
+        self.assertEqual(self.llm.chat.completions.create.call_count, 1)
+
+        # Other limits are other requests
+        search.query_to_keywords_llm('Was ist Mord?', max_keywords=8)
+        self.assertEqual(self.llm.chat.completions.create.call_count, 2)
+
+    def test_fallback_keywords_are_not_cached(self):
+        self.llm.chat.completions.create.side_effect = RuntimeError('upstream down')
+        keywords = search.query_to_keywords_llm('Was ist Mord?')
+
+        self.assertEqual(keywords, search.query_to_keywords('Was ist Mord?'))
+        self.assertEqual(len(search.keyword_cache), 0)
+
+        # The next search asks the llm again
+        self.llm.chat.completions.create.side_effect = None
+        self.assertEqual(search.query_to_keywords_llm('Was ist Mord?'), ['Mord', 'Totschlag'])
+
+    def test_entries_expire(self):
+        with mock.patch('api_app.cache.time.monotonic', return_value=1000.0):
+            search.keyword_cache.set(('mord', 32), ('Mord',), ttl=60)
+            self.assertEqual(search.keyword_cache.get(('mord', 32)), ('Mord',))
+        with mock.patch('api_app.cache.time.monotonic', return_value=1061.0):
+            self.assertIsNone(search.keyword_cache.get(('mord', 32)))
+        self.assertEqual(len(search.keyword_cache), 0)
+
+
+class RerateTests(TestCase):
+
+    def test_scores_stay_with_their_laws(self):
+        rng = np.random.default_rng(1)
+        embeddings = rng.standard_normal((len(LAWS), DIMS)).astype(np.float32)
+        law_ids = np.array([100 + i for i in range(len(LAWS))], dtype=np.int64)
+        query = rng.standard_normal(DIMS).astype(np.float32)
+
+        # The keyword results are in bm25 order, not in the order of their distances
+        keyword_results = [{'law_id': law_id} for law_id in (104, 999, 100, 103, 101)]
+        with mock.patch.object(search, 'get_embedding_matrix', return_value=EmbeddingMatrix(law_ids, embeddings)):
+            results = search.rerate_keyword_search_results(keyword_results, query)
+
+        # Laws without an embedding are dropped
+        self.assertEqual([result['law_id'] for result in results], [104, 100, 103, 101])
+        for result in results:
+            distance = np.sum((embeddings[result['law_id'] - 100] - query) ** 2)
+            self.assertAlmostEqual(result['score'], 1 / (1 + distance), places=5)
+
+        self.assertEqual(search.rerate_keyword_search_results([], query), [])
+
+
+class QuantizationTests(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.embedding = rng.standard_normal(DIMS).astype(np.float32)
+        # Dimensions with very different ranges
+        self.matrix = rng.standard_normal((16, DIMS)).astype(np.float32) * np.logspace(-3, 1, DIMS, dtype=np.float32)
+
+    def test_blob_round_trip(self):
+        blob = encode_embedding(self.embedding, 'float32')
+        self.assertEqual(len(blob), 4 * DIMS)
+        np.testing.assert_array_equal(decode_embedding(blob), self.embedding)
+
+        blob = encode_embedding(self.embedding, 'float16')
+        self.assertEqual(len(blob), BLOB_HEADER_SIZE + 2 * DIMS)
+        np.testing.assert_allclose(decode_embedding(blob), self.embedding, rtol=1e-3)
+
+        blob = encode_embedding(self.embedding, 'int8')
+        self.assertEqual(len(blob), BLOB_HEADER_SIZE + 4 + DIMS)
+        decoded = decode_embedding(blob)
+        self.assertEqual(decoded.dtype, np.float32)
+        scale = np.abs(self.embedding).max() / 127
+        self.assertLessEqual(np.abs(decoded - self.embedding).max(), scale / 2 + 1e-6)
+
+        np.testing.assert_array_equal(decode_embedding(encode_embedding(np.zeros(DIMS), 'int8')), np.zeros(DIMS))
+
+    def test_blob_header(self):
+        # Blobs without the -inf marker are plain float32, e.g. rows written before quantization
+        blob = encode_embedding(self.embedding, 'float16')
+        self.assertTrue(blob.startswith(BLOB_MARKER))
+        self.assertFalse(encode_embedding(self.embedding, 'float32').startswith(BLOB_MARKER))
+        np.testing.assert_array_equal(decode_embedding(memoryview(self.embedding.tobytes())), self.embedding)
+
+        with self.assertRaises(ValueError):
+            decode_embedding(BLOB_MARKER + bytes([9, 0, 0, 0]) + bytes(DIMS))
+
+    def test_matrix_round_trip(self):
+        stored, scales = quantize_matrix(self.matrix, 'int8')
+        self.assertEqual(stored.dtype, np.int8)
+        self.assertEqual(scales.shape, (DIMS,))
+
+        # Every dimension keeps its own precision
+        errors = np.abs(dequantize(stored, scales) - self.matrix).max(axis=0)
+        self.assertTrue(np.all(errors <= scales / 2 + 1e-7))
+
+        stored, scales = quantize_matrix(self.matrix, 'float16')
+        self.assertIsNone(scales)
+        np.testing.assert_allclose(dequantize(stored), self.matrix, rtol=1e-3, atol=1e-6)
+
+        # Constant zero dimensions and values outside the range of the scales
+        _, scales = quantize_matrix(np.zeros((2, DIMS)), 'int8')
+        np.testing.assert_array_equal(scales, np.ones(DIMS))
+        np.testing.assert_array_equal(quantize_rows(np.full((1, DIMS), 1000.0), np.ones(DIMS)), np.full((1, DIMS), 127))
+
+    def test_storage_format(self):
+        with mock.patch.object(quantization, 'get_env', return_value='int4'):
+            with self.assertRaises(ValueError):
+                quantization.storage_format()
+
+
+class EmbeddingStoreTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for patch in (
+            mock.patch.dict(os.environ, {'LAW_DATA_DIR': directory.name, 'EMBEDDING_STORAGE_FORMAT': 'int8'}),
+            mock.patch.object(embedding_store, 'STORE_IDS_PATH', os.path.join(directory.name, 'ids.npy')),
+            mock.patch.dict(embedding_matrix._matrices, clear=True),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        rng = np.random.default_rng(4)
+        self.law_ids = np.arange(100, 106)
+        self.embeddings = rng.standard_normal((len(self.law_ids), DIMS)).astype(np.float32)
+        embedding_store.write_embedding_store(self.law_ids, {'optimized': self.embeddings})
+
+    def test_rating_updates_the_row_norm_in_place(self):
+        matrix = embedding_matrix.get_embedding_matrix('optimized')
+        np.testing.assert_allclose(matrix.squared_norms, np.sum(matrix.dense() ** 2, axis=1), rtol=1e-5)
+
+        embedding = np.full(DIMS, 0.5, dtype=np.float32)
+        with mock.patch.object(embedding_store, 'squared_norms', wraps=embedding_store.squared_norms) as norms:
+            embedding_store.update_embedding('optimized', 2, embedding)
+            updated = embedding_matrix.get_embedding_matrix('optimized')
+
+        # Same mapping, only the changed row was normed again
+        self.assertIs(updated, matrix)
+        self.assertEqual([len(call.args[0]) for call in norms.call_args_list], [1])
+        np.testing.assert_allclose(matrix.rows(np.array([2]))[0], embedding, atol=0.01)
+        np.testing.assert_allclose(matrix.squared_norms, np.sum(matrix.dense() ** 2, axis=1), rtol=1e-5)
+
+        query = self.embeddings[0]
+        np.testing.assert_allclose(
+            matrix.squared_distances(np.arange(len(self.law_ids)), query),
+            np.sum((matrix.dense() - query) ** 2, axis=1), rtol=1e-4, atol=1e-4,
+        )
+
+    def test_norms_are_written_for_older_stores(self):
+        os.remove(embedding_store.norms_path('optimized'))
+
+        matrix = embedding_matrix.get_embedding_matrix('optimized')
+
+        self.assertTrue(os.path.exists(embedding_store.norms_path('optimized')))
+        np.testing.assert_allclose(matrix.squared_norms, np.sum(matrix.dense() ** 2, axis=1), rtol=1e-5)
+        self.assertIs(embedding_matrix.get_embedding_matrix('optimized'), matrix)
+
+
+class VectorIndexTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = f"{directory.name}/law_vector_db.faiss"
+
+    def flat_index(self, count: int):
+        index = faiss.IndexFlatL2(DIMS)
+        index.add(np.random.default_rng(count).standard_normal((count, DIMS)).astype(np.float32))
+        return index
+
+    def test_reload_when_the_file_changes(self):
+        writer = VectorIndex(self.path, check_interval=0)
+        reader = VectorIndex(self.path, check_interval=0)
+        slow_reader = VectorIndex(self.path, check_interval=3600)
+
+        with self.assertRaises(FileNotFoundError):
+            reader.get()
+
+        writer.publish(self.flat_index(2))
+        index = reader.get()
+        self.assertEqual(index.ntotal, 2)
+        self.assertEqual(slow_reader.get().ntotal, 2)
+
+        # Unchanged files are not loaded again
+        self.assertIs(reader.get(), index)
+        self.assertEqual(reader.loads, 1)
+
+        # A published index is resident in its process at once and picked up by the others
+        writer.publish(self.flat_index(3))
+        self.assertEqual(writer.get().ntotal, 3)
+        self.assertEqual(writer.loads, 2)
+        self.assertEqual(reader.get().ntotal, 3)
+        self.assertEqual(reader.loads, 2)
+        self.assertEqual(reader.version, writer.version)
+
+        # Until the next check the previous version is served
+        self.assertEqual(slow_reader.get().ntotal, 2)
+
+    def test_missing_file_keeps_the_resident_index(self):
+        index = VectorIndex(self.path, check_interval=0)
+        index.publish(self.flat_index(2))
+        os.remove(self.path)
+
+        distances, ids = index.search(np.zeros(DIMS, dtype=np.float32), 1)
+        self.assertEqual(ids.shape, (1, 1))
+        self.assertEqual(index.loads, 1)
+
+
+class SnippetTests(TestCase):
+
+    def test_matches_at_word_starts(self):
+        matcher = KeywordMatcher(['miet', 'Mietvertrag', 'vertrag', ' '])
+        text = 'Der MIETVERTRAG endet, die Miete nicht.'
+
+        # Leftmost-longest, case insensitive, never inside a word
+        self.assertEqual(matcher.find(text), [(4, 15), (27, 31)])
+        self.assertEqual([text[start:end] for start, end in matcher.find(text)], ['MIETVERTRAG', 'Miet'])
+
+        # Keywords that are suffixes of other keywords
+        self.assertEqual(KeywordMatcher(['Mietsache', 'sache']).find('Die Mietsache, eine Sache'), [(4, 13), (20, 25)])
+        self.assertEqual(KeywordMatcher(['Straße']).find('Die STRASSE und die Straße'), [(20, 26)])
+
+        self.assertFalse(KeywordMatcher(['', '  ']))
+        self.assertEqual(KeywordMatcher([]).find(text), [])
+
+    def test_snippet_offsets(self):
+        text = ' '.join(['Vorwort'] * 40) + ' Der Mietvertrag kann gekündigt werden. ' + ' '.join(['Nachwort'] * 40)
+        snippet = make_snippet(text, KeywordMatcher(['Mietvertrag', 'gekündigt']), length=80)
+
+        self.assertTrue(snippet['snippet'].startswith('…'))
+        self.assertTrue(snippet['snippet'].endswith('…'))
+        self.assertLessEqual(len(snippet['snippet']), 80 + 2)
+        self.assertEqual([snippet['snippet'][start:end] for start, end in snippet['highlights']], ['Mietvertrag', 'gekündigt'])
+
+        # Without keywords (or matches) the snippet is the start of the text, cut at a word
+        snippet = make_snippet(text, None, length=20)
+        self.assertEqual(snippet, {'snippet': 'Vorwort Vorwort…', 'highlights': []})
+        self.assertEqual(make_snippet('Kurzer Text', KeywordMatcher(['fehlt'])), {'snippet': 'Kurzer Text', 'highlights': []})
+
+
+class LawDetailTests(SearchTestCase):
+
+    def test_conditional_requests(self):
+        law = EmbeddedLaw.objects.get(law_id=100)
+        factory = RequestFactory()
+
+        def get(**headers):
+            return endpoints.law_detail(factory.get(f"/api/laws/{law.id}/", **headers), law.id)
+
+        response = get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['title'], law.title)
+        etag = response['ETag']
+        self.assertIn('max-age', response['Cache-Control'])
+
+        # Revalidation of an unchanged law
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+        response = get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        # A changed law has a new ETag
+        law.text = 'Der Mietvertrag kann nur schriftlich gekündigt werden.'
+        law.save()
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content)['text'], law.text)
+
+        self.assertEqual(endpoints.law_detail(factory.get('/api/laws/999999/'), 999999).status_code, 404)
+
+
+class EmbeddingCacheTests(TestCase):
+
+    def test_hit_rate_counts_every_request_once(self):
+        embedding = np.ones(DIMS, dtype=np.float32)
+        QueryEmbeddingCache().set('Was ist Mord?', embedding)
+
+        # A new worker: the query is only in the persistent tier
+        cache = QueryEmbeddingCache()
+        compute = mock.Mock(return_value=np.zeros(DIMS, dtype=np.float32))
+        np.testing.assert_array_equal(cache.get_or_compute('was ist mord', compute), embedding)
+        compute.assert_not_called()
+
+        stats = cache.stats()
+        self.assertEqual((stats['memory']['hits'], stats['memory']['misses']), (0, 1))
+        self.assertEqual((stats['persistent']['hits'], stats['persistent']['misses']), (1, 0))
+        self.assertEqual(stats['hit_rate'], 1.0)
+
+        # A cold miss is computed and counted as miss of both tiers
+        cache.get_or_compute('Was ist Totschlag?', compute)
+        compute.assert_called_once_with('Was ist Totschlag?')
+
+        stats = cache.stats()
+        self.assertEqual((stats['memory']['hits'], stats['memory']['misses']), (0, 2))
+        self.assertEqual((stats['persistent']['hits'], stats['persistent']['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+        # Both are in memory now
+        cache.get_or_compute('Was ist Totschlag?', compute)
+        self.assertEqual(cache.stats()['hit_rate'], 2 / 3)
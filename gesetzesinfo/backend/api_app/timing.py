@@ -0,0 +1,60 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+from .metrics import metrics
+
+
+# The stage durations of the current request, collected for its Server-Timing header.
+# Stages on the search executor see the list of their request (submit_search_task
+# copies the context), stages outside of a request only record their metrics.
+request_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times a stage of a search.
+
+    The duration is recorded in the histogram search_stage_duration_seconds{stage=name}
+    and in the timings of the current request, failures are counted in
+    search_stage_errors_total{stage=name}.
+
+    Parameters:
+    name (str): The name of the stage, e.g. embedding, keywords or vector_search.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        metrics.increment('search_stage_errors_total', stage=name)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe('search_stage_duration_seconds', duration, stage=name)
+
+        timings = request_timings.get()
+        if timings is not None:
+            timings.append((name, duration))
+
+
+def server_timing(timings: List[Tuple[str, float]], total: float = None) -> str:
+    """
+    Formats stage durations as the value of a Server-Timing header, e.g.
+    "embedding;dur=12.3, keywords;dur=480.1, total;dur=502.7".
+
+    Stages that ran more than once (e.g. once per query of a batch) are summed up.
+    Concurrent stages overlap, so their durations can add up to more than the total.
+
+    Parameters:
+    timings (List[Tuple[str, float]]): The names and durations (seconds) of the stages.
+    total (float): The duration of the whole request in seconds, optional.
+    """
+    durations = {}
+    for name, duration in timings:
+        durations[name] = durations.get(name, 0.0) + duration
+    if total is not None:
+        durations['total'] = total
+
+    return ', '.join(f"{name};dur={duration * 1000:.1f}" for name, duration in durations.items())
@@ -3,8 +3,16 @@ from . import views
 
 urlpatterns = [
     path('api/search/', views.search, name='search'),
+    path('api/search/batch/', views.search_batch, name='search_batch'),
+    path('api/search/stream/', views.search_stream, name='search_stream'),
     path('api/rate/', views.rate, name='rate'),
+    path('api/search/async/', views.search_async, name='search_async'),
+    path('api/rate/async/', views.rate_async, name='rate_async'),
 
+    path('api/laws/<int:id>/', views.law_detail, name='law_detail'),
     path('api/laws/count/', views.law_count, name='law_count'),
     path('api/laws/count_raw/', views.unprocessed_law_count, name='count_raw'),
+
+    path('api/stats/', views.stats, name='stats'),
+    path('metrics', views.prometheus_metrics, name='metrics'),
 ]
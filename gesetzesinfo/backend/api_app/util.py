@@ -14,6 +14,38 @@ env_path = os.path.join(parent_dir, '.env')
 env_vars = dotenv_values(env_path)
 
 
+def get_env(name: str, default=None):
+    """
+    Returns a setting from the process environment, falling back to the .env file.
+
+    Parameters:
+    name (str): The name of the setting.
+    default: The value to return if the setting is not defined anywhere.
+
+    Returns:
+    str: The value of the setting or the default.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        value = env_vars.get(name, default)
+    return value
+
+
+def data_path(file_name: str) -> str:
+    """
+    Returns the path of a data file (indexes, stores, ...) used by the search backend.
+
+    The files live in the backend folder unless LAW_DATA_DIR points somewhere else.
+
+    Parameters:
+    file_name (str): The name of the data file.
+
+    Returns:
+    str: The absolute path of the data file.
+    """
+    return os.path.join(get_env('LAW_DATA_DIR', parent_dir), file_name)
+
+
 def lerp(a, b, t):
     return a + t * (b - a)
 
@@ -33,6 +65,52 @@ def clear_text(query: str):
     
     return query
 
+# Folding of the German special characters, so "Straße" and "Strasse" are the same word
+GERMAN_FOLDING = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss'})
+
+
+def fold_text(text: str) -> str:
+    """
+    Lower cases a text and folds umlauts and "ß" to their ASCII spelling.
+
+    Parameters:
+    text (str): The text to fold.
+
+    Returns:
+    str: The folded text.
+    """
+    return text.lower().translate(GERMAN_FOLDING)
+
+
+def tokenize(text: str) -> list:
+    """
+    Splits a text into folded word tokens. Punctuation and whitespace are dropped.
+
+    Parameters:
+    text (str): The text to tokenize.
+
+    Returns:
+    list: The tokens of the text.
+    """
+    return re.findall(r'\w+', fold_text(text))
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a search query for use as cache key.
+
+    Case, umlauts and "ß", punctuation and whitespace are folded, so
+    "Was ist Mord?" and "was ist  mord" share the same key.
+
+    Parameters:
+    query (str): The query to normalize.
+
+    Returns:
+    str: The normalized query.
+    """
+    return ' '.join(tokenize(query))
+
+
 def clamp_text_to_tokens(text: str, max_tokens: int):
     if len(text) > max_tokens:
         encoding = tiktoken.encoding_for_model(env_vars.get('EMBEDDING_MODEL'))
@@ -0,0 +1,258 @@
+import os
+import logging
+import threading
+import time
+
+import faiss
+import numpy as np
+
+from .util import get_env, data_path
+from .quantization import storage_format
+
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_PATH = data_path('law_vector_db.faiss')
+
+# Two stage search: a small index over the first PREFIX_DIMS dimensions of every
+# embedding finds the candidates, which are rescored with the full embeddings.
+# The embedding models are trained so that a truncated (and renormalized) embedding
+# is still a good embedding.
+PREFIX_INDEX_PATH = data_path('law_vector_db_prefix.faiss')
+TWO_STAGE_SEARCH = get_env('VECTOR_SEARCH_TWO_STAGE', 'false').lower() in ('1', 'true', 'yes')
+PREFIX_DIMS = int(get_env('VECTOR_SEARCH_PREFIX_DIMS', 256))
+
+# The index types build_index can create (VECTOR_INDEX_TYPE)
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'ivfpq')
+
+# The faiss scalar quantizer of each embedding storage format (EMBEDDING_STORAGE_FORMAT).
+# SQ8 quantizes every dimension to 8 bit with its own range.
+SCALAR_QUANTIZERS = {'float32': None, 'float16': 'SQfp16', 'int8': 'SQ8'}
+
+
+def index_factory_string(kind: str, dims: int, count: int, nlist: int = None, hnsw_m: int = None, pq_m: int = None, storage: str = None) -> str:
+    """
+    Returns the faiss index factory string of an index type.
+
+    Parameters:
+    kind (str): One of INDEX_TYPES.
+    dims (int): The dimensions of the embeddings.
+    count (int): The number of embeddings the index is trained on.
+    nlist (int): IVF cells. Defaults to ~4 * sqrt(count), with enough training points per cell.
+    hnsw_m (int): Neighbours per HNSW node. Defaults to 32.
+    pq_m (int): PQ sub-quantizers, must divide dims. Defaults to the largest divisor of dims <= dims / 16.
+    storage (str): How flat, ivf and hnsw store the vectors, defaults to EMBEDDING_STORAGE_FORMAT.
+                   ivfpq always stores compressed codes.
+
+    Returns:
+    str: The factory string.
+    """
+    if nlist is None:
+        nlist = max(1, min(int(4 * np.sqrt(count)), count // 39))
+    if hnsw_m is None:
+        hnsw_m = 32
+    if pq_m is None:
+        pq_m = max(m for m in range(1, max(dims // 16, 1) + 1) if dims % m == 0)
+
+    quantizer = SCALAR_QUANTIZERS[storage or storage_format()]
+
+    if kind == 'flat':
+        return quantizer or 'Flat'
+    if kind == 'ivf':
+        return f'IVF{nlist},{quantizer or "Flat"}'
+    if kind == 'hnsw':
+        return f'HNSW{hnsw_m}_{quantizer}' if quantizer else f'HNSW{hnsw_m}'
+    if kind == 'ivfpq':
+        # 8 bit codes need 256 centroids per sub-quantizer, small corpora get fewer bits
+        pq_bits = int(min(8, max(4, np.log2(max(count // 39, 1)))))
+        return f'IVF{nlist},PQ{pq_m}x{pq_bits}'
+    raise ValueError(f"Unknown index type {kind}, expected one of {', '.join(INDEX_TYPES)}")
+
+
+def configure_search(index, nprobe: int = None, ef_search: int = None):
+    """
+    Sets the search time parameters of an index (IVF nprobe, HNSW efSearch).
+
+    These parameters are not part of the index file, so they are applied after every load.
+    Unset parameters are read from VECTOR_INDEX_NPROBE and VECTOR_INDEX_EF_SEARCH.
+    """
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+
+    if hasattr(inner, 'nprobe'):
+        inner.nprobe = int(nprobe or get_env('VECTOR_INDEX_NPROBE', 16))
+    if hasattr(inner, 'hnsw'):
+        inner.hnsw.efSearch = int(ef_search or get_env('VECTOR_INDEX_EF_SEARCH', 64))
+    return index
+
+
+def build_index(embeddings: np.ndarray, ids: np.ndarray, kind: str = None, **params):
+    """
+    Builds (and if needed trains) a vector index over the embeddings, keyed by ids.
+
+    Parameters:
+    embeddings (np.ndarray): The embeddings, one per row.
+    ids (np.ndarray): The ids (law_ids) of the rows.
+    kind (str): One of INDEX_TYPES, defaults to VECTOR_INDEX_TYPE or 'flat'.
+    params: Overrides for index_factory_string (nlist, hnsw_m, pq_m, storage).
+
+    Returns:
+    faiss.IndexIDMap: The filled index.
+    """
+    kind = kind or get_env('VECTOR_INDEX_TYPE', 'flat')
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    count, dims = embeddings.shape
+
+    factory_string = index_factory_string(kind, dims, count, **params)
+    index = faiss.index_factory(dims, factory_string, faiss.METRIC_L2)
+
+    if not index.is_trained:
+        start = time.perf_counter()
+        index.train(embeddings)
+        logger.info("Trained %s index on %d embeddings in %.2fs", factory_string, count, time.perf_counter() - start)
+
+    id_map = faiss.IndexIDMap(index)
+    id_map.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+    return configure_search(id_map)
+
+
+def truncate_embeddings(embeddings: np.ndarray, dims: int = None) -> np.ndarray:
+    """
+    Returns the first dims dimensions of the embeddings, renormalized to unit length.
+
+    Parameters:
+    embeddings (np.ndarray): One embedding or a matrix of embeddings (one per row).
+    dims (int): The dimensions to keep, defaults to PREFIX_DIMS.
+
+    Returns:
+    np.ndarray: The truncated embeddings as a float32 matrix.
+    """
+    dims = dims or PREFIX_DIMS
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    prefix = np.array(embeddings.reshape(-1, embeddings.shape[-1])[:, :dims], dtype=np.float32)
+    norms = np.linalg.norm(prefix, axis=1, keepdims=True)
+    return prefix / np.where(norms > 0, norms, 1.0)
+
+
+def build_prefix_index(embeddings: np.ndarray, ids: np.ndarray, dims: int = None, kind: str = None):
+    """
+    Builds the index of the first stage of the two stage search (see build_index).
+    """
+    return build_index(truncate_embeddings(embeddings, dims), ids, kind)
+
+
+class VectorIndex:
+    """
+    A FAISS index that stays resident in the worker process.
+
+    The index is read from disk once and every search is answered from memory.
+    The file on disk is polled (at most every `check_interval` seconds) and a changed
+    file is loaded synchronously by the request that notices it, so that request
+    pays for the load. While it loads, all other requests keep searching the
+    previous version, so there is no gap in service.
+    """
+
+    def __init__(self, path: str, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+
+        self._index = None
+        self._stamp = None
+        self._loads = 0
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _file_stamp(self):
+        """Returns a stamp that changes whenever the index file is replaced, or None if it is missing."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    @property
+    def version(self) -> str:
+        """
+        The version of the loaded index.
+
+        The version is derived from the file on disk, so all workers that loaded the
+        same file report the same version.
+        """
+        self.get()
+        return self._stamp
+
+    @property
+    def loads(self) -> int:
+        """How often the index was (re)loaded by this process."""
+        return self._loads
+
+    def get(self):
+        """
+        Returns the resident index, loading or reloading it if the file on disk changed.
+
+        Returns:
+        faiss.Index: The loaded index.
+        """
+        now = time.monotonic()
+        if self._index is not None and now - self._last_check < self.check_interval:
+            return self._index
+        self._last_check = now
+
+        stamp = self._file_stamp()
+        if self._index is not None and (stamp is None or stamp == self._stamp):
+            return self._index
+
+        # Only one thread loads a new version. Everybody else keeps using the current one.
+        if not self._lock.acquire(blocking=self._index is None):
+            return self._index
+        try:
+            if stamp != self._stamp or self._index is None:
+                if stamp is None:
+                    raise FileNotFoundError(f"FAISS index not found at {self.path}")
+                index = configure_search(faiss.read_index(self.path))
+                self._index, self._stamp = index, stamp
+                self._loads += 1
+                logger.info("Loaded FAISS index version %s with %d vectors", stamp, index.ntotal)
+        finally:
+            self._lock.release()
+
+        return self._index
+
+    def search(self, embeddings: np.ndarray, k: int):
+        """
+        Searches the resident index.
+
+        Parameters:
+        embeddings (np.ndarray): One embedding or a matrix of embeddings (one per row).
+        k (int): The number of neighbours to return per embedding.
+
+        Returns:
+        tuple: The distances and ids as returned by faiss.
+        """
+        index = self.get()
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, index.d)
+        return index.search(embeddings, k)
+
+    def publish(self, index):
+        """
+        Writes a new index to disk and makes it the resident version of this process.
+
+        The file is written next to the current one and moved into place atomically,
+        so other workers never read a half written index.
+
+        Parameters:
+        index (faiss.Index): The new index.
+        """
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, self.path)
+
+        with self._lock:
+            self._index, self._stamp = index, self._file_stamp()
+            self._loads += 1
+            self._last_check = time.monotonic()
+
+
+# The indexes used by the search, shared by all requests of this worker
+law_index = VectorIndex(INDEX_PATH, float(get_env('VECTOR_INDEX_CHECK_INTERVAL', 1.0)))
+law_prefix_index = VectorIndex(PREFIX_INDEX_PATH, float(get_env('VECTOR_INDEX_CHECK_INTERVAL', 1.0)))
@@ -23,10 +23,31 @@ from . import endpoints
 def search(request):
     return endpoints.search(request)
 
+@csrf_exempt
+def search_stream(request):
+    return endpoints.search_stream(request)
+
+@csrf_exempt
+def search_batch(request):
+    return endpoints.search_batch(request)
+
 @csrf_exempt
 def rate(request):
     return endpoints.rate(request)
 
+# csrf_exempt does not wrap coroutine functions before Django 5.0, so the async views
+# are marked the same way the decorator would mark them.
+async def search_async(request):
+    return await endpoints.search_async(request)
+search_async.csrf_exempt = True
+
+async def rate_async(request):
+    return await endpoints.rate_async(request)
+rate_async.csrf_exempt = True
+
+def law_detail(request, id):
+    return endpoints.law_detail(request, id)
+
 def law_count(request):
     return endpoints.law_count(request) 
 
@@ -35,3 +56,9 @@ def unprocessed_law_count(request):
 
 def old_keywords_count(request):
     return endpoints.old_keywords_count(request)
+
+def stats(request):
+    return endpoints.stats(request)
+
+def prometheus_metrics(request):
+    return endpoints.prometheus_metrics(request)
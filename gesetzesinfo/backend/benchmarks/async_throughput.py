@@ -0,0 +1,75 @@
+"""
+Throughput of the async search path compared to the sync path.
+
+Both paths run the full smart search against a local fake upstream with a fixed
+latency. The sync path gets a fixed number of threads (one per sync worker thread),
+the async path runs all searches concurrently on one event loop. Every search uses
+a distinct query, so the caches do not hide the upstream latency.
+
+Requires a populated law database and FAISS index (see processing.populate_law_db).
+
+    python -m benchmarks.async_throughput --requests 200 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.environment import use_fake_upstream, setup_django
+from benchmarks.fake_upstream import FakeUpstream
+
+
+def run_sync(queries: list, threads: int) -> float:
+    from api_app.search import smart_search
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(smart_search, queries))
+    return time.perf_counter() - start
+
+
+def run_async(queries: list) -> float:
+    from api_app.async_search import async_smart_search
+
+    async def run():
+        await asyncio.gather(*(async_smart_search(query) for query in queries))
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='Searches per path')
+    parser.add_argument('--latency', type=float, default=0.2, help='Latency of the fake upstream in seconds')
+    parser.add_argument('--sync-threads', type=int, default=1, help='Threads of the sync path')
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(latency=args.latency).start()
+    use_fake_upstream(upstream.base_url)
+    setup_django()
+
+    run_id = int(time.time())
+    sync_queries = [f"benchmark sync {run_id} anfrage {i}" for i in range(args.requests)]
+    async_queries = [f"benchmark async {run_id} anfrage {i}" for i in range(args.requests)]
+
+    sync_seconds = run_sync(sync_queries, args.sync_threads)
+    async_seconds = run_async(async_queries)
+    upstream.stop()
+
+    report = {
+        'requests': args.requests,
+        'upstream_latency': args.latency,
+        'sync_threads': args.sync_threads,
+        'sync': {'seconds': sync_seconds, 'searches_per_second': args.requests / sync_seconds},
+        'async': {'seconds': async_seconds, 'searches_per_second': args.requests / async_seconds},
+        'speedup': sync_seconds / async_seconds,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
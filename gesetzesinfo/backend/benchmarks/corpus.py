@@ -0,0 +1,265 @@
+"""
+A synthetic law corpus for the benchmarks, at any scale (10k to 1M laws).
+
+The laws are generated from a small German legal vocabulary: every law belongs to a
+topic (tenancy, purchase, criminal law, ...) and mostly uses the words of its topic,
+with a Zipf distribution like real texts. Titles and texts are deterministic for a
+seed, so every run searches the same corpus.
+
+The embeddings are the word embeddings of the fake upstream (fake_upstream.text_embedding)
+summed per law, so a query embedded by the fake upstream lands next to the laws that
+share its words, and the vector search finds laws of the right topic.
+
+build_corpus writes everything the search reads into a data directory of its own:
+a SQLite database with the laws and the keyword index, the term statistics, the
+keyword model, the embedding store and the FAISS index(es). The real database and data files are not
+touched. The embedding blobs of the EmbeddedLaw rows are left empty, the search reads
+the embedding store.
+
+    python -m benchmarks.corpus --laws 100000 --dims 256
+
+Memory: the embeddings take laws * dims * 4 bytes (1M laws with 256 dims: 1 GB).
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from benchmarks.fake_upstream import word_embedding
+
+
+# Bump when the generated corpus changes, so stale corpora are rebuilt
+CORPUS_VERSION = 2
+
+# The stems of every topic and the book its laws belong to
+TOPICS = {
+    'BGB-Miete': ['Miet', 'Vermiet', 'Wohn', 'Kaution', 'Nebenkost', 'Kündigung', 'Räum', 'Schönheitsreparatur'],
+    'BGB-Kauf': ['Kauf', 'Verkäuf', 'Sachmangel', 'Gewährleist', 'Rücktritt', 'Minder', 'Lieferung', 'Eigentum'],
+    'StGB': ['Diebstahl', 'Betrug', 'Körperverletz', 'Strafe', 'Vorsatz', 'Fahrlässig', 'Versuch', 'Täter'],
+    'ArbZG': ['Arbeit', 'Urlaub', 'Lohn', 'Überstund', 'Betriebsrat', 'Abmahn', 'Arbeitszeit', 'Schutz'],
+    'BGB-Erbe': ['Erb', 'Testament', 'Pflichtteil', 'Nachlass', 'Vermächtnis', 'Erblasser', 'Ausschlag', 'Schenk'],
+    'BGB-Familie': ['Ehe', 'Scheidung', 'Unterhalt', 'Sorgerecht', 'Kind', 'Vormund', 'Adoption', 'Güterstand'],
+    'StVO': ['Verkehr', 'Fahrzeug', 'Geschwindigkeit', 'Vorfahrt', 'Park', 'Führerschein', 'Unfall', 'Ampel'],
+    'EStG': ['Steuer', 'Einkommen', 'Freibetrag', 'Abzug', 'Veranlag', 'Werbungskost', 'Sonderausgab', 'Erstattung'],
+}
+SUFFIXES = ['', 'e', 'en', 'er', 'ung', 'vertrag', 'recht', 'pflicht', 'frist', 'sache', 'anspruch', 'verfahren']
+
+# Words every law uses
+COMMON_WORDS = (
+    'der die das und oder ist wird werden nach gemäß Absatz Satz soweit sofern wenn kann muss darf '
+    'nicht eine einer eines den dem des durch bei von zu mit für auf im gegen innerhalb schriftlich '
+    'Person Frist Antrag Gericht Behörde Verpflichtung Vorschrift Voraussetzung Fall Jahr Monat'
+).split()
+
+# Share of the words of a text that are taken from its topic
+TOPIC_SHARE = 0.6
+
+
+def topic_vocabulary(topic: str) -> List[str]:
+    """The words of a topic: every stem with every suffix, the most common first."""
+    return [stem + suffix for suffix in SUFFIXES for stem in TOPICS[topic]]
+
+
+def vocabulary() -> List[str]:
+    """All words of the corpus, every word once."""
+    words = [word for topic in TOPICS for word in topic_vocabulary(topic)] + COMMON_WORDS
+    return list(dict.fromkeys(words))
+
+
+def zipf_choice(rng: np.random.Generator, words: List[str], size: int, exponent: float = 1.1) -> List[str]:
+    """Draws words with a Zipf distribution over their position in the list."""
+    weights = 1.0 / np.arange(1, len(words) + 1) ** exponent
+    return [words[i] for i in rng.choice(len(words), size=size, p=weights / weights.sum())]
+
+
+def generate_laws(count: int, seed: int = 0, first_law_id: int = 1) -> Iterator[Tuple[int, str, str, str]]:
+    """
+    Generates the laws of the corpus.
+
+    Parameters:
+    count (int): The number of laws.
+    seed (int): The seed, the same seed gives the same laws.
+    first_law_id (int): The law_id of the first law.
+
+    Yields:
+    tuple: law_id, book_code, title and text of every law.
+    """
+    rng = np.random.default_rng(seed)
+    topics = list(TOPICS)
+    vocabularies = {topic: topic_vocabulary(topic) for topic in topics}
+
+    for i in range(count):
+        topic = topics[rng.integers(len(topics))]
+        words = vocabularies[topic]
+
+        title_words = zipf_choice(rng, words, int(rng.integers(1, 4)))
+        title = f"§ {i % 2000 + 1} " + ' '.join(dict.fromkeys(title_words))
+
+        length = int(rng.integers(20, 120))
+        topic_words = zipf_choice(rng, words, int(length * TOPIC_SHARE))
+        common_words = [str(word) for word in rng.choice(COMMON_WORDS, size=length - len(topic_words))]
+        text_words = topic_words + common_words
+        rng.shuffle(text_words)
+
+        yield first_law_id + i, topic.split('-')[0], title, ' '.join(text_words) + '.'
+
+
+def generate_queries(count: int, seed: int = 0) -> List[str]:
+    """
+    Generates search queries: a few words of one topic, phrased like the questions
+    users ask. Distinct for every index, so they miss the caches.
+    """
+    rng = np.random.default_rng(seed + 1)
+    topics = list(TOPICS)
+    queries = []
+    for i in range(count):
+        words = zipf_choice(rng, topic_vocabulary(topics[rng.integers(len(topics))]), int(rng.integers(2, 5)))
+        queries.append(f"Was gilt bei {' und '.join(dict.fromkeys(words))}? ({i})")
+    return queries
+
+
+def embed_laws(laws: List[Tuple[int, str, str, str]], dims: int, chunk_size: int = 10000) -> np.ndarray:
+    """
+    Embeds the laws like the fake upstream embeds a text (title and text), with one
+    sparse product per chunk instead of one sum per law.
+
+    Returns:
+    np.ndarray: The unit length embeddings, one row per law.
+    """
+    words = vocabulary()
+    rows = {word.lower(): i for i, word in enumerate(words)}
+    word_matrix = np.stack([word_embedding(word, dims) for word in words])
+
+    embeddings = np.empty((len(laws), dims), dtype=np.float32)
+    for start in range(0, len(laws), chunk_size):
+        chunk = laws[start:start + chunk_size]
+        indptr, indices = [0], []
+        for _, _, title, text in chunk:
+            indices.extend(rows[word] for word in re.findall(r'\w+', f"{title} {text}".lower()) if word in rows)
+            indptr.append(len(indices))
+        counts = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr), shape=(len(chunk), len(words)))
+
+        vectors = np.asarray(counts @ word_matrix, dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        embeddings[start:start + len(chunk)] = vectors
+    return embeddings
+
+
+def manifest_path(data_dir: str) -> str:
+    return os.path.join(data_dir, 'corpus.json')
+
+
+def read_manifest(data_dir: str) -> dict:
+    try:
+        with open(manifest_path(data_dir)) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def build_corpus(data_dir: str, count: int, dims: int, seed: int = 0, batch_size: int = 5000) -> dict:
+    """
+    Builds the synthetic corpus into data_dir, unless a corpus with the same
+    parameters is there already.
+
+    Django must have been set up with benchmarks.environment.use_benchmark_data(data_dir),
+    so the database and the data files of the search point into data_dir.
+
+    Parameters:
+    data_dir (str): The data directory of the benchmark.
+    count (int): The number of laws.
+    dims (int): The dimensions of the embeddings.
+    seed (int): The seed of the corpus.
+
+    Returns:
+    dict: The manifest of the corpus (its parameters and build time).
+    """
+    from django.core.management import call_command
+    from django.db import connection
+
+    from api_app.embedding_store import write_embedding_store
+    from api_app.keyword_index import drop_keyword_index, ensure_keyword_index
+    from api_app.local_keywords import build_keyword_model
+    from api_app.models import EmbeddedLaw
+    from api_app.term_stats import build_term_stats
+    from api_app.vector_index import law_index, law_prefix_index, build_index, build_prefix_index, TWO_STAGE_SEARCH
+
+    wanted = {'version': CORPUS_VERSION, 'laws': count, 'dims': dims, 'seed': seed}
+    manifest = read_manifest(data_dir)
+    if {key: manifest.get(key) for key in wanted} == wanted:
+        return manifest
+
+    start = time.perf_counter()
+    print(f"Building synthetic corpus with {count} laws and {dims} dimensions in {data_dir}")
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    with connection.cursor() as cursor:
+        # Faster without the triggers, ensure_keyword_index recreates the index and its triggers
+        drop_keyword_index(cursor)
+    EmbeddedLaw.objects.all().delete()
+
+    laws = list(generate_laws(count, seed))
+    for offset in range(0, count, batch_size):
+        EmbeddedLaw.objects.bulk_create([
+            EmbeddedLaw(
+                law_id=law_id, book_code=book_code, title=title, text=text,
+                text_reduced=text[:EmbeddedLaw.reduced_text_length], embedding_text=text,
+                embedding_base=b'', embedding_optimized=b'',
+            ) for law_id, book_code, title, text in laws[offset:offset + batch_size]
+        ])
+
+    ensure_keyword_index(rebuild=True)
+    build_term_stats()
+    build_keyword_model()
+
+    embeddings = embed_laws(laws, dims)
+    law_ids = np.array([law[0] for law in laws], dtype=np.int64)
+    del laws
+
+    write_embedding_store(law_ids, {'base': embeddings, 'optimized': embeddings})
+    law_index.publish(build_index(embeddings, law_ids))
+    if TWO_STAGE_SEARCH:
+        law_prefix_index.publish(build_prefix_index(embeddings, law_ids))
+
+    manifest = {**wanted, 'build_seconds': round(time.perf_counter() - start, 2)}
+    with open(manifest_path(data_dir), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    print(f"Built synthetic corpus in {manifest['build_seconds']}s")
+    return manifest
+
+
+def default_data_dir(count: int, dims: int, seed: int) -> str:
+    """The data directory of a corpus, outside of the repository."""
+    return os.path.join(tempfile.gettempdir(), 'gesetzesinfo-benchmarks', f"laws-{count}-dims-{dims}-seed-{seed}")
+
+
+def main():
+    from benchmarks.environment import use_benchmark_data, setup_django
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--laws', type=int, default=10000, help='Number of laws')
+    parser.add_argument('--dims', type=int, default=256, help='Dimensions of the embeddings')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=None, help='Data directory of the corpus, defaults to a directory in the temp dir')
+    parser.add_argument('--rebuild', action='store_true', help='Remove an existing corpus first')
+    args = parser.parse_args()
+
+    data_dir = use_benchmark_data(args.data_dir or default_data_dir(args.laws, args.dims, args.seed), args.dims)
+    if args.rebuild and os.path.exists(manifest_path(data_dir)):
+        shutil.rmtree(data_dir)
+        os.makedirs(data_dir)
+    setup_django()
+
+    print(json.dumps(build_corpus(data_dir, args.laws, args.dims, args.seed), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Throughput and tail latency of the query embeddings with and without micro-batching.
+
+A number of clients (threads, like the searches of a worker) embed distinct queries
+back to back through search.request_embedding, against the local fake upstream.
+Every window of the sweep is run with its own embedding batcher, window 0 calls the
+upstream once per query. The upstream latency and its concurrency limit emulate the
+request limits of the real embedding api, where batching pays off the most.
+
+The report is JSON with sorted keys: per window the throughput, the p50, p95 and p99
+latency in milliseconds, the number of upstream calls and the mean batch size.
+
+    python -m benchmarks.embedding_batching --clients 64 --windows 0,2,5,10 --latency 0.1 --upstream-concurrency 8
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
+
+from benchmarks.environment import use_fake_upstream, setup_django
+from benchmarks.fake_upstream import FakeUpstream
+
+
+def run_clients(embed, clients: int, queries_per_client: int, run_id: str) -> tuple:
+    """
+    Runs the clients, every client embeds its queries one after another.
+
+    Returns:
+    tuple: The total seconds and the latencies of all queries in milliseconds.
+    """
+    def client(index: int) -> list:
+        latencies = []
+        for i in range(queries_per_client):
+            start = time.perf_counter()
+            embed(f"benchmark {run_id} client {index} anfrage {i}")
+            latencies.append((time.perf_counter() - start) * 1000)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = [latency for result in executor.map(client, range(clients)) for latency in result]
+    return time.perf_counter() - start, latencies
+
+
+def run_window(window_ms: float, args, upstream: FakeUpstream) -> dict:
+    """Embeds the queries of all clients with a batcher with the given window (0: without batcher)."""
+    from api_app import search
+    from api_app.embedding_batcher import EmbeddingBatcher
+
+    batcher = None
+    if window_ms > 0:
+        batcher = EmbeddingBatcher(
+            search.request_embeddings, window=window_ms / 1000,
+            max_size=args.max_batch_size, concurrency=args.batch_concurrency,
+        )
+
+    before = upstream.requests.get('/v1/embeddings', 0)
+    with mock.patch.object(search, 'embedding_batcher', batcher):
+        seconds, latencies = run_clients(search.request_embedding, args.clients, args.queries, f"{time.time()} {window_ms}")
+    calls = upstream.requests.get('/v1/embeddings', 0) - before
+
+    values = np.asarray(latencies)
+    return {
+        'window_ms': window_ms,
+        'queries': len(latencies),
+        'seconds': round(seconds, 3),
+        'queries_per_second': round(len(latencies) / seconds, 1),
+        'p50_ms': round(float(np.percentile(values, 50)), 2),
+        'p95_ms': round(float(np.percentile(values, 95)), 2),
+        'p99_ms': round(float(np.percentile(values, 99)), 2),
+        'upstream_calls': calls,
+        'mean_batch_size': round(len(latencies) / calls, 2) if calls else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=64, help='Concurrent clients')
+    parser.add_argument('--queries', type=int, default=20, help='Queries per client')
+    parser.add_argument('--windows', default='0,2,5,10', help='Comma separated batch windows in milliseconds')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--batch-concurrency', type=int, default=4, help='Embeddings calls of the batcher in flight at once')
+    parser.add_argument('--latency', type=float, default=0.1, help='Latency of the fake upstream in seconds')
+    parser.add_argument('--upstream-concurrency', type=int, default=8, help='Requests the fake upstream answers at once, 0 for no limit')
+    parser.add_argument('--dims', type=int, default=256)
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(latency=args.latency, dims=args.dims, concurrency=args.upstream_concurrency).start()
+    use_fake_upstream(upstream.base_url)
+    setup_django()
+
+    results = []
+    for window_ms in (float(window) for window in args.windows.split(',') if window):
+        print(f"Running window {window_ms}ms with {args.clients} clients", file=sys.stderr)
+        results.append(run_window(window_ms, args, upstream))
+    upstream.stop()
+
+    report = {
+        'suite': 'embedding_batching',
+        'config': {
+            'clients': args.clients,
+            'queries_per_client': args.queries,
+            'max_batch_size': args.max_batch_size,
+            'batch_concurrency': args.batch_concurrency,
+            'upstream_latency': args.latency,
+            'upstream_concurrency': args.upstream_concurrency,
+        },
+        'results': results,
+    }
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
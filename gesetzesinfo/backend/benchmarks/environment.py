@@ -0,0 +1,62 @@
+"""
+Shared setup of the benchmarks: fake upstream settings, the data of the benchmark and Django.
+"""
+
+import os
+import sys
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def use_fake_upstream(base_url: str):
+    """
+    Points the embedding and keyword llm clients to a fake upstream.
+
+    Must be called before Django is set up, the settings are read on import.
+    """
+    os.environ['EMBEDDING_API_HOST'] = base_url
+    os.environ['LLM_KEYWORD_EXTRACTION_HOST'] = base_url
+    os.environ['OPENAI_API_KEY'] = 'fake'
+    os.environ['GROQ_API_KEY'] = 'fake'
+    os.environ.setdefault('EMBEDDING_MODEL', 'text-embedding-3-small')
+    os.environ.setdefault('EMBEDDING_MODEL_DIMS', '1536')
+    os.environ.setdefault('LLM_KEYWORD_EXTRACTION_MODEL', 'fake')
+
+
+def use_benchmark_data(data_dir: str, dims: int) -> str:
+    """
+    Points the database and the data files (indexes, stores, term statistics) of the
+    search to a directory of the benchmark, so the real data is never touched.
+
+    Must be called before Django is set up, like use_fake_upstream.
+
+    Parameters:
+    data_dir (str): The data directory, created if missing.
+    dims (int): The dimensions of the embeddings of the corpus.
+
+    Returns:
+    str: The absolute path of the data directory.
+    """
+    data_dir = os.path.abspath(data_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    os.environ['LAW_DATA_DIR'] = data_dir
+    os.environ['BENCHMARK_DATABASE'] = os.path.join(data_dir, 'db.sqlite3')
+    os.environ['EMBEDDING_MODEL_DIMS'] = str(dims)
+    return data_dir
+
+
+def setup_django():
+    """
+    Sets up Django with the project settings, using the database of use_benchmark_data if set.
+    """
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_project.settings')
+
+    import django
+    from django.conf import settings
+
+    if os.environ.get('BENCHMARK_DATABASE'):
+        settings.DATABASES['default']['NAME'] = os.environ['BENCHMARK_DATABASE']
+    django.setup()
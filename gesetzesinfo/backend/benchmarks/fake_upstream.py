@@ -0,0 +1,185 @@
+"""
+A local stand-in for the OpenAI compatible embedding and chat completion apis.
+
+It answers /v1/embeddings and /v1/chat/completions after a configurable latency, so
+the search pipeline can be benchmarked without network access or api costs. A
+concurrency limit emulates the request limits of the real apis: requests beyond it
+wait for a free slot.
+Embeddings are deterministic: the normalized sum of a random vector per word, derived
+from a hash of the word. Texts that share words are close, so the synthetic corpus
+(benchmarks.corpus) embeds its laws the same way. Keywords are the words of the query.
+
+Run it standalone with:
+    python -m benchmarks.fake_upstream --port 8100 --latency 0.2
+and point EMBEDDING_API_HOST / LLM_KEYWORD_EXTRACTION_HOST to http://127.0.0.1:8100/v1
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+DEFAULT_DIMS = 1536
+
+
+def fake_embedding(text: str, dims: int = DEFAULT_DIMS) -> np.ndarray:
+    """
+    Returns a deterministic unit length embedding for a text.
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    embedding = np.random.default_rng(seed).standard_normal(dims).astype(np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+@lru_cache(maxsize=65536)
+def word_embedding(word: str, dims: int = DEFAULT_DIMS) -> np.ndarray:
+    """The embedding of a single (lower cased) word, cached since texts repeat their words."""
+    return fake_embedding(word.lower(), dims)
+
+
+def text_embedding(text: str, dims: int = DEFAULT_DIMS) -> np.ndarray:
+    """
+    Returns the deterministic unit length embedding of a text: the normalized sum of
+    the embeddings of its words. A text without words gets the embedding of its hash.
+    """
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return fake_embedding(text, dims)
+    embedding = np.sum([word_embedding(word, dims) for word in words], axis=0)
+    return (embedding / np.linalg.norm(embedding)).astype(np.float32)
+
+
+def fake_keywords(text: str, max_keywords: int = 32) -> list:
+    """
+    Returns the words of the quoted query in a keyword extraction prompt.
+    """
+    quoted = re.findall(r'"([^"]*)"', text)
+    query = quoted[-1] if quoted else text
+    return list(dict.fromkeys(re.findall(r'\w+', query)))[:max_keywords]
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        with self.server.slots:
+            time.sleep(self.server.latency)
+        self.server.count(self.path)
+
+        if self.path.endswith('/embeddings'):
+            response = self.embeddings(body)
+        elif self.path.endswith('/chat/completions'):
+            response = self.chat_completion(body)
+        else:
+            self.send_error(404)
+            return
+
+        payload = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def embeddings(self, body: dict) -> dict:
+        inputs = body.get('input', '')
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        dims = int(body.get('dimensions') or self.server.dims)
+
+        return {
+            'object': 'list',
+            'model': body.get('model', 'fake'),
+            'data': [
+                {'object': 'embedding', 'index': i, 'embedding': text_embedding(text, dims).tolist()}
+                for i, text in enumerate(inputs)
+            ],
+            'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+        }
+
+    def chat_completion(self, body: dict) -> dict:
+        user_message = body.get('messages', [{}])[-1].get('content', '')
+        content = json.dumps({'keywords': fake_keywords(user_message)})
+
+        return {
+            'id': 'fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        }
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    """
+    The fake upstream server. Counts the requests per path.
+
+    concurrency limits the requests that are answered at once, 0 answers all at once.
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.05, dims: int = DEFAULT_DIMS,
+                 concurrency: int = 0):
+        super().__init__((host, port), FakeUpstreamHandler)
+        self.latency = latency
+        self.dims = dims
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency > 0 else contextlib.nullcontext()
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, path: str):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self) -> 'FakeUpstream':
+        """Serves in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds before every response')
+    parser.add_argument('--dims', type=int, default=DEFAULT_DIMS)
+    parser.add_argument('--concurrency', type=int, default=0, help='Requests answered at once, 0 for no limit')
+    args = parser.parse_args()
+
+    server = FakeUpstream(args.host, args.port, args.latency, args.dims, args.concurrency)
+    print(f"Fake upstream listening on {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
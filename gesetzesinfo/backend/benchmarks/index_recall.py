@@ -0,0 +1,139 @@
+"""
+Recall@k and latency of the vector index types compared to the exact flat index.
+
+Every index type of vector_index.INDEX_TYPES is built over the same embeddings
+with build_index and searched with a range of search time parameters (IVF nprobe,
+HNSW efSearch). Recall@k is the share of the exact top k (IndexFlatL2) that an
+index returns in its own top k.
+
+The embeddings are read from the embedding store (law_embeddings_base.npy). The
+queries are stored embeddings with a little noise added, so they are close to, but
+not identical with, a law. With --synthetic the corpus is random instead, which
+allows to test corpus sizes we do not have yet.
+
+    python -m benchmarks.index_recall --k 32 --queries 500
+    python -m benchmarks.index_recall --synthetic 200000 --dims 1536
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import faiss
+import numpy as np
+
+from benchmarks.environment import BACKEND_DIR
+
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from api_app.embedding_store import open_embedding_store
+from api_app.quantization import dequantize
+from api_app.vector_index import build_index, configure_search, index_factory_string
+
+
+# Search time parameters tried per index type
+SEARCH_PARAMS = {
+    'flat': [{}],
+    'ivf': [{'nprobe': n} for n in (1, 4, 16, 64)],
+    'hnsw': [{'ef_search': ef} for ef in (16, 64, 256)],
+    'ivfpq': [{'nprobe': n} for n in (4, 16, 64)],
+}
+
+
+def load_corpus(synthetic: int, dims: int, seed: int):
+    """Returns the ids and embeddings of the corpus."""
+    if synthetic:
+        rng = np.random.default_rng(seed)
+        embeddings = rng.standard_normal((synthetic, dims), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return np.arange(synthetic, dtype=np.int64), embeddings
+
+    store = open_embedding_store('base')
+    if store is None:
+        raise SystemExit("No embedding store found, build it first or use --synthetic")
+    law_ids, vectors, scales = store
+    return law_ids, np.ascontiguousarray(dequantize(vectors, scales))
+
+
+def make_queries(embeddings: np.ndarray, count: int, noise: float, seed: int) -> np.ndarray:
+    """Returns noisy, renormalized copies of randomly chosen corpus embeddings."""
+    rng = np.random.default_rng(seed + 1)
+    rows = rng.choice(len(embeddings), size=min(count, len(embeddings)), replace=False)
+    queries = embeddings[rows] + noise * rng.standard_normal((len(rows), embeddings.shape[1]), dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return np.ascontiguousarray(queries, dtype=np.float32)
+
+
+def recall_at_k(found: np.ndarray, exact: np.ndarray) -> float:
+    """Returns the mean share of the exact neighbours that were found."""
+    hits = [len(set(f[f >= 0]) & set(e[e >= 0])) / max(len(e[e >= 0]), 1) for f, e in zip(found, exact)]
+    return float(np.mean(hits))
+
+
+def time_queries(index, queries: np.ndarray, k: int) -> tuple:
+    """Searches the queries one at a time (like the search endpoint) and returns the ids and latencies in ms."""
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    latencies = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, found = index.search(query.reshape(1, -1), k)
+        latencies[i] = (time.perf_counter() - start) * 1000
+        ids[i] = found[0]
+    return ids, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--k', type=int, default=32, help='Neighbours per query')
+    parser.add_argument('--queries', type=int, default=500, help='Number of queries')
+    parser.add_argument('--noise', type=float, default=0.02, help='Noise added to the query embeddings')
+    parser.add_argument('--types', default=','.join(SEARCH_PARAMS), help='Comma separated index types')
+    parser.add_argument('--synthetic', type=int, default=0, help='Use a random corpus of this size')
+    parser.add_argument('--dims', type=int, default=1536, help='Dimensions of the random corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    ids, embeddings = load_corpus(args.synthetic, args.dims, args.seed)
+    queries = make_queries(embeddings, args.queries, args.noise, args.seed)
+    count, dims = embeddings.shape
+
+    exact = faiss.IndexIDMap(faiss.IndexFlatL2(dims))
+    exact.add_with_ids(embeddings, ids)
+    exact_ids, _ = time_queries(exact, queries, args.k)
+
+    results = []
+    for kind in args.types.split(','):
+        start = time.perf_counter()
+        index = build_index(embeddings, ids, kind)
+        build_seconds = time.perf_counter() - start
+
+        for params in SEARCH_PARAMS[kind]:
+            configure_search(index, **params)
+            found, latencies = time_queries(index, queries, args.k)
+            results.append({
+                'type': kind,
+                'factory': index_factory_string(kind, dims, count),
+                'params': params,
+                'build_seconds': round(build_seconds, 3),
+                'index_bytes': int(faiss.serialize_index(index).nbytes),
+                f'recall_at_{args.k}': round(recall_at_k(found, exact_ids), 4),
+                'latency_ms_p50': round(float(np.percentile(latencies, 50)), 4),
+                'latency_ms_p95': round(float(np.percentile(latencies, 95)), 4),
+            })
+
+    report = {
+        'corpus': 'synthetic' if args.synthetic else 'embedding_store',
+        'vectors': count,
+        'dims': dims,
+        'queries': len(queries),
+        'k': args.k,
+        'threads': faiss.omp_get_max_threads(),
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Score drift of the quantized embedding storage formats against float32.
+
+For every storage format (EMBEDDING_STORAGE_FORMAT) the corpus is stored the way
+the search reads it and searched with the same queries:
+
+    store   the embedding store / in memory matrix (per dimension int8 scales)
+    blob    the database blobs (per vector int8 scale)
+    index   the flat faiss index (SQfp16 / SQ8)
+
+Scores are the search scores 1 / (1 + squared L2 distance). Drift is the absolute
+difference to the float32 score of the same law (for the index, of the result at
+the same rank), recall@k compares the top k.
+
+The embeddings are read from the embedding store, which should be float32 for a
+meaningful result. With --synthetic the corpus is random instead.
+
+    python -m benchmarks.quantization_drift --k 32 --queries 500
+"""
+
+import argparse
+import json
+import sys
+
+import faiss
+import numpy as np
+
+from benchmarks.environment import BACKEND_DIR
+
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from api_app.quantization import STORAGE_FORMATS, quantize_matrix, dequantize, encode_embedding, decode_embedding
+from api_app.vector_index import build_index
+from benchmarks.index_recall import load_corpus, make_queries, recall_at_k
+
+
+def exact_search(embeddings: np.ndarray, queries: np.ndarray, k: int):
+    """Returns the squared distances and rows of the exact top k."""
+    index = faiss.IndexFlatL2(embeddings.shape[1])
+    index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+    return index.search(queries, k)
+
+
+def squared_distances(embeddings: np.ndarray, rows: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    """Returns the squared distances of every query to its rows."""
+    return np.stack([((embeddings[r] - q) ** 2).sum(axis=1) for r, q in zip(rows, queries)])
+
+
+def score(distances: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + distances)
+
+
+def drift_report(reference_scores: np.ndarray, scores: np.ndarray, reference_rows: np.ndarray, rows: np.ndarray, k: int) -> dict:
+    drift = np.abs(reference_scores - scores)
+    return {
+        'score_drift_mean': float(drift.mean()),
+        'score_drift_p99': float(np.percentile(drift, 99)),
+        'score_drift_max': float(drift.max()),
+        f'recall_at_{k}': round(recall_at_k(rows, reference_rows), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--k', type=int, default=32, help='Neighbours per query')
+    parser.add_argument('--queries', type=int, default=500, help='Number of queries')
+    parser.add_argument('--noise', type=float, default=0.02, help='Noise added to the query embeddings')
+    parser.add_argument('--synthetic', type=int, default=0, help='Use a random corpus of this size')
+    parser.add_argument('--dims', type=int, default=1536, help='Dimensions of the random corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    ids, embeddings = load_corpus(args.synthetic, args.dims, args.seed)
+    queries = make_queries(embeddings, args.queries, args.noise, args.seed)
+    count, dims = embeddings.shape
+    rows_ids = np.arange(count, dtype=np.int64)
+
+    reference_distances, reference_rows = exact_search(embeddings, queries, args.k)
+    reference_scores = score(reference_distances)
+
+    formats = {}
+    for storage in STORAGE_FORMATS:
+        stored, scales = quantize_matrix(embeddings, storage)
+        store = dequantize(stored, scales)
+        blobs = np.array([decode_embedding(encode_embedding(embedding, storage)) for embedding in embeddings])
+        store_bytes = stored.nbytes + (scales.nbytes if scales is not None else 0)
+
+        report = {
+            'bytes_per_vector': {
+                'store': store_bytes / count,
+                'blob': len(encode_embedding(embeddings[0], storage)),
+            },
+        }
+
+        # Same laws, quantized vectors: how much does the score of a result move
+        # Own top k: does the quantized search still find the same laws
+        for name, vectors in (('store', store), ('blob', blobs)):
+            distances, rows = exact_search(vectors, queries, args.k)
+            same_law_scores = score(squared_distances(vectors, reference_rows, queries))
+            report[name] = drift_report(reference_scores, same_law_scores, reference_rows, rows, args.k)
+            report[name]['relative_l2_error'] = float(np.mean(
+                np.linalg.norm(vectors - embeddings, axis=1) / np.linalg.norm(embeddings, axis=1)
+            ))
+
+        index = build_index(embeddings, rows_ids, 'flat', storage=storage)
+        distances, rows = index.search(queries, args.k)
+        report['index'] = drift_report(reference_scores, score(distances), reference_rows, rows, args.k)
+        report['index']['bytes'] = int(faiss.serialize_index(index).nbytes)
+
+        formats[storage] = report
+
+    print(json.dumps({
+        'corpus': 'synthetic' if args.synthetic else 'embedding_store',
+        'vectors': count,
+        'dims': dims,
+        'queries': len(queries),
+        'k': args.k,
+        'formats': formats,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+Microbenchmarks of the search pipeline on a synthetic corpus, without network access.
+
+The corpus is built by benchmarks.corpus (once per size, dims and seed) into a data
+directory of its own. The embedding and keyword llm apis are answered by the local
+fake upstream. Every benchmark runs its function once per query after a warmup:
+
+    local_keywords                 the local keyword extraction (stopwords, stemming, expansion)
+    multi_keyword_search           full text candidates and keyword scoring
+    natural_language_search        the vector search (FAISS, two stage if enabled)
+    rerate_keyword_search_results  re-rating the keyword hits with the query embedding
+    smart_search_cold              the full search of a new query (caches missed, upstream called)
+    smart_search_warm              the full search of a repeated query (result cache)
+
+The inputs of the microbenchmarks are computed locally: the local keywords of the
+query and the embedding the fake upstream returns for it.
+
+The report is JSON with sorted keys (schema_version 1): the environment, the config,
+the corpus and per benchmark the number of samples and the mean, p50, p95, p99, min
+and max latency in milliseconds. Compare a run with an earlier one with --compare:
+
+    python -m benchmarks.search_pipeline --laws 10000 --output baseline.json
+    python -m benchmarks.search_pipeline --laws 10000 --output current.json --compare baseline.json
+
+Comparisons are only meaningful between runs on the same machine with the same config.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Callable, List
+
+import numpy as np
+
+from benchmarks.corpus import build_corpus, default_data_dir, generate_queries
+from benchmarks.environment import BACKEND_DIR, use_benchmark_data, use_fake_upstream, setup_django
+from benchmarks.fake_upstream import FakeUpstream, text_embedding
+
+
+SCHEMA_VERSION = 1
+
+BENCHMARKS = (
+    'local_keywords',
+    'multi_keyword_search',
+    'natural_language_search',
+    'rerate_keyword_search_results',
+    'smart_search_cold',
+    'smart_search_warm',
+)
+
+
+def measure(fn: Callable, inputs: list, warmup: int) -> List[float]:
+    """
+    Calls fn once per input and returns the latencies in milliseconds. The first
+    warmup inputs are run before, without being measured.
+    """
+    for item in inputs[:warmup]:
+        fn(item)
+
+    latencies = []
+    for item in inputs[warmup:]:
+        start = time.perf_counter()
+        fn(item)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def summarize(latencies: List[float]) -> dict:
+    """The statistics of the latencies (milliseconds) of one benchmark."""
+    values = np.asarray(latencies, dtype=np.float64)
+    return {
+        'samples': len(values),
+        'mean_ms': round(float(values.mean()), 4),
+        'p50_ms': round(float(np.percentile(values, 50)), 4),
+        'p95_ms': round(float(np.percentile(values, 95)), 4),
+        'p99_ms': round(float(np.percentile(values, 99)), 4),
+        'min_ms': round(float(values.min()), 4),
+        'max_ms': round(float(values.max()), 4),
+    }
+
+
+def environment_info() -> dict:
+    """The machine and versions a report was measured with."""
+    import faiss
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'faiss': getattr(faiss, '__version__', None),
+        'git_commit': commit,
+    }
+
+
+def run_benchmarks(names: List[str], queries: List[str], dims: int, warmup: int) -> dict:
+    """
+    Runs the selected benchmarks over the queries.
+
+    Returns:
+    dict: The statistics of every benchmark.
+    """
+    from api_app import search
+    from api_app.analytics import search_log_queue
+    from api_app.metrics import metrics
+    from api_app.result_cache import result_cache
+
+    keywords = [search.query_to_keywords(search.clear_text(query)) for query in queries]
+    embeddings = [text_embedding(query, dims) for query in queries]
+    keyword_results = [search.multi_keyword_search(kws) for kws in keywords]
+
+    benchmarks = {
+        'local_keywords': lambda i: search.query_to_keywords(queries[i]),
+        'multi_keyword_search': lambda i: search.multi_keyword_search(keywords[i]),
+        'natural_language_search': lambda i: search.natural_language_search(embeddings[i]),
+        'rerate_keyword_search_results': lambda i: search.rerate_keyword_search_results(keyword_results[i], embeddings[i]),
+        'smart_search_cold': lambda i: search.smart_search(queries[i]),
+        'smart_search_warm': lambda i: search.smart_search(queries[0]),
+    }
+
+    if result_cache is not None:
+        result_cache.clear()
+
+    results = {}
+    for name in names:
+        print(f"Running {name} ({len(queries) - warmup} samples)", file=sys.stderr)
+        results[name] = summarize(measure(benchmarks[name], list(range(len(queries))), warmup))
+
+    # The stages of the smart searches (see timing.stage)
+    stages = {
+        entry['labels']['stage']: {
+            'samples': entry['count'],
+            **{f"{quantile}_ms": round(entry[quantile] * 1000, 4) for quantile in ('p50', 'p95', 'p99')},
+        }
+        for entry in metrics.snapshot().get('search_stage_duration_seconds', [])
+    }
+    if stages:
+        results['smart_search_stages'] = stages
+
+    search_log_queue.join(timeout=30)
+    return results
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compares the p50 latencies of a report with a baseline.
+
+    Returns:
+    list: The names of the benchmarks that got slower by more than the threshold.
+    """
+    if report['config'] != baseline.get('config'):
+        print("Warning: the configs of the runs differ, the comparison is not meaningful", file=sys.stderr)
+
+    regressions = []
+    print(f"{'benchmark':34} {'baseline p50':>14} {'current p50':>14} {'change':>9}", file=sys.stderr)
+    for name, current in report['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None or 'p50_ms' not in current:
+            continue
+        change = current['p50_ms'] / previous['p50_ms'] - 1 if previous['p50_ms'] else 0.0
+        flag = '  REGRESSION' if change > threshold else ''
+        print(f"{name:34} {previous['p50_ms']:>12.3f}ms {current['p50_ms']:>12.3f}ms {change:>+8.1%}{flag}", file=sys.stderr)
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--laws', type=int, default=10000, help='Number of laws of the synthetic corpus')
+    parser.add_argument('--dims', type=int, default=256, help='Dimensions of the embeddings')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=None, help='Data directory of the corpus (see benchmarks.corpus)')
+    parser.add_argument('--queries', type=int, default=200, help='Measured queries per benchmark')
+    parser.add_argument('--warmup', type=int, default=20, help='Unmeasured queries before every benchmark')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency of the fake upstream in seconds')
+    parser.add_argument('--benchmarks', default=','.join(BENCHMARKS), help='Comma separated benchmarks to run')
+    parser.add_argument('--output', default=None, help='Write the report to this file instead of stdout')
+    parser.add_argument('--compare', default=None, help='A report of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown of the p50 that counts as regression')
+    args = parser.parse_args()
+
+    names = [name for name in args.benchmarks.split(',') if name]
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    upstream = FakeUpstream(latency=args.latency, dims=args.dims).start()
+    data_dir = use_benchmark_data(args.data_dir or default_data_dir(args.laws, args.dims, args.seed), args.dims)
+    use_fake_upstream(upstream.base_url)
+    setup_django()
+
+    corpus = build_corpus(data_dir, args.laws, args.dims, args.seed)
+    queries = generate_queries(args.queries + args.warmup, args.seed)
+
+    from api_app.util import get_env
+
+    report = {
+        'schema_version': SCHEMA_VERSION,
+        'suite': 'search_pipeline',
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'environment': environment_info(),
+        'config': {
+            'laws': args.laws,
+            'dims': args.dims,
+            'seed': args.seed,
+            'queries': args.queries,
+            'warmup': args.warmup,
+            'upstream_latency': args.latency,
+            'vector_index_type': get_env('VECTOR_INDEX_TYPE', 'flat'),
+            'two_stage_search': get_env('TWO_STAGE_SEARCH', 'false'),
+            'embedding_storage_format': get_env('EMBEDDING_STORAGE_FORMAT', 'float32'),
+            'keyword_scoring': get_env('KEYWORD_SCORING', 'bm25'),
+            'keyword_extraction_mode': get_env('KEYWORD_EXTRACTION_MODE', 'llm'),
+        },
+        'corpus': corpus,
+        'results': run_benchmarks(names, queries, args.dims, args.warmup),
+    }
+    upstream.stop()
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        if regressions:
+            sys.exit(f"Slower than the baseline: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
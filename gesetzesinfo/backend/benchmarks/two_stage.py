@@ -0,0 +1,120 @@
+"""
+Two stage vector search (truncated prefix index + full rescoring) compared to the
+single stage search over the full embeddings.
+
+The single stage is the flat index of natural_language_search. The two stage path
+searches the prefix index of build_prefix_index and rescores the candidates with
+the full embeddings, like two_stage_search. Recall@k is measured against the single
+stage top k, FLOPs are the multiply-adds of the distance computations per query.
+
+Only embeddings of models trained for truncation (e.g. text-embedding-3-*) keep
+their quality in the prefix. The synthetic corpus imitates this by concentrating
+the variance in the leading dimensions (--decay), a corpus without it is the
+worst case for the first stage.
+
+    python -m benchmarks.two_stage --k 32 --prefix-dims 256
+    python -m benchmarks.two_stage --synthetic 200000 --dims 1536
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import faiss
+import numpy as np
+
+from benchmarks.environment import BACKEND_DIR
+
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from api_app.vector_index import build_index, build_prefix_index, truncate_embeddings
+from benchmarks.index_recall import load_corpus, make_queries, recall_at_k
+
+
+def two_stage(prefix_index, embeddings: np.ndarray, squared_norms: np.ndarray, query: np.ndarray, prefix_dims: int, candidates: int, k: int) -> np.ndarray:
+    """Returns the rows of the top k of one query, found like two_stage_search."""
+    _, candidate_rows = prefix_index.search(truncate_embeddings(query, prefix_dims), candidates)
+    rows = candidate_rows[0][candidate_rows[0] >= 0]
+    distances = squared_norms[rows] - 2.0 * (embeddings[rows] @ query) + query @ query
+    return rows[np.argsort(distances, kind='stable')[:k]]
+
+
+def percentiles(latencies: list) -> dict:
+    return {
+        'latency_ms_p50': round(float(np.percentile(latencies, 50)), 4),
+        'latency_ms_p95': round(float(np.percentile(latencies, 95)), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--k', type=int, default=32, help='Results per query')
+    parser.add_argument('--queries', type=int, default=500, help='Number of queries')
+    parser.add_argument('--noise', type=float, default=0.02, help='Noise added to the query embeddings')
+    parser.add_argument('--prefix-dims', type=int, default=256, help='Dimensions of the first stage')
+    parser.add_argument('--candidates', default='64,128,256,512', help='Comma separated candidates of the first stage')
+    parser.add_argument('--synthetic', type=int, default=0, help='Use a random corpus of this size')
+    parser.add_argument('--dims', type=int, default=1536, help='Dimensions of the random corpus')
+    parser.add_argument('--decay', type=float, default=0.5, help='Variance of dimension j of the random corpus is (1 + j) ** -decay')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    ids, embeddings = load_corpus(args.synthetic, args.dims, args.seed)
+    if args.synthetic:
+        embeddings *= (1.0 + np.arange(embeddings.shape[1], dtype=np.float32)) ** (-args.decay / 2)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    queries = make_queries(embeddings, args.queries, args.noise, args.seed)
+    count, dims = embeddings.shape
+    rows_ids = np.arange(count, dtype=np.int64)
+
+    full_index = build_index(embeddings, rows_ids, 'flat')
+    prefix_index = build_prefix_index(embeddings, rows_ids, args.prefix_dims, 'flat')
+    squared_norms = np.einsum('ij,ij->i', embeddings, embeddings)
+
+    single_rows, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, rows = full_index.search(query.reshape(1, -1), args.k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        single_rows.append(rows[0])
+    single_rows = np.array(single_rows)
+
+    report = {
+        'corpus': 'synthetic' if args.synthetic else 'embedding_store',
+        'vectors': count,
+        'dims': dims,
+        'prefix_dims': args.prefix_dims,
+        'queries': len(queries),
+        'k': args.k,
+        'single_stage': {
+            'flops_per_query': count * dims,
+            'index_bytes': int(faiss.serialize_index(full_index).nbytes),
+            **percentiles(latencies),
+        },
+        'two_stage': [],
+    }
+
+    for candidates in map(int, args.candidates.split(',')):
+        candidates = max(candidates, args.k)
+        found, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            rows = two_stage(prefix_index, embeddings, squared_norms, query, args.prefix_dims, candidates, args.k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append(np.pad(rows, (0, args.k - len(rows)), constant_values=-1))
+
+        report['two_stage'].append({
+            'candidates': candidates,
+            f'recall_at_{args.k}': round(recall_at_k(np.array(found), single_rows), 4),
+            'flops_per_query': count * args.prefix_dims + candidates * dims,
+            'index_bytes': int(faiss.serialize_index(prefix_index).nbytes),
+            **percentiles(latencies),
+        })
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
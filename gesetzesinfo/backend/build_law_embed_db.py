@@ -15,7 +15,11 @@ import faiss
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from api_app.util import clear_text
-from dotenv import dotenv_values
+from api_app.clients import get_openai_client
+from api_app.embedding_store import write_embedding_store
+from api_app.vector_index import build_index, build_prefix_index, law_index, law_prefix_index, TWO_STAGE_SEARCH
+from api_app.quantization import encode_embedding, decode_embedding
+from dotenv import dotenv_values, load_dotenv
 
 # Get the directory of the current script
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -25,6 +29,9 @@ env_path = os.path.join(parent_dir, '.env')
 # Load the environment variables
 env_vars = dotenv_values(env_path)
 
+# The shared api clients read their settings from the process environment
+load_dotenv(env_path)
+
 
 REBUILD = True
 
@@ -90,7 +97,7 @@ def embed_laws(laws: List[dict]) -> List[dict]:
     max_tokens = int(env_vars.get('EMBEDDING_MODEL_MAX_TOKENS', 8191))
     combined_texts = [clamp_text_to_tokens(law_to_text(law), max_tokens) for law in laws]
 
-    response = OpenAI(api_key=api_key).embeddings.create(
+    response = get_openai_client('openai').embeddings.create(
         model=env_vars.get('EMBEDDING_MODEL'),
         input=combined_texts,
         encoding_format='float',
@@ -203,7 +210,7 @@ def process_new_laws():
 
             # Prepare and insert data
             valid_data = [
-                ( law['book_code'], law['title'], law['text'], law['source_url'], np.array(law['embedding']).astype(np.float32).tobytes())
+                ( law['book_code'], law['title'], law['text'], law['source_url'], encode_embedding(law['embedding']))
                 for law in embedded_laws
             ]
 
@@ -233,7 +240,7 @@ def build_vector_db():
     This function:
     1. Fetches all embedded laws from the database.
     2. Creates a FAISS index using the embeddings.
-    3. Saves the index to a file named 'law_vector_db.faiss'.
+    3. Saves the index to vector_index.INDEX_PATH ('law_vector_db.faiss' in the data directory).
 
     The function provides progress updates and handles potential errors.
     """
@@ -247,7 +254,7 @@ def build_vector_db():
         return
 
     ids = np.array([row[0] for row in results], dtype=np.int64)
-    embeddings = np.array([np.frombuffer(row[1], dtype=np.float32) for row in results])
+    embeddings = np.array([decode_embedding(row[1]) for row in results], dtype=np.float32)
 
     print(f"Number of embeddings: {len(embeddings)}")
     print(f"Number of ids: {len(ids)}")
@@ -263,17 +270,23 @@ def build_vector_db():
     dimension = len(embeddings[0])
     print(f"Dimension: {dimension}")
 
-    index = faiss.IndexFlatL2(int(env_vars.get("EMBEDDING_MODEL_DIMS")))
-    id_map = faiss.IndexIDMap(index)
+    # Build (and train) an index of the type set in VECTOR_INDEX_TYPE (flat, ivf, hnsw, ivfpq)
+    id_map = build_index(embeddings, ids)
 
     print(f"Index created with dimension: {dimension}")
 
-    id_map.add_with_ids(embeddings, ids)
-
     print(f"Index total after adding: {id_map.ntotal}")
 
 
-    faiss.write_index(id_map, os.path.join(current_dir, 'law_vector_db.faiss')) 
+    # Written atomically to INDEX_PATH (honours LAW_DATA_DIR), the search workers reload it
+    law_index.publish(id_map)
+
+    # Index over the truncated embeddings, the first stage of the two stage search
+    if TWO_STAGE_SEARCH:
+        law_prefix_index.publish(build_prefix_index(embeddings, ids))
+
+    # Write the memory mapped embedding store, ratings start from the base embeddings
+    write_embedding_store(ids, {'base': embeddings, 'optimized': embeddings})
 
     print(f"Vector database built and saved with {len(ids)} laws.")
 
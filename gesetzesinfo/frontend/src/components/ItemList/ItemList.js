@@ -19,12 +19,15 @@ function ItemList({ items, error}) {
             {items.length > 0 ? (
                 items.map(item => (
                     <ListItem
-                        key={String(item.query_id) + String(item.id)}
+                        key={String(item.query) + String(item.id)}
                         id={item.id}
                         title={item.title}
-                        text={item.text}
+                        book_code={item.book_code}
+                        snippet={item.snippet}
+                        highlights={item.highlights}
                         score={item.score}
                         query_id={item.query_id}
+                        query={item.query}
                         show_id={item.show_id}
                     />
                 ))
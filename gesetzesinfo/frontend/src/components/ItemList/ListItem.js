@@ -5,14 +5,35 @@ import { Button } from '../Button/Button';
 const BACKEND_PORT = process.env.BACKEND_PORT || 8000;
 const API_DOMAIN = process.env.API_DOMAIN || "localhost";
 
-function ListItem({ id, title, text, score, query_id, show_id }) {
+/**
+ * Renders a snippet with the keyword matches (pairs of [start, end] offsets) highlighted.
+ * @param {string} snippet The snippet text
+ * @param {Array} highlights The offsets of the matches, sorted and not overlapping
+ */
+function HighlightedSnippet({ snippet, highlights }) {
+    const parts = [];
+    let position = 0;
+    (highlights || []).forEach(([start, end], index) => {
+        parts.push(snippet.slice(position, start));
+        parts.push(<mark key={index}>{snippet.slice(start, end)}</mark>);
+        position = end;
+    });
+    parts.push(snippet.slice(position));
+    return <>{parts}</>;
+}
+
+function ListItem({ id, title, book_code, snippet, highlights, score, query_id, query, show_id }) {
     const [isExpanded, setIsExpanded] = useState(false);
+    const [fullText, setFullText] = useState(null);
     const [itemData, setItemData] = useState({
         id,
         title,
-        text,
+        book_code,
+        snippet,
+        highlights,
         score,
         query_id,
+        query,
         show_id,
       });
 
@@ -21,18 +42,48 @@ function ListItem({ id, title, text, score, query_id, show_id }) {
     setItemData({
         id,
         title,
-        text,
+        book_code,
+        snippet,
+        highlights,
         score,
         query_id,
+        query,
         show_id,
     });
-    }, [id, title, text, score, query_id, show_id]);
+    setFullText(null);
+    }, [id, title, book_code, snippet, highlights, score, query_id, query, show_id]);
+
+    /**
+     * Loads the full text of the law. The response is cached by the browser (ETag).
+     * @async
+     */
+    const loadFullText = () => {
+        fetch(`http://${API_DOMAIN}:${BACKEND_PORT}/api/laws/${encodeURIComponent(itemData.id)}/`)
+            .then((response) => {
+                if (!response.ok) {
+                    throw new Error(`Network response was not ok: ${response.status}`);
+                }
+                return response.json();
+            })
+            .then((data) => {
+                if (data.error) {
+                    throw new Error(data.error);
+                }
+                setFullText(data.text);
+            })
+            .catch((error) => {
+                console.error('Error loading law:', error);
+            });
+    };
 
     /**
-     * Toggles the expanded state of the list item.
+     * Toggles the expanded state of the list item, loading the full text on the first expand.
      * @function
      */
     const toggleExpand = () => {
+        if (!isExpanded && fullText === null) {
+            loadFullText();
+        }
         setIsExpanded(!isExpanded);
     };
 
@@ -43,9 +94,12 @@ function ListItem({ id, title, text, score, query_id, show_id }) {
      * @async
      */
     const handleRatingClick = (value) => {
-       const query = `http://${API_DOMAIN}:${BACKEND_PORT}/api/rate/?id=${encodeURIComponent(itemData.id)}&qid=${encodeURIComponent(itemData.query_id)}&r=${encodeURIComponent(value)}`;
+       const searchQuery = itemData.query_id
+           ? `qid=${encodeURIComponent(itemData.query_id)}`
+           : `q=${encodeURIComponent(itemData.query)}`;
+       const rateUrl = `http://${API_DOMAIN}:${BACKEND_PORT}/api/rate/?id=${encodeURIComponent(itemData.id)}&${searchQuery}&r=${encodeURIComponent(value)}`;
 
-        fetch(query)
+        fetch(rateUrl)
             .then((response) => {
                 if (!response.ok) {
                     throw new Error(`Network response was not ok: ${response.status}`);
@@ -92,8 +146,17 @@ function ListItem({ id, title, text, score, query_id, show_id }) {
                 <div className="list-item-score">{itemData.score ? score.toFixed(4) : '0.00'}</div>
                 <div className="triangle"></div>
             </div>
+            {!isExpanded && (
+                <div className="list-item-snippet">
+                    <HighlightedSnippet snippet={itemData.snippet} highlights={itemData.highlights} />
+                </div>
+            )}
             <div className="list-item-content">
-                <div className="list-item-content-text">{text}</div>
+                <div className="list-item-content-text">
+                    {fullText !== null
+                        ? fullText
+                        : <HighlightedSnippet snippet={itemData.snippet} highlights={itemData.highlights} />}
+                </div>
                 <InteractionBar />
             </div>
         </div>
@@ -140,39 +140,93 @@ export function Search() {
     }, []);  // Empty dependency array to run only once when component mounts
 
         
-    const handleClick = () => {
-        const query = `http://${encodeURIComponent(API_DOMAIN)}:${encodeURIComponent(BACKEND_PORT)}/api/search?q=${encodeURIComponent(text)}`;
-
-        fetch(query)
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error('Network response was not ok');
+    /**
+     * Applies one event of the streaming search to the current results.
+     * @param {Array} current The results shown so far.
+     * @param {Object} event The event (results, merge, update, done or error).
+     * @returns {Array} The new results.
+     */
+    const applySearchEvent = (current, event) => {
+        switch (event.event) {
+            case 'results':
+                return event.results;
+            case 'merge':
+                return [...current, ...event.results];
+            case 'update': {
+                // Keyword highlights, final order and query_id of every result
+                const updates = new Map(event.results.map(update => [update.id, update]));
+                return current
+                    .map(item => ({ ...item, ...updates.get(item.id) }))
+                    .sort((a, b) => a.show_id - b.show_id);
+            }
+            case 'done':
+                if (event.count === 0) {
+                    throw new Error('No results found');
                 }
-                return response.json();
-            })
-            .then(data => {
-                if (data.error) {
-                    throw new Error(data.error);
+                return current;
+            case 'error':
+                throw new Error(event.error);
+            default:
+                return current;
+        }
+    };
+
+    const showItems = (current) => {
+        const validItems = current.filter(item => item.show_id && item.id && item.title && typeof item.snippet === 'string' && (item.score !== undefined && item.score !== null));
+        // The query_id is only known when the search log is written synchronously,
+        // otherwise the items are rated by the query itself
+        setItems(validItems.map(item => ({ ...item, query: text })));
+        setError(null);
+    };
+
+    /**
+     * Event handler for the search button click event.
+     * Reads the streaming search, the vector search hits are shown before the keyword search finishes.
+     */
+    const handleClick = async () => {
+        const query = `http://${encodeURIComponent(API_DOMAIN)}:${encodeURIComponent(BACKEND_PORT)}/api/search/stream/?q=${encodeURIComponent(text)}`;
+
+        try {
+            const response = await fetch(query);
+            if (!response.ok) {
+                throw new Error('Network response was not ok');
+            }
+
+            // Invalid queries are answered with a plain JSON error
+            if ((response.headers.get('Content-Type') || '').includes('application/json')) {
+                const data = await response.json();
+                throw new Error(data.error || 'Search response data format is incorrect');
+            }
+
+            // One JSON event per line
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let current = [];
+
+            for (;;) {
+                const { done, value } = await reader.read();
+                if (done) {
+                    break;
                 }
-                if (data && Array.isArray(data.results)) {
-                    const validItems = data.results.filter(item => item.show_id && item.id && item.title && item.text && item.query_id && (item.score !== undefined && item.score !== null));
-                    if (validItems.length === 0) {
-                        throw new Error('No results found');
-                    } else {
-                        
-                        setItems(validItems);
-                        setError(null);
+                buffer += decoder.decode(value, { stream: true });
+
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (line.trim()) {
+                        current = applySearchEvent(current, JSON.parse(line));
                     }
-                } else {
-                    throw new Error('Search response data format is incorrect');
                 }
-                updateLawCount();  // Update law count after successful search
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                setError(`${error}`);
-                setItems([]);
-            });
+                showItems(current);
+            }
+
+            updateLawCount();  // Update law count after successful search
+        } catch (error) {
+            console.error('Error:', error);
+            setError(`${error}`);
+            setItems([]);
+        }
     };
     return (
         <div className="search-container">